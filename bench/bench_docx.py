@@ -0,0 +1,171 @@
+# bench/bench_docx.py
+# DOCX extraction: engine.docxtext (document.xml streamed in body order) vs the previous
+# python-docx implementation (all paragraphs, then all tables).
+#
+# Generated contracts with N clauses: auto-numbered "第X条" headings (numbering.xml, the label
+# is not in the text), body paragraphs, and every 20 clauses a fee table with a horizontally
+# and a vertically merged cell. Reports wall time, peak memory and the
+# differences that matter to the model: clause labels kept, tables in place, merged cells once.
+# Memory is the growth of peak RSS while parsing, in a fresh process per run.
+#
+#   python -m bench.bench_docx
+#   python -m bench.bench_docx --clauses 200,2000,10000 --repeat 3
+
+import argparse
+import io
+import multiprocessing
+import re
+import resource
+import time
+from typing import Iterator, List, Tuple
+
+from engine.docxtext import iter_docx_blocks
+
+_NUMBERING_XML = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<w:numbering xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">
+  <w:abstractNum w:abstractNumId="90">
+    <w:lvl w:ilvl="0"><w:start w:val="1"/><w:numFmt w:val="chineseCounting"/><w:lvlText w:val="第%1条"/></w:lvl>
+    <w:lvl w:ilvl="1"><w:start w:val="1"/><w:numFmt w:val="chineseCounting"/><w:lvlText w:val="（%2）"/></w:lvl>
+  </w:abstractNum>
+  <w:num w:numId="90"><w:abstractNumId w:val="90"/></w:num>
+</w:numbering>"""
+_CLAUSE_RE = re.compile(r"第[零一二三四五六七八九十百千万]+条")
+
+
+def iter_docx_parts_python_docx(docx_bytes: bytes) -> Iterator[str]:
+    # 旧实现（engine/extract.py 里原来的 iter_docx_parts），留作对照
+    from docx import Document
+
+    doc = Document(io.BytesIO(docx_bytes))
+    for p in doc.paragraphs:
+        t = (p.text or "").strip()
+        if t:
+            yield t
+    for table in doc.tables:
+        for row in table.rows:
+            cells = []
+            for cell in row.cells:
+                ct = (cell.text or "").strip()
+                if ct:
+                    cells.append(ct)
+            if cells:
+                yield " | ".join(cells)
+
+
+_IMPLS = {"python-docx": iter_docx_parts_python_docx, "docxtext": iter_docx_blocks}
+
+
+def _make_docx(clauses: int) -> bytes:
+    from docx import Document
+    from docx.oxml import parse_xml
+    from docx.oxml.ns import qn
+
+    doc = Document()
+    for i in range(1, clauses + 1):
+        p = doc.add_paragraph(f"租金支付 {i}")
+        num_pr = parse_xml(
+            '<w:numPr xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main">'
+            '<w:ilvl w:val="0"/><w:numId w:val="90"/></w:numPr>'
+        )
+        p._p.get_or_add_pPr().append(num_pr)
+        doc.add_paragraph(
+            "甲方应于每月五日前支付当月租金，逾期按日万分之五向乙方支付违约金；"
+            "乙方未按约定交付房屋的，甲方有权解除合同并要求返还已付款项。"
+        )
+        if i % 20 == 0:
+            t = doc.add_table(rows=3, cols=3)
+            t.cell(0, 0).merge(t.cell(0, 2)).text = f"费用明细 {i}"       # horizontal merge
+            t.cell(1, 0).merge(t.cell(2, 0)).text = "押金"                # vertical merge
+            t.cell(1, 1).text, t.cell(1, 2).text = "金额", "5000元"
+            t.cell(2, 1).text, t.cell(2, 2).text = "退还", "租期届满后7日内"
+
+    # the default template's numbering part: add the clause list (abstractNum before the first num)
+    numbering = doc.part.numbering_part.element
+    abstract, num = parse_xml(_NUMBERING_XML.encode("utf-8"))
+    first_num = numbering.find(qn("w:num"))
+    if first_num is not None:
+        first_num.addprevious(abstract)
+    else:
+        numbering.append(abstract)
+    numbering.append(num)
+    buf = io.BytesIO()
+    doc.save(buf)
+    return buf.getvalue()
+
+
+def _hwm_mb() -> float:
+    # VmHWM resets with the new address space on exec; ru_maxrss would still carry the peak
+    # of the (forked) parent it was spawned from
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _rss_child(impl: str, data: bytes, conn):
+    import docx  # noqa: F401  (library import is not part of the comparison)
+
+    fn = _IMPLS[impl]
+    before = _hwm_mb()
+    for _ in fn(data):
+        pass
+    conn.send(_hwm_mb() - before)
+    conn.close()
+
+
+def _peak_rss_mb(impl: str, data: bytes) -> float:
+    # python-docx keeps its tree in lxml (C heap, invisible to tracemalloc), and a process that
+    # already parsed once reuses its freed arenas: measure peak RSS growth in a fresh process
+    ctx = multiprocessing.get_context("spawn")
+    recv, send = ctx.Pipe(duplex=False)
+    proc = ctx.Process(target=_rss_child, args=(impl, data, send))
+    proc.start()
+    send.close()
+    grown = recv.recv()
+    proc.join()
+    return grown
+
+
+def _measure(impl: str, data: bytes, repeat: int) -> Tuple[float, float, List[str]]:
+    fn = _IMPLS[impl]
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        parts = list(fn(data))
+        best = min(best, time.perf_counter() - t0)
+    return best, _peak_rss_mb(impl, data), parts
+
+
+def _table_offset(parts: List[str]) -> int:
+    # blocks between the heading of clause 20 and the first table (it belongs 2 blocks later)
+    heading = next((i for i, p in enumerate(parts) if p.endswith("租金支付 20")), -1)
+    table = next((i for i, p in enumerate(parts) if p.startswith("费用明细")), -1)
+    return table - heading
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--clauses", default="200,2000,10000")
+    ap.add_argument("--repeat", type=int, default=3)
+    args = ap.parse_args()
+
+    for n in [int(x) for x in args.clauses.split(",") if x.strip()]:
+        data = _make_docx(n)
+        print(f"\n{n} clauses, {n // 20} tables ({len(data) / 1024:.0f} KB docx)")
+        for label in _IMPLS:
+            best, peak, parts = _measure(label, data, args.repeat)
+            labels = sum(1 for p in parts if _CLAUSE_RE.match(p))
+            merged = sum(p.count("费用明细") for p in parts)
+            print(
+                f"  {label:<12}: {best * 1000:8.1f} ms  peak RSS +{peak:6.1f} MB  "
+                f"{len(parts):6d} blocks  clause labels {labels:5d}  "
+                f"merged header x{merged / max(1, n // 20):.0f}  first table at clause 20 {_table_offset(parts):+d}"
+            )
+
+
+if __name__ == "__main__":
+    main()
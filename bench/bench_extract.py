@@ -0,0 +1,135 @@
+# bench/bench_extract.py
+# PDF extraction in a worker process vs inline, and streaming pages into the chunker.
+#
+# For generated 1 / 50 / 300-page contracts (text layer, optionally with scanned pages):
+#   parse     time to first page / last page, inline vs in a worker process (EXTRACT_WORKERS),
+#             and the CPU time the calling process itself spends (what used to block the server)
+#   pipeline  extract-then-analyze vs streamed chunk calls (_ChunkStream), fake model
+#
+#   python -m bench.bench_extract
+#   python -m bench.bench_extract --pages 1,50,300 --scanned-every 10 --latency 2.0
+#
+# Runs offline: LLM_PROVIDER defaults to fake here, the DB to a throwaway file.
+
+import argparse
+import os
+import resource
+import tempfile
+import time
+from typing import Dict, List, Tuple
+
+
+def _make_pdf(pages: int, scanned_every: int) -> bytes:
+    import fitz
+
+    doc = fitz.open()
+    art = 0
+    for i in range(pages):
+        page = doc.new_page()
+        if scanned_every and (i + 1) % scanned_every == 0:
+            # an image-only page (signature page / photographed annex)
+            pix = fitz.Pixmap(fitz.csGRAY, fitz.IRect(0, 0, 600, 800), False)
+            pix.clear_with(235)
+            page.insert_image(page.rect, pixmap=pix)
+            continue
+        lines = []
+        for _ in range(18):
+            art += 1
+            lines.append(f"第{art}条 甲方应于每月五日前支付当月租金，逾期按日万分之五向乙方支付违约金；"
+                         f"乙方未按约定交付房屋的，甲方有权解除合同。")
+        page.insert_textbox(page.rect + (40, 40, -40, -40), "\n".join(lines), fontname="china-s", fontsize=9)
+    return doc.tobytes()
+
+
+def _cpu() -> float:
+    r = resource.getrusage(resource.RUSAGE_SELF)
+    return r.ru_utime + r.ru_stime
+
+
+def _parse(app_main, pool, pdf: bytes) -> Tuple[float, float, float, int]:
+    from engine.extract import iter_pdf_pages
+
+    t0, c0 = time.perf_counter(), _cpu()
+    first = None
+    n = 0
+    for _ in pool.stream(iter_pdf_pages, pdf, max_pages=app_main.PDF_MAX_PAGES, dpi=app_main.OCR_PDF_DPI):
+        n += 1
+        if first is None:
+            first = time.perf_counter() - t0
+    return first or 0.0, time.perf_counter() - t0, _cpu() - c0, n
+
+
+def _pipeline(app_main, pdf: bytes, streamed: bool) -> Dict[str, float]:
+    t0 = time.perf_counter()
+    first_call: List[float] = []
+    calls = [0]
+    inner = app_main._analyze_text_once
+
+    def spy(*a, **kw):
+        calls[0] += 1
+        if not first_call:
+            first_call.append(time.perf_counter() - t0)
+        return inner(*a, **kw)
+
+    app_main._analyze_text_once = spy
+    app_main._chunk_memo = app_main.LRUCache(app_main.CHUNK_MEMO_SIZE)  # every run from scratch
+    try:
+        stream = app_main._ChunkStream("lease", "A")
+        text, _ = app_main._extract_pdf_text_or_ocr(pdf, on_page=stream.feed if streamed else None)
+        extracted = time.perf_counter() - t0
+        stream.finish(text)
+    finally:
+        app_main._analyze_text_once = inner
+    return {
+        "extracted": extracted,
+        "first_call": first_call[0] if first_call else 0.0,
+        "total": time.perf_counter() - t0,
+        "calls": calls[0],
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--pages", default="1,50,300")
+    ap.add_argument("--scanned-every", type=int, default=0, help="every Nth page is image-only (OCR)")
+    ap.add_argument("--latency", type=float, default=1.0, help="fake model latency per call (s)")
+    args = ap.parse_args()
+
+    os.environ.setdefault("LLM_PROVIDER", "fake")
+    os.environ.setdefault("OPENAI_API_KEY", "bench")
+    os.environ.setdefault("CONTRACT_AI_DB", os.path.join(tempfile.mkdtemp(), "bench.db"))
+    os.environ.setdefault("FAKE_LLM_LATENCY", f"const:{args.latency}")
+    os.environ.setdefault("OCR_CACHE", "0")
+
+    import main as app_main
+    from engine.extract import ExtractionPool
+
+    inline = ExtractionPool(0)
+    worker = ExtractionPool(app_main.EXTRACT_WORKERS or 2, app_main.EXTRACT_TIMEOUT_SECONDS, app_main.EXTRACT_MEMORY_MB)
+    _parse(app_main, worker, _make_pdf(1, 0))  # start the forkserver
+
+    print(
+        f"EXTRACT_WORKERS={app_main.EXTRACT_WORKERS} EXTRACT_MEMORY_MB={app_main.EXTRACT_MEMORY_MB} "
+        f"CHUNK_TOKENS={app_main.CHUNK_TOKENS} model latency={args.latency}s"
+    )
+    for n in [int(x) for x in args.pages.split(",") if x.strip()]:
+        pdf = _make_pdf(n, args.scanned_every)
+        print(f"\n{n} pages ({len(pdf) / 1024:.0f} KB)")
+        for label, pool in (("inline", inline), ("process", worker)):
+            first, total, cpu, pages = _parse(app_main, pool, pdf)
+            print(
+                f"  parse {label:<8}: first page {first * 1000:7.1f} ms  all {pages} pages {total * 1000:8.1f} ms  "
+                f"caller cpu {cpu * 1000:7.1f} ms"
+            )
+        for label, streamed in (("sequential", False), ("streamed", True)):
+            r = _pipeline(app_main, pdf, streamed)
+            print(
+                f"  {label:<14}: extracted {r['extracted']:6.2f}s  first model call {r['first_call']:6.2f}s  "
+                f"done {r['total']:6.2f}s  ({r['calls']} calls)"
+            )
+    # workers are forked by the forkserver, so their memory never shows up here
+    print(f"\npeak RSS of this process: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+# bench/bench_imageprep.py
+# OCR image preprocessing (engine/imageprep.py): bytes / vision tokens saved, duplicate pages
+# dropped, and optionally OCR text agreement against the unprocessed images.
+#
+# Usage:
+#   python -m bench.bench_imageprep                          # synthetic phone-sized pages
+#   python -m bench.bench_imageprep --images ./samples       # your own jpg/png/webp pages
+#   LLM_PROVIDER=openai python -m bench.bench_imageprep --images ./samples --ocr
+#
+# Agreement = character-bigram Dice similarity (engine.merge.similarity) between the OCR text of
+# the original and of the processed image. It is only meaningful with a real model: the fake
+# provider derives its "OCR" text from the image bytes.
+
+import argparse
+import io
+import os
+import random
+import time
+from typing import List, Tuple
+
+from engine.imageprep import available, duplicate_positions, page_signature, prepare_image
+
+
+def _synthetic_pages(n: int, seed: int) -> List[Tuple[str, bytes, str]]:
+    from PIL import Image, ImageDraw, ImageFont
+
+    rng = random.Random(seed)
+    try:
+        font = ImageFont.load_default(size=44)  # roughly a 12pt line in a 12MP phone photo
+    except TypeError:  # Pillow < 10.1
+        font = ImageFont.load_default()
+    words = "lessee lessor rent deposit term notice breach repair premises payment clause party".split()
+    pages = []
+    for k in range(1, n + 1):
+        img = Image.new("RGB", (3024, 4032), (236 + rng.randint(0, 12),) * 3)
+        d = ImageDraw.Draw(img)
+        for line in range(56):
+            text = f"{k}.{line} " + " ".join(rng.choice(words) for _ in range(rng.randint(6, 11)))
+            d.text((180, 200 + line * 64), text, fill=(20, 20, 20), font=font)
+        # sensor noise, so the JPEG is as heavy as a real photo
+        px = img.load()
+        for _ in range(40000):
+            x, y = rng.randrange(img.width), rng.randrange(img.height)
+            v = rng.randint(150, 255)
+            px[x, y] = (v, v, v)
+        exif = Image.Exif()
+        exif[0x0112] = 6 if k % 2 == 0 else 1  # every other page shot in portrait-rotated mode
+        buf = io.BytesIO()
+        img.save(buf, format="JPEG", quality=95, exif=exif)
+        pages.append((f"synthetic_{k}.jpg", buf.getvalue(), "image/jpeg"))
+    # the same first page uploaded twice (re-encoded)
+    again = Image.open(io.BytesIO(pages[0][1]))
+    buf = io.BytesIO()
+    again.save(buf, format="JPEG", quality=90)
+    pages.append(("synthetic_1_again.jpg", buf.getvalue(), "image/jpeg"))
+    return pages
+
+
+def _load_dir(path: str) -> List[Tuple[str, bytes, str]]:
+    mimes = {".jpg": "image/jpeg", ".jpeg": "image/jpeg", ".png": "image/png", ".webp": "image/webp"}
+    out = []
+    for name in sorted(os.listdir(path)):
+        ext = os.path.splitext(name)[1].lower()
+        if ext in mimes:
+            with open(os.path.join(path, name), "rb") as f:
+                out.append((name, f.read(), mimes[ext]))
+    return out
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--images", help="directory of page images (default: synthetic pages)")
+    ap.add_argument("--pages", type=int, default=4, help="synthetic pages to generate")
+    ap.add_argument("--max-side", type=int, default=2000)
+    ap.add_argument("--format", choices=["jpeg", "webp"], default="jpeg")
+    ap.add_argument("--quality", type=int, default=80)
+    ap.add_argument("--color", action="store_true", help="keep colour (default: grayscale)")
+    ap.add_argument("--dedupe-distance", type=int, default=4)
+    ap.add_argument("--ocr", action="store_true", help="also OCR original vs processed and compare")
+    ap.add_argument("--seed", type=int, default=7)
+    args = ap.parse_args()
+
+    if not available():
+        print("Pillow is not installed: images pass through unchanged")
+        return
+
+    pages = _load_dir(args.images) if args.images else _synthetic_pages(args.pages, args.seed)
+    if not pages:
+        print("no images found")
+        return
+
+    print(
+        f"pages={len(pages)} max_side={args.max_side} format={args.format} quality={args.quality} "
+        f"grayscale={not args.color}"
+    )
+    prepared = []
+    for name, data, mime in pages:
+        t0 = time.perf_counter()
+        p = prepare_image(
+            data, mime, max_side=args.max_side, grayscale=not args.color, fmt=args.format, quality=args.quality,
+        )
+        dt = time.perf_counter() - t0
+        prepared.append(p)
+        print(
+            f"  {name:<24} {len(data) / 1024:8.0f} KB -> {len(p.data) / 1024:6.0f} KB  "
+            f"{p.size_in[0]}x{p.size_in[1]} -> {p.size_out[0]}x{p.size_out[1]}  "
+            f"tokens {p.tokens_in:5d} -> {p.tokens_out:5d}  {dt * 1000:5.0f} ms"
+        )
+
+    dup = duplicate_positions([page_signature(d) for _, d, _ in pages], args.dedupe_distance)
+    bytes_in = sum(len(d) for _, d, _ in pages)
+    bytes_out = sum(len(p.data) for i, p in enumerate(prepared) if i not in dup)
+    tokens_in = sum(p.tokens_in for p in prepared)
+    tokens_out = sum(p.tokens_out for i, p in enumerate(prepared) if i not in dup)
+    print(f"  duplicates     : {[pages[i][0] for i in dup] or 'none'}")
+    print(f"  bytes          : {bytes_in / 1024:.0f} KB -> {bytes_out / 1024:.0f} KB  (-{1 - bytes_out / bytes_in:.0%})")
+    if tokens_in:
+        print(f"  vision tokens  : {tokens_in} -> {tokens_out}  (-{1 - tokens_out / tokens_in:.0%})")
+
+    if args.ocr:
+        from engine.llm import make_provider
+        from engine.merge import similarity
+
+        provider_name = os.getenv("LLM_PROVIDER", "fake")
+        model = os.getenv("OCR_MODEL", "gpt-4o-mini")
+        prompt = "请对图片进行OCR，输出完整可读的中文合同文本。只输出纯文本，不要解释。"
+        llm = make_provider(provider_name)
+        print(f"  ocr agreement  : provider={provider_name} model={model}")
+        for (name, data, mime), p in zip(pages, prepared):
+            base = llm.ocr(model, prompt, [(data, mime)])
+            proc = llm.ocr(model, prompt, [(p.data, p.mime)])
+            print(f"    {name:<22} {similarity(base, proc):.3f}  ({len(base)} vs {len(proc)} chars)")
+        if provider_name == "fake":
+            print("    (fake provider: text depends on the bytes, agreement is not meaningful)")
+
+
+if __name__ == "__main__":
+    main()
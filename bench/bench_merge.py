@@ -0,0 +1,141 @@
+# bench/bench_merge.py
+# Local merge vs LLM merge: latency and output agreement.
+#
+# Modes compared:
+#   local      : engine.merge.merge_chunk_results_local (MERGE_MODE=local, no model call)
+#   llm-summary: local clauses/score + model-written riskSummary (MERGE_MODE=llm)
+#   llm-full   : the previous full-LLM merge prompt (baseline for agreement, --live only)
+#
+# Usage:
+#   python -m bench.bench_merge                        # synthetic chunks, fake model (engine/llm.py)
+#   python -m bench.bench_merge --input chunks.json    # captured chunk results (list of dicts)
+#   OPENAI_API_KEY=... python -m bench.bench_merge --input chunks.json --live
+
+import argparse
+import json
+import random
+import time
+from typing import Any, Dict, List
+
+from engine.llm import FakeProvider, LLMProvider, make_provider
+from engine.merge import (
+    build_summary_merge_messages,
+    is_duplicate,
+    merge_chunk_results_local,
+    similarity,
+)
+from prompts.registry import build_system_prompt
+
+LEGACY_MERGE_RULES = (
+    "\n你将收到多个分块审阅结果，请合并去重并输出最终JSON。"
+    "合并规则：\n"
+    "- clauses 去重：若 originalText/标题/含义高度相似则只保留更清晰的一条。\n"
+    "- 保留最重要的风险点，最多12条。\n"
+    "- score 取整体风险评估（不是简单平均，可偏向更高风险）。\n"
+)
+
+
+def _synthetic_chunks(n_chunks: int, seed: int) -> List[Dict[str, Any]]:
+    # 8 distinct risks; each chunk re-reports 4 of them with small wording differences,
+    # like overlapping chunks do. A perfect merge keeps exactly 8 clauses.
+    rng = random.Random(seed)
+    topics = [
+        ("押金", "押金扣除标准模糊", "退租时房屋如有损耗，出租人可在押金中酌情扣除。"),
+        ("解约", "提前解约违约金过高", "乙方提前解约需支付三个月租金作为违约金。"),
+        ("维修", "维修责任整体转嫁给承租人", "房屋及设施维修均由承租人负责。"),
+        ("租金", "出租人可单方上调租金", "出租人可根据市场行情调整租金，乙方应予配合。"),
+        ("转租", "禁止转租且无例外", "未经甲方书面同意，乙方不得转租或分租。"),
+        ("费用", "物业取暖费用承担不明", "水电燃气物业及取暖等费用按实际情况承担。"),
+        ("交房", "交房标准缺失", "甲方按现状交付房屋。"),
+        ("续租", "未约定续租优先权", "租期届满后是否续租由甲方决定。"),
+    ]
+    out = []
+    for i in range(n_chunks):
+        clauses = []
+        for section, title, text in rng.sample(topics, 4):
+            clauses.append({
+                "section": section,
+                "title": title if rng.random() < 0.5 else title + "，对乙方不利",
+                "originalText": text if rng.random() < 0.5 else f"第{rng.randint(1, 30)}条 " + text,
+                "explanation": f"{title}。" * rng.randint(1, 3),
+                "suggestion": f"建议明确{section}相关标准。",
+                "level": rng.choice(["HIGH", "MEDIUM", "LOW"]),
+            })
+        out.append({
+            "score": rng.randint(35, 85),
+            "riskSummary": f"本部分主要风险集中在{clauses[0]['section']}条款。整体条款偏向出租人。",
+            "clauses": clauses,
+        })
+    return out
+
+
+MODEL = "gpt-4.1-mini"
+
+
+def _clause_agreement(a: List[Dict[str, Any]], b: List[Dict[str, Any]]) -> float:
+    if not a and not b:
+        return 1.0
+    matched = sum(1 for x in a if any(is_duplicate(x, y) for y in b))
+    return matched / max(len(a), len(b))
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--input", help="JSON file: list of chunk results")
+    ap.add_argument("--chunks", type=int, default=12)
+    ap.add_argument("--latency", type=float, default=1.5, help="fake model latency (s)")
+    ap.add_argument("--live", action="store_true", help="use OpenAI (needs OPENAI_API_KEY)")
+    ap.add_argument("--type", default="lease")
+    ap.add_argument("--identity", default="B")
+    args = ap.parse_args()
+
+    if args.input:
+        with open(args.input, "r", encoding="utf-8") as f:
+            chunks = json.load(f)
+    else:
+        chunks = _synthetic_chunks(args.chunks, seed=7)
+
+    llm: LLMProvider = make_provider("openai") if args.live else FakeProvider(latency=f"const:{args.latency}")
+    system = build_system_prompt(args.type, args.identity)
+
+    t0 = time.perf_counter()
+    local = merge_chunk_results_local(chunks)
+    t_local = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    summary_only = dict(merge_chunk_results_local(chunks))
+    raw = llm.chat(MODEL, build_summary_merge_messages(system, chunks, summary_only))
+    summary_only["riskSummary"] = json.loads(raw).get("riskSummary", "")
+    t_llm_summary = time.perf_counter() - t0
+
+    n_in = sum(len(c.get("clauses") or []) for c in chunks)
+    print(f"chunks={len(chunks)} input clauses={n_in} live={args.live}")
+    print(f"  local       : {t_local * 1000:9.1f} ms  clauses={len(local['clauses'])} score={local['score']}")
+    print(f"  llm-summary : {t_llm_summary * 1000:9.1f} ms  (same clauses/score as local)")
+
+    if not args.live:
+        print("  (agreement against the full-LLM merge needs --live)")
+        return
+
+    compact = [
+        {"chunkIndex": i, "score": r.get("score", 0), "riskSummary": r.get("riskSummary", ""), "clauses": r.get("clauses", [])}
+        for i, r in enumerate(chunks, start=1)
+    ]
+    t0 = time.perf_counter()
+    raw = llm.chat(MODEL, [
+        {"role": "system", "content": system + LEGACY_MERGE_RULES},
+        {"role": "user", "content": json.dumps(compact, ensure_ascii=False)},
+    ])
+    t_full = time.perf_counter() - t0
+    full = json.loads(raw)
+
+    print(f"  llm-full    : {t_full * 1000:9.1f} ms  clauses={len(full.get('clauses') or [])} score={full.get('score')}")
+    print("agreement vs llm-full:")
+    print(f"  clause overlap        : {_clause_agreement(local['clauses'], full.get('clauses') or []):.2f}")
+    print(f"  |score delta|         : {abs(float(local['score']) - float(full.get('score') or 0)):.1f}")
+    print(f"  summary sim (local)   : {similarity(local['riskSummary'], full.get('riskSummary', '')):.2f}")
+    print(f"  summary sim (llm-sum) : {similarity(summary_only['riskSummary'], full.get('riskSummary', '')):.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+# bench/loadtest.py
+# Offline load test of the analysis endpoints against the in-process fake model.
+#
+# The app is driven in-process (FastAPI TestClient, no network) with LLM_PROVIDER=fake and a
+# throwaway SQLite file, so the numbers are server overhead + injected model latency —
+# independent of OpenAI. Fake model behaviour is set with the FAKE_LLM_* env vars (engine/llm.py).
+#
+# Usage:
+#   python -m bench.loadtest
+#   python -m bench.loadtest --scenario job --requests 200 --concurrency 32 --dup 0.3
+#   FAKE_LLM_LATENCY=lognormal:2:0.5 FAKE_LLM_FAILURE_RATE=0.05 python -m bench.loadtest --chars 120000
+#   FAKE_LLM_FAILURE_RATE=0.5 LLM_BREAKER_THRESHOLD=3 python -m bench.loadtest   (outage: breaker trips, 503s)
+#   FAKE_LLM_DRIFT_RATE=0.3 ANALYSIS_OUTPUT_MODE=text python -m bench.loadtest      (schema drift: re-asks)
+#
+# Scenarios:
+#   text   : POST /v1/contracts/analyze/text (synchronous)
+#   stream : POST /v1/contracts/analyze/text/stream (SSE; also reports the server-side time to
+#            first clause — TestClient hands the body over only once the stream has ended)
+#   job    : POST /v1/jobs/analyze/text, then poll GET /v1/jobs/{id} until finished
+
+import argparse
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+
+
+def _contract(n_chars: int, seed: int) -> str:
+    rng = random.Random(seed)
+    topics = ["租金", "押金", "维修", "违约", "转租", "续租", "交付", "费用", "保密", "争议解决"]
+    parts, total, k = [], 0, 1
+    while total < n_chars:
+        topic = rng.choice(topics)
+        line = (
+            f"第{k}条 {topic}\n"
+            f"双方就{topic}事项约定如下：乙方应于每月{rng.randint(1, 28)}日前履行相应义务，"
+            f"逾期按日千分之{rng.randint(1, 9)}支付违约金；甲方有权单方调整{topic}标准。"
+        )
+        parts.append(line)
+        total += len(line)
+        k += 1
+    return "\n".join(parts)
+
+
+def _pct(vals: List[float], p: float) -> float:
+    if not vals:
+        return 0.0
+    vals = sorted(vals)
+    return vals[min(len(vals) - 1, int(p * len(vals)))]
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--scenario", choices=["text", "stream", "job"], default="text")
+    ap.add_argument("--requests", type=int, default=100)
+    ap.add_argument("--concurrency", type=int, default=16)
+    ap.add_argument("--users", type=int, default=20)
+    ap.add_argument("--chars", type=int, default=6000, help="contract size (above SINGLE_PASS_TOKENS, ~90k chars, exercises chunking)")
+    ap.add_argument("--dup", type=float, default=0.0, help="share of requests reusing one popular contract")
+    ap.add_argument("--seed", type=int, default=7)
+    args = ap.parse_args()
+
+    os.environ.setdefault("LLM_PROVIDER", "fake")
+    os.environ.setdefault("FAKE_LLM_LATENCY", "lognormal:1.0:0.3")
+    db_dir = tempfile.mkdtemp(prefix="loadtest-")
+    os.environ.setdefault("METRICS_TOKEN", "loadtest")
+    os.environ["CONTRACT_AI_DB"] = os.path.join(db_dir, "loadtest.db")
+
+    import main as app_main
+    from fastapi.testclient import TestClient
+
+    client = TestClient(app_main.app, raise_server_exceptions=False)
+    db = app_main.SessionLocal()
+    try:
+        headers = []
+        for i in range(args.users):
+            u = app_main.User(phone=f"199{i:08d}", password_hash="x", credits=args.requests + 10)
+            db.add(u)
+            db.commit()
+            headers.append({"Authorization": "Bearer " + app_main._make_token(u.id)})
+    finally:
+        db.close()
+
+    rng = random.Random(args.seed)
+    popular = _contract(args.chars, seed=0)
+    plan: List[Tuple[Dict[str, str], str]] = []
+    for i in range(args.requests):
+        content = popular if rng.random() < args.dup else _contract(args.chars, seed=i + 1)
+        plan.append((headers[i % len(headers)], content))
+
+    lock = threading.Lock()
+    latencies: List[float] = []
+    statuses: Dict[str, int] = {}
+
+    def one(item: Tuple[Dict[str, str], str]):
+        h, content = item
+        body = {"type": "lease", "identity": "B", "content": content}
+        t0 = time.perf_counter()
+        status = "ok"
+        if args.scenario == "text":
+            r = client.post("/v1/contracts/analyze/text", json=body, headers=h)
+            if r.status_code != 200:
+                status = str(r.status_code)
+        elif args.scenario == "stream":
+            r = client.post("/v1/contracts/analyze/text/stream", json=body, headers=h)
+            if r.status_code != 200 or "event: error" in r.text:
+                status = "error"
+        else:
+            r = client.post("/v1/jobs/analyze/text", json=body, headers=h)
+            if r.status_code != 200:
+                status = str(r.status_code)
+            else:
+                job_id = r.json()["jobId"]
+                while True:
+                    j = client.get(f"/v1/jobs/{job_id}", headers=h).json()
+                    if j["status"] in ("SUCCEEDED", "FAILED"):
+                        status = "ok" if j["status"] == "SUCCEEDED" else "failed"
+                        break
+                    time.sleep(0.05)
+        dt = time.perf_counter() - t0
+        with lock:
+            latencies.append(dt)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    if args.scenario == "job":
+        # the per-user active-job cap would turn the load test into a 429 test
+        app_main.MAX_ACTIVE_JOBS_PER_USER = 10 ** 6
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(one, plan))
+    wall = time.perf_counter() - t0
+
+    snap = client.get("/v1/metrics", headers={"X-Metrics-Token": os.environ["METRICS_TOKEN"]}).json()
+    counters = snap["counters"]
+    llm_calls = sum(v for k, v in counters.items() if k.startswith("llm.") and k.endswith(".calls"))
+
+    print(
+        f"scenario={args.scenario} requests={args.requests} concurrency={args.concurrency} "
+        f"chars={args.chars} dup={args.dup} provider={snap['derived']['llm.provider']} "
+        f"latency={os.environ.get('FAKE_LLM_LATENCY')}"
+    )
+    print(f"  throughput     : {args.requests / wall:8.2f} req/s  (wall {wall:.2f}s)")
+    print(
+        f"  latency        : p50 {_pct(latencies, 0.5):.2f}s  p95 {_pct(latencies, 0.95):.2f}s  "
+        f"p99 {_pct(latencies, 0.99):.2f}s  max {max(latencies):.2f}s"
+    )
+    ttfc = snap["timings"].get("analysis.stream.time_to_first_clause_s")
+    if ttfc:
+        print(f"  first clause   : p50 {ttfc['p50']:.2f}s  p95 {ttfc['p95']:.2f}s  (server side)")
+    print(f"  outcomes       : {json.dumps(statuses)}")
+    print(f"  model calls    : {llm_calls:.0f}  ({llm_calls / args.requests:.2f} per request)")
+    print(
+        f"  tokens         : prompt {counters.get('llm.prompt_tokens', 0):.0f}  "
+        f"completion {counters.get('llm.completion_tokens', 0):.0f}"
+    )
+    print(
+        f"  cache hit rate : {snap['derived']['analysis_cache.hit_rate']:.2f}  "
+        f"coalesced {snap['derived']['singleflight.coalescing_rate']:.2f}"
+    )
+    print(
+        f"  resilience     : retries {counters.get('llm.retry.attempts', 0):.0f}  "
+        f"exhausted {counters.get('llm.retry.exhausted', 0):.0f}  "
+        f"breaker trips {counters.get('llm.breaker.trips', 0):.0f} ({snap['derived']['llm.breaker.state']})  "
+        f"refunds {counters.get('credits.refunded', 0):.0f}"
+    )
+    print(
+        f"  output repairs : json re-asks {counters.get('analysis.json_repair.reask', 0):.0f}  "
+        f"schema re-asks {counters.get('analysis.schema.reask', 0):.0f}  "
+        f"dropped clauses {counters.get('analysis.schema.dropped_clauses', 0):.0f}"
+    )
+    print(f"  db             : {os.environ['CONTRACT_AI_DB']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+# bench/migrate_blobs.py
+# Move uploaded originals out of SQLite into the blob store (BLOB_DIR), then check / repair it.
+#
+# Importing main already moves analyses.file_bytes into BLOB_DIR (batched, idempotent); this
+# script additionally:
+#   --drop-column  drops the emptied analyses.file_bytes column (SQLite >= 3.35)
+#   --vacuum       VACUUMs the database so the freed BLOB pages are returned to the filesystem
+#   --fsck         recounts references from analyses, fixes blobs.refcount, reports missing files
+#   --gc           deletes files in BLOB_DIR that no blobs row references, and extracted_texts rows
+#                  no analysis references (e.g. the analysis failed after extraction); both only
+#                  when older than --min-age
+#
+#   python -m bench.migrate_blobs                       # migrate + report
+#   python -m bench.migrate_blobs --drop-column --vacuum
+#   python -m bench.migrate_blobs --db /srv/contract_ai.db --fsck --gc
+#
+# Run it with the server stopped: the per-sha locks only exist inside one process.
+
+import argparse
+import os
+from datetime import datetime, timedelta
+
+
+def _mb(n: int) -> str:
+    return f"{n / (1024 * 1024):.1f} MB"
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--db", help="SQLite file (default: CONTRACT_AI_DB or the app's contract_ai.db)")
+    ap.add_argument("--drop-column", action="store_true")
+    ap.add_argument("--vacuum", action="store_true")
+    ap.add_argument("--fsck", action="store_true")
+    ap.add_argument("--gc", action="store_true")
+    ap.add_argument("--min-age", type=float, default=3600, help="--gc: keep files younger than this (s)")
+    args = ap.parse_args()
+
+    if args.db:
+        os.environ["CONTRACT_AI_DB"] = args.db
+    os.environ.setdefault("OPENAI_API_KEY", "migrate")
+
+    import main as app_main  # runs _migrate_legacy_file_blobs()
+    from sqlalchemy import func, select
+
+    db_size_before = os.path.getsize(app_main.DB_PATH)
+    store = app_main._blob_store
+    Analysis, Blob = app_main.Analysis, app_main.Blob
+
+    db = app_main.SessionLocal()
+    try:
+        refs = dict(
+            db.query(Analysis.file_sha, func.count(Analysis.id))
+            .filter(Analysis.file_sha.isnot(None))
+            .group_by(Analysis.file_sha)
+            .all()
+        )
+        logical = db.query(func.coalesce(func.sum(Analysis.file_size), 0)).scalar()
+        blobs = {b.sha256: b for b in db.query(Blob).all()}
+        stored = sum(b.size for b in blobs.values())
+        print(f"db        : {app_main.DB_PATH}")
+        print(f"blob dir  : {app_main.BLOB_DIR}")
+        print(f"analyses with a file: {sum(refs.values())}  distinct files: {len(refs)}")
+        print(f"bytes referenced {_mb(logical)}  stored {_mb(stored)}  (dedup saves {_mb(max(0, logical - stored))})")
+
+        if args.fsck:
+            fixed = missing = 0
+            for sha, n in refs.items():
+                b = blobs.get(sha)
+                if b is None:
+                    db.add(Blob(sha256=sha, size=store.size(sha) if store.exists(sha) else 0, refcount=n))
+                    fixed += 1
+                elif b.refcount != n:
+                    b.refcount = n
+                    fixed += 1
+                if not store.exists(sha):
+                    missing += 1
+                    print(f"  missing file {sha} ({n} analyses)")
+            for sha, b in blobs.items():
+                if sha not in refs:
+                    db.delete(b)
+                    fixed += 1
+            db.commit()
+            print(f"fsck      : {fixed} refcount row(s) fixed, {missing} file(s) missing")
+
+        if args.gc:
+            known = {sha for (sha,) in db.query(Blob.sha256)}
+            removed = freed = 0
+            for sha, size in list(store.iter_blobs(min_age_seconds=args.min_age)):
+                if sha not in known and store.remove(sha):
+                    removed += 1
+                    freed += size
+            print(f"gc        : removed {removed} unreferenced file(s), {_mb(freed)}")
+
+            ExtractedText = app_main.ExtractedText
+            cutoff = datetime.utcnow() - timedelta(seconds=args.min_age)
+            referenced = select(Analysis.id).where(Analysis.extracted_text_id == ExtractedText.id).exists()
+            texts = (
+                db.query(ExtractedText)
+                .filter(ExtractedText.created_at < cutoff, ~referenced)
+                .delete(synchronize_session=False)
+            )
+            db.commit()
+            print(f"gc        : removed {texts} unreferenced extracted text(s)")
+    finally:
+        db.close()
+
+    if args.drop_column:
+        with app_main.engine.connect() as conn:
+            cols = {r[1] for r in conn.exec_driver_sql("PRAGMA table_info(analyses);").fetchall()}
+            if "file_bytes" in cols:
+                conn.exec_driver_sql("ALTER TABLE analyses DROP COLUMN file_bytes;")
+                conn.commit()
+                print("dropped   : analyses.file_bytes")
+    if args.vacuum:
+        with app_main.engine.connect() as conn:
+            conn.exec_driver_sql("VACUUM;")
+        print(f"vacuum    : {_mb(db_size_before)} -> {_mb(os.path.getsize(app_main.DB_PATH))}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+# bench/query_plans.py
+# EXPLAIN QUERY PLAN for every hot query in main._hot_queries(); exits 1 if any does a full table scan
+# or a temp b-tree sort.
+#
+#   python -m bench.query_plans
+#   python -m bench.query_plans --db /srv/contract_ai.db
+#
+# Importing main creates the tables / indexes (idempotent), so point --db at a copy if the
+# production file must not be touched.
+
+import argparse
+import os
+import sys
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--db", help="SQLite file (default: CONTRACT_AI_DB or the app's contract_ai.db)")
+    args = ap.parse_args()
+
+    if args.db:
+        os.environ["CONTRACT_AI_DB"] = args.db
+    os.environ.setdefault("OPENAI_API_KEY", "query-plans")
+    os.environ["QUERY_PLAN_AUDIT"] = "off"  # 这里自己跑、自己打印
+
+    import main as app_main
+
+    report = app_main.run_query_plan_audit()
+    bad = 0
+    for name, steps, flagged in report:
+        print(f"{'FAIL' if flagged else 'ok  '}  {name}")
+        for step in steps:
+            print(f"        {step}")
+        bad += bool(flagged)
+    print(f"{len(report)} queries, {bad} with a full table scan or temp b-tree sort")
+    sys.exit(1 if bad else 0)
+
+
+if __name__ == "__main__":
+    main()
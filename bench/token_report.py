@@ -0,0 +1,123 @@
+# bench/token_report.py
+# Token distribution of stored contracts (analyses.original_content, or the extracted_texts row it
+# references), for tuning SINGLE_PASS_TOKENS / CHUNK_TOKENS / MAX_CHUNK_TOKENS.
+#
+# Uses the same tokenizer and the same single-pass / chunking decision as the server, with the
+# budgets from the environment, so "what if" runs are just env overrides:
+#   python -m bench.token_report
+#   python -m bench.token_report --db /srv/contract_ai.db --type lease
+#   SINGLE_PASS_TOKENS=60000 CHUNK_TOKENS=24000 python -m bench.token_report
+
+import argparse
+import os
+from collections import Counter
+from typing import Dict, List
+
+
+def _pct(vals: List[float], p: float) -> float:
+    if not vals:
+        return 0.0
+    vals = sorted(vals)
+    return vals[min(len(vals) - 1, int(p * len(vals)))]
+
+
+def _dist(label: str, vals: List[float], fmt: str = "8.0f"):
+    if not vals:
+        return
+    print(
+        f"  {label:<15}: p50 {_pct(vals, 0.5):{fmt}}  p90 {_pct(vals, 0.9):{fmt}}  "
+        f"p99 {_pct(vals, 0.99):{fmt}}  max {max(vals):{fmt}}"
+    )
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--db", help="SQLite file (default: CONTRACT_AI_DB or the app's contract_ai.db)")
+    ap.add_argument("--type", help="only this contract_type")
+    ap.add_argument("--limit", type=int, default=0, help="newest N analyses only")
+    args = ap.parse_args()
+
+    if args.db:
+        os.environ["CONTRACT_AI_DB"] = os.path.abspath(args.db)
+
+    import main as app_main
+    from fastapi import HTTPException
+    from engine.tokens import count_tokens, estimate_tokens, tokenizer_name
+
+    db = app_main.SessionLocal()
+    try:
+        q = db.query(
+            app_main.Analysis.contract_type,
+            app_main.Analysis.identity,
+            app_main.Analysis.original_content,
+            app_main.ExtractedText.text,
+        ).outerjoin(
+            app_main.ExtractedText, app_main.ExtractedText.id == app_main.Analysis.extracted_text_id,
+        ).order_by(app_main.Analysis.id.desc())
+        if args.type:
+            q = q.filter(app_main.Analysis.contract_type == args.type)
+        if args.limit:
+            q = q.limit(args.limit)
+        rows = q.all()
+    finally:
+        db.close()
+
+    chars: List[float] = []
+    tokens: List[float] = []
+    per_char: List[float] = []
+    est_error: List[float] = []
+    prompt_tokens: List[float] = []
+    chunk_counts: Counter = Counter()
+    by_type: Dict[str, List[int]] = {}
+    near_limit = 0
+    too_long = 0
+
+    for t, identity, content, extracted in rows:
+        text = (content or extracted or "").strip()
+        if not text:
+            continue
+        n = count_tokens(text)
+        overhead = app_main._prompt_overhead_tokens(t, identity)
+        chars.append(len(text))
+        tokens.append(n)
+        per_char.append(n / len(text))
+        est_error.append((estimate_tokens(text) - n) / n if n else 0.0)
+        prompt_tokens.append(overhead + n)
+        by_type.setdefault(t, []).append(n)
+
+        if app_main._fits_single_pass(n, t, identity):
+            chunk_counts[1] += 1
+            if overhead + n > 0.9 * app_main.SINGLE_PASS_TOKENS:
+                near_limit += 1
+            continue
+        try:
+            chunk_counts[len(app_main._split_for_analysis(text, t, identity, n))] += 1
+        except HTTPException:
+            too_long += 1
+
+    total = len(tokens)
+    print(
+        f"analyses={total} tokenizer={tokenizer_name()} db={app_main.DB_PATH}\n"
+        f"budgets: SINGLE_PASS_TOKENS={app_main.SINGLE_PASS_TOKENS} CHUNK_TOKENS={app_main.CHUNK_TOKENS} "
+        f"MAX_CHUNK_TOKENS={app_main.MAX_CHUNK_TOKENS} MAX_CHUNKS={app_main.MAX_CHUNKS}"
+    )
+    if not total:
+        return
+    _dist("chars", chars)
+    _dist("tokens", tokens)
+    _dist("tokens/char", per_char, "8.2f")
+    _dist("prompt tokens", prompt_tokens)
+    _dist("estimate error", est_error, "+8.1%")
+    single = chunk_counts.pop(1, 0)
+    print(f"  single pass    : {single}/{total} ({single / total:.0%}), {near_limit} within 10% of the limit")
+    if chunk_counts:
+        print("  chunked        : " + "  ".join(f"{k} chunks x{v}" for k, v in sorted(chunk_counts.items())))
+    if too_long:
+        print(f"  rejected (413) : {too_long}")
+    print("  by type        :")
+    for t, vals in sorted(by_type.items(), key=lambda kv: -len(kv[1])):
+        print(f"    {t:<13} n={len(vals):<5} p50 {_pct(vals, 0.5):8.0f}  p90 {_pct(vals, 0.9):8.0f}  max {max(vals):8.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+# engine/blobstore.py
+# Content-addressed file store: <root>/<sha[:2]>/<sha[2:4]>/<sha>, one file per distinct content.
+#
+# Only the bytes live here; who references a blob (and how many times) is the caller's business
+# (main.py keeps a refcount per sha in the blobs table). Writes go to a temp file in the same
+# directory and are renamed into place, so a reader never sees a partial blob. lock(sha) gives
+# the caller a per-sha critical section for "write + add reference" vs "drop reference + unlink".
+# Shard directories left empty by remove() are pruned (best effort).
+
+import contextlib
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from typing import Iterable, Iterator, Tuple
+
+_SHA_CHARS = set("0123456789abcdef")
+
+
+class BlobStore:
+    def __init__(self, root: str, lock_stripes: int = 64):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self._locks = [threading.Lock() for _ in range(max(1, lock_stripes))]
+
+    @staticmethod
+    def _check(sha: str):
+        if len(sha) != 64 or not set(sha) <= _SHA_CHARS:
+            raise ValueError(f"not a sha256 hex digest: {sha!r}")
+
+    def path(self, sha: str) -> str:
+        self._check(sha)
+        return os.path.join(self.root, sha[:2], sha[2:4], sha)
+
+    def lock(self, sha: str) -> threading.Lock:
+        return self._locks[int(sha[:8], 16) % len(self._locks)]
+
+    @contextlib.contextmanager
+    def lock_many(self, shas: Iterable[str]) -> Iterator[None]:
+        # 每个条带只锁一次，按固定顺序加锁，避免两个批量删除互相等待
+        stripes = sorted({int(sha[:8], 16) % len(self._locks) for sha in shas if sha})
+        with contextlib.ExitStack() as stack:
+            for i in stripes:
+                stack.enter_context(self._locks[i])
+            yield
+
+    def exists(self, sha: str) -> bool:
+        return os.path.isfile(self.path(sha))
+
+    def size(self, sha: str) -> int:
+        return os.path.getsize(self.path(sha))
+
+    def put(self, data: bytes, sha: str = "") -> Tuple[str, int]:
+        """
+        Store data (no-op if the same content is already there). Returns (sha256, size).
+        """
+        sha = sha or hashlib.sha256(data).hexdigest()
+        path = self.path(sha)
+        if os.path.isfile(path) and os.path.getsize(path) == len(data):
+            return sha, len(data)
+        fd, tmp = self._mkstemp(os.path.dirname(path))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, path)
+        except BaseException:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+        return sha, len(data)
+
+    @staticmethod
+    def _mkstemp(d: str):
+        # remove() 可能正好把这个（空的）分片目录删掉：重建一次即可，目录里有临时文件后就删不掉了
+        for attempt in (0, 1):
+            os.makedirs(d, exist_ok=True)
+            try:
+                return tempfile.mkstemp(dir=d, prefix=".tmp-")
+            except FileNotFoundError:
+                if attempt:
+                    raise
+
+    def read(self, sha: str) -> bytes:
+        with open(self.path(sha), "rb") as f:
+            return f.read()
+
+    def remove(self, sha: str) -> bool:
+        path = self.path(sha)
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            return False
+        self._prune(os.path.dirname(path))
+        return True
+
+    def _prune(self, d: str):
+        # 尽力删掉变空的分片目录（sha[2:4] 再 sha[:2]），不为空 / 已被删 / 无权限都直接放弃
+        root = os.path.abspath(self.root)
+        d = os.path.abspath(d)
+        while d != root and os.path.dirname(d) != d:
+            try:
+                os.rmdir(d)
+            except OSError:
+                return
+            d = os.path.dirname(d)
+
+    def iter_blobs(self, min_age_seconds: float = 0.0) -> Iterator[Tuple[str, int]]:
+        """
+        (sha, size) of every stored blob; temp files are skipped, and so are blobs written
+        within min_age_seconds (their reference may not be committed yet).
+        """
+        cutoff = time.time() - min_age_seconds
+        for dirpath, _, files in os.walk(self.root):
+            for name in files:
+                if len(name) != 64 or not set(name) <= _SHA_CHARS:
+                    continue
+                st = os.stat(os.path.join(dirpath, name))
+                if st.st_mtime <= cutoff:
+                    yield name, st.st_size
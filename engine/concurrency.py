@@ -0,0 +1,128 @@
+# engine/concurrency.py
+# Bounded, order-preserving fan-out for blocking calls (LLM / OCR round-trips), and a
+# thread -> event loop handoff for streaming their output.
+
+import asyncio
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Any, Callable, Deque, Dict, List, Optional, Sequence, Tuple
+
+_POLL_SECONDS = 0.1
+
+
+class TaskTimeoutError(Exception):
+    """
+    Raised when a single task runs longer than its per-item timeout.
+    index is 0-based (position in the input sequence).
+    """
+
+    def __init__(self, index: int, timeout: float):
+        super().__init__(f"task {index} timed out after {timeout:.0f}s")
+        self.index = index
+        self.timeout = timeout
+
+
+def run_ordered(
+    fn: Callable[[Any], Any],
+    items: Sequence[Any],
+    *,
+    max_workers: int,
+    item_timeout: Optional[float] = None,
+    thread_name_prefix: str = "fanout",
+) -> List[Any]:
+    """
+    Run fn(item) for every item with at most max_workers in flight.
+    Results come back in input order regardless of completion order.
+
+    - item_timeout counts from the moment an item actually starts running,
+      so queued items are never charged for time spent waiting for a worker.
+    - The first exception (or timeout) is raised immediately; queued items are
+      cancelled and running ones are abandoned (threads cannot be killed, so
+      callers should also pass a client-side timeout to the blocking call).
+    """
+    items = list(items)
+    if not items:
+        return []
+
+    workers = max(1, min(int(max_workers or 1), len(items)))
+    started: Dict[int, float] = {}
+
+    def _run(i: int, item: Any) -> Any:
+        started[i] = time.monotonic()
+        return fn(item)
+
+    ex = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=thread_name_prefix)
+    try:
+        futures = {ex.submit(_run, i, item): i for i, item in enumerate(items)}
+        results: List[Any] = [None] * len(items)
+        pending = set(futures)
+
+        while pending:
+            done, pending = wait(pending, timeout=_POLL_SECONDS, return_when=FIRST_COMPLETED)
+            for f in done:
+                results[futures[f]] = f.result()
+
+            if item_timeout:
+                now = time.monotonic()
+                for f in pending:
+                    i = futures[f]
+                    t0 = started.get(i)
+                    if t0 is not None and now - t0 > item_timeout:
+                        raise TaskTimeoutError(i, item_timeout)
+
+        return results
+    finally:
+        ex.shutdown(wait=False, cancel_futures=True)
+
+
+def _wake(fut: "asyncio.Future"):
+    if not fut.done():
+        fut.set_result(None)
+
+
+class AsyncHandoff:
+    """
+    Items produced by worker threads, consumed by one coroutine on the event loop.
+    put() never blocks; get() awaits without holding a threadpool worker (a blocking
+    queue.get() in a sync generator would park one of the server's threads per client).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._items: Deque[Any] = deque()
+        self._waiter: Optional[Tuple[asyncio.AbstractEventLoop, "asyncio.Future"]] = None
+
+    def put(self, item: Any):
+        with self._lock:
+            self._items.append(item)
+            waiter, self._waiter = self._waiter, None
+        if waiter:
+            loop, fut = waiter
+            try:
+                loop.call_soon_threadsafe(_wake, fut)
+            except RuntimeError:  # loop already closed (server shutting down)
+                pass
+
+    async def get(self, timeout: float) -> Any:
+        """
+        Next item, or queue.Empty after timeout seconds without one.
+        """
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._items:
+                return self._items.popleft()
+            fut = loop.create_future()
+            self._waiter = (loop, fut)
+        try:
+            await asyncio.wait_for(fut, timeout)
+        except asyncio.TimeoutError:
+            pass
+        with self._lock:
+            if self._waiter and self._waiter[1] is fut:
+                self._waiter = None
+            if self._items:
+                return self._items.popleft()
+        raise queue.Empty
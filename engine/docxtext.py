@@ -0,0 +1,304 @@
+# engine/docxtext.py
+# DOCX text straight from the zip: word/document.xml is parsed incrementally (iterparse) and each
+# top-level paragraph / table is emitted in body order, then dropped from memory.
+#
+# Compared with python-docx (all paragraphs first, then all tables, whole tree in memory):
+# - body order is kept, so a table between 第五条 and 第六条 stays there;
+# - merged cells are emitted once (gridSpan is one <w:tc>; vMerge continuations are skipped);
+# - automatic numbering is rendered from numbering.xml (直接编号 or via the paragraph style),
+#   so "第%1条" / "%1.%2" / "（%1）" labels that Word draws survive as text;
+# - text boxes are read once (mc:Fallback repeats the mc:Choice content).
+
+import io
+import re
+import zipfile
+import xml.etree.ElementTree as ET
+from typing import Dict, Iterator, List, Optional, Tuple
+
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+_MC_FALLBACK = "{http://schemas.openxmlformats.org/markup-compatibility/2006}Fallback"
+
+_CN_DIGITS = "零一二三四五六七八九"
+_CN_UNITS = ["", "十", "百", "千"]
+_TIANGAN = "甲乙丙丁戊己庚辛壬癸"
+_DIZHI = "子丑寅卯辰巳午未申酉戌亥"
+_CIRCLED = "①②③④⑤⑥⑦⑧⑨⑩⑪⑫⑬⑭⑮⑯⑰⑱⑲⑳"
+_LVL_REF_RE = re.compile(r"%([1-9])")
+
+
+def _cn_number(n: int) -> str:
+    if n <= 0 or n >= 100000000:
+        return str(n)
+    if n >= 10000:
+        high, low = divmod(n, 10000)
+        if not low:
+            return _cn_number(high) + "万"
+        return _cn_number(high) + "万" + ("零" if low < 1000 else "") + _cn_number(low)
+    digits = [int(d) for d in str(n)]
+    out = ""
+    zero = False
+    for pos, d in enumerate(digits):
+        unit = _CN_UNITS[len(digits) - pos - 1]
+        if d == 0:
+            zero = True
+            continue
+        if zero and out:
+            out += "零"
+        zero = False
+        out += _CN_DIGITS[d] + unit
+    # 一十二 -> 十二
+    return out[1:] if out.startswith("一十") else out
+
+
+def _letters(n: int) -> str:
+    # Word: a..z, aa..zz, aaa..
+    if n <= 0:
+        return str(n)
+    return chr(ord("a") + (n - 1) % 26) * ((n - 1) // 26 + 1)
+
+
+def _roman(n: int) -> str:
+    if n <= 0 or n >= 4000:
+        return str(n)
+    out = ""
+    for value, sym in ((1000, "m"), (900, "cm"), (500, "d"), (400, "cd"), (100, "c"), (90, "xc"),
+                       (50, "l"), (40, "xl"), (10, "x"), (9, "ix"), (5, "v"), (4, "iv"), (1, "i")):
+        while n >= value:
+            out += sym
+            n -= value
+    return out
+
+
+def format_number(n: int, fmt: str) -> str:
+    if fmt in ("chineseCounting", "chineseCountingThousand", "chineseLegalSimplified",
+               "japaneseCounting", "taiwaneseCounting", "ideographDigital"):
+        return _cn_number(n)
+    if fmt == "ideographTraditional":
+        return _TIANGAN[(n - 1) % 10] if n > 0 else str(n)
+    if fmt == "ideographZodiac":
+        return _DIZHI[(n - 1) % 12] if n > 0 else str(n)
+    if fmt == "lowerLetter":
+        return _letters(n)
+    if fmt == "upperLetter":
+        return _letters(n).upper()
+    if fmt == "lowerRoman":
+        return _roman(n)
+    if fmt == "upperRoman":
+        return _roman(n).upper()
+    if fmt == "decimalZero":
+        return f"{n:02d}"
+    if fmt == "decimalEnclosedCircle" or fmt == "decimalEnclosedCircleChinese":
+        return _CIRCLED[n - 1] if 0 < n <= len(_CIRCLED) else str(n)
+    if fmt in ("none", "bullet"):
+        return ""
+    return str(n)
+
+
+class _Numbering:
+    """
+    numbering.xml + paragraph styles -> list labels. Counters are kept per numId; a level
+    restarts when a shallower level of the same list advances.
+    """
+
+    def __init__(self, numbering_xml: Optional[bytes], styles_xml: Optional[bytes]):
+        # abstractNumId -> ilvl -> (start, numFmt, lvlText)
+        self.abstract: Dict[str, Dict[int, Tuple[int, str, str]]] = {}
+        # numId -> (abstractNumId, {ilvl: startOverride})
+        self.nums: Dict[str, Tuple[str, Dict[int, int]]] = {}
+        # styleId -> (numId, ilvl)
+        self.styles: Dict[str, Tuple[str, int]] = {}
+        self.counters: Dict[str, Dict[int, int]] = {}
+        if numbering_xml:
+            self._load_numbering(ET.fromstring(numbering_xml))
+        if styles_xml:
+            self._load_styles(ET.fromstring(styles_xml))
+
+    @staticmethod
+    def _levels(parent) -> Dict[int, Tuple[int, str, str]]:
+        levels = {}
+        for lvl in parent.iter(f"{_W}lvl"):
+            ilvl = int(lvl.get(f"{_W}ilvl", "0"))
+            start = lvl.find(f"{_W}start")
+            fmt = lvl.find(f"{_W}numFmt")
+            text = lvl.find(f"{_W}lvlText")
+            levels[ilvl] = (
+                int(start.get(f"{_W}val", "1")) if start is not None else 1,
+                fmt.get(f"{_W}val", "decimal") if fmt is not None else "decimal",
+                text.get(f"{_W}val", "") if text is not None else "",
+            )
+        return levels
+
+    def _load_numbering(self, root):
+        for an in root.findall(f"{_W}abstractNum"):
+            self.abstract[an.get(f"{_W}abstractNumId")] = self._levels(an)
+        for num in root.findall(f"{_W}num"):
+            ref = num.find(f"{_W}abstractNumId")
+            if ref is None:
+                continue
+            overrides = {}
+            for ov in num.findall(f"{_W}lvlOverride"):
+                so = ov.find(f"{_W}startOverride")
+                if so is not None:
+                    overrides[int(ov.get(f"{_W}ilvl", "0"))] = int(so.get(f"{_W}val", "1"))
+            self.nums[num.get(f"{_W}numId")] = (ref.get(f"{_W}val"), overrides)
+
+    def _load_styles(self, root):
+        based_on: Dict[str, str] = {}
+        for st in root.findall(f"{_W}style"):
+            sid = st.get(f"{_W}styleId")
+            b = st.find(f"{_W}basedOn")
+            if b is not None:
+                based_on[sid] = b.get(f"{_W}val")
+            num_pr = st.find(f"{_W}pPr/{_W}numPr")
+            if num_pr is not None:
+                num_id = num_pr.find(f"{_W}numId")
+                ilvl = num_pr.find(f"{_W}ilvl")
+                if num_id is not None:
+                    self.styles[sid] = (num_id.get(f"{_W}val"), int(ilvl.get(f"{_W}val", "0")) if ilvl is not None else 0)
+        # numbering inherited through basedOn (a few levels is plenty)
+        for sid in list(based_on):
+            cur, hops = sid, 0
+            while cur not in self.styles and cur in based_on and hops < 5:
+                cur, hops = based_on[cur], hops + 1
+            if cur in self.styles and sid not in self.styles:
+                self.styles[sid] = self.styles[cur]
+
+    def label(self, p) -> str:
+        ppr = p.find(f"{_W}pPr")
+        if ppr is None:
+            return ""
+        num_id, ilvl = None, 0
+        style = ppr.find(f"{_W}pStyle")
+        if style is not None and style.get(f"{_W}val") in self.styles:
+            num_id, ilvl = self.styles[style.get(f"{_W}val")]
+        num_pr = ppr.find(f"{_W}numPr")
+        if num_pr is not None:
+            n = num_pr.find(f"{_W}numId")
+            lv = num_pr.find(f"{_W}ilvl")
+            if n is not None:
+                num_id = n.get(f"{_W}val")
+            if lv is not None:
+                ilvl = int(lv.get(f"{_W}val", "0"))
+        if not num_id or num_id == "0" or num_id not in self.nums:
+            return ""
+        abstract_id, overrides = self.nums[num_id]
+        levels = self.abstract.get(abstract_id, {})
+        if ilvl not in levels:
+            return ""
+
+        counters = self.counters.setdefault(num_id, {})
+        start = overrides.get(ilvl, levels[ilvl][0])
+        counters[ilvl] = counters.get(ilvl, start - 1) + 1
+        for deeper in [k for k in counters if k > ilvl]:
+            del counters[deeper]
+
+        _, fmt, text = levels[ilvl]
+        if fmt == "bullet" or not text:
+            return ""
+
+        def sub(m) -> str:
+            k = int(m.group(1)) - 1
+            if k not in levels:
+                return ""
+            value = counters.get(k, overrides.get(k, levels[k][0]))
+            return format_number(value, levels[k][1])
+
+        return _LVL_REF_RE.sub(sub, text).strip()
+
+
+def _run_text(node, out: List[str]):
+    for child in node:
+        tag = child.tag
+        if tag == _MC_FALLBACK:
+            continue  # same content as mc:Choice
+        if tag == f"{_W}t":
+            out.append(child.text or "")
+        elif tag == f"{_W}tab":
+            out.append("\t")
+        elif tag in (f"{_W}br", f"{_W}cr"):
+            out.append("\n")
+        elif tag == f"{_W}noBreakHyphen":
+            out.append("-")
+        elif tag in (f"{_W}del", f"{_W}delText", f"{_W}instrText", f"{_W}pPr", f"{_W}rPr"):
+            continue
+        else:
+            _run_text(child, out)
+
+
+def _paragraph(p, numbering: _Numbering) -> str:
+    parts: List[str] = []
+    _run_text(p, parts)
+    text = "".join(parts).strip()
+    label = numbering.label(p)
+    if label and text:
+        return f"{label} {text}"
+    return text or label
+
+
+def _cell_text(tc, numbering: _Numbering) -> str:
+    parts = []
+    for child in tc:
+        if child.tag == f"{_W}p":
+            t = _paragraph(child, numbering)
+        elif child.tag == f"{_W}tbl":
+            t = " / ".join(_direct_rows(child, numbering))
+        else:
+            continue
+        if t:
+            parts.append(t)
+    return " ".join(parts)
+
+
+def _block(elem, numbering: _Numbering) -> Iterator[str]:
+    if elem.tag == f"{_W}p":
+        t = _paragraph(elem, numbering)
+        if t:
+            yield t
+    elif elem.tag == f"{_W}tbl":
+        yield from _direct_rows(elem, numbering)
+    elif elem.tag == f"{_W}sdt":
+        content = elem.find(f"{_W}sdtContent")
+        if content is not None:
+            for child in content:
+                yield from _block(child, numbering)
+
+
+def _direct_rows(tbl, numbering: _Numbering) -> Iterator[str]:
+    # only this table's rows; nested tables are rendered inside their cell
+    for tr in tbl.findall(f"{_W}tr"):
+        cells = []
+        for tc in tr.findall(f"{_W}tc"):
+            vmerge = tc.find(f"{_W}tcPr/{_W}vMerge")
+            if vmerge is not None and vmerge.get(f"{_W}val", "continue") == "continue":
+                continue  # 纵向合并的下半部分：文字在上面那一格
+            t = _cell_text(tc, numbering)
+            if t:
+                cells.append(t)
+        if cells:
+            yield " | ".join(cells)
+
+
+def iter_docx_blocks(docx_bytes: bytes) -> Iterator[str]:
+    """
+    Text of every paragraph / table row in document order (empty ones skipped).
+    """
+    with zipfile.ZipFile(io.BytesIO(docx_bytes)) as z:
+        names = set(z.namelist())
+        numbering = _Numbering(
+            z.read("word/numbering.xml") if "word/numbering.xml" in names else None,
+            z.read("word/styles.xml") if "word/styles.xml" in names else None,
+        )
+        with z.open("word/document.xml") as f:
+            depth = 0
+            body = None
+            for event, elem in ET.iterparse(f, events=("start", "end")):
+                if event == "start":
+                    depth += 1
+                    if depth == 2 and elem.tag == f"{_W}body":
+                        body = elem
+                    continue
+                depth -= 1
+                if depth == 2 and body is not None:
+                    # a whole top-level block has been read: emit it and drop it
+                    yield from _block(elem, numbering)
+                    body.remove(elem)
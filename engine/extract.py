@@ -0,0 +1,240 @@
+# engine/extract.py
+# Document parsing (PDF / DOCX) out of the request thread, in bounded worker processes.
+#
+# - iter_pdf_pages / iter_docx_blocks: pure generators, importable by worker processes.
+#   PDF pages come out one by one (text-layer pages with their text, image-only pages
+#   rendered to PNG for OCR), so the caller can start on page 1 before page 300 is parsed;
+#   DOCX paragraphs / table rows in body order (engine/docxtext.py).
+# - ExtractionPool.stream(target, ...): runs such a generator in a separate process and
+#   yields its items as they are produced. One process per job (forked from a forkserver
+#   that has fitz preloaded, ~ms to start) rather than a long-lived pool: a stuck parse
+#   can then be killed at its deadline, and RLIMIT_AS caps the memory of that one job.
+#   At most max_workers jobs run at once; further callers wait for a slot.
+
+import multiprocessing
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Iterator, Optional
+
+import fitz  # pymupdf
+
+from .docxtext import iter_docx_blocks
+
+try:
+    import resource
+except ImportError:  # pragma: no cover - not on Windows
+    resource = None
+
+
+class ExtractionError(Exception):
+    """
+    Parsing failed in the worker (corrupt / encrypted / unsupported file).
+    """
+
+
+class ExtractionTimeout(ExtractionError):
+    def __init__(self, timeout: float):
+        super().__init__(f"extraction exceeded {timeout:g}s")
+        self.timeout = timeout
+
+
+class ExtractionMemoryError(ExtractionError):
+    pass
+
+
+@dataclass
+class PdfPage:
+    index: int               # 0-based
+    total: int               # page count of the document
+    kind: str                # text | ocr | blank | skipped
+    text: str = ""
+    png: Optional[bytes] = None   # rendered page, kind == "ocr" only
+
+
+def _classify_pdf_page(page, min_chars: int, image_min_coverage: float, scan_coverage: float):
+    """
+    (kind, text): "text" (usable text layer), "ocr" (scanned / image-only page) or "blank".
+    A page covered by a scan keeps its text layer only if that layer is substantial
+    (scanners often add just a header or a stamp as text).
+    """
+    text = page.get_text("text").strip()
+    area = abs(page.rect) or 1.0
+    covered = 0.0
+    for info in page.get_image_info():
+        covered += abs(fitz.Rect(info["bbox"]) & page.rect)
+    coverage = min(1.0, covered / area)
+
+    if len(text) >= min_chars and (coverage < scan_coverage or len(text) >= 200):
+        return "text", text
+    if coverage >= image_min_coverage:
+        return "ocr", text
+    return ("text", text) if text else ("blank", "")
+
+
+def iter_pdf_pages(
+    pdf_bytes: bytes,
+    *,
+    max_pages: int = 300,
+    max_ocr_pages: int = 50,
+    min_chars: int = 30,
+    image_min_coverage: float = 0.05,
+    scan_coverage: float = 0.6,
+    dpi: int = 150,
+) -> Iterator[PdfPage]:
+    """
+    One PdfPage per page, in order. Pages past max_pages, and image-only pages past
+    max_ocr_pages, come out as kind="skipped".
+    """
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    try:
+        total = doc.page_count
+        ocr_count = 0
+        for i in range(total):
+            if i >= max_pages:
+                yield PdfPage(i, total, "skipped")
+                continue
+            page = doc.load_page(i)
+            kind, text = _classify_pdf_page(page, min_chars, image_min_coverage, scan_coverage)
+            if kind != "ocr":
+                yield PdfPage(i, total, kind, text)
+                continue
+            if ocr_count >= max_ocr_pages:
+                yield PdfPage(i, total, "skipped")
+                continue
+            ocr_count += 1
+            png = page.get_pixmap(dpi=dpi, colorspace=fitz.csGRAY).tobytes("png")
+            yield PdfPage(i, total, "ocr", text, png)
+    finally:
+        doc.close()
+
+
+# ---- worker processes ----
+
+_END = "end"
+_ITEM = "item"
+_ERROR = "error"
+
+
+def _limit_memory(memory_mb: int):
+    if resource is None or memory_mb <= 0:
+        return
+    limit = memory_mb * 1024 * 1024
+    soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (limit, hard))
+
+
+def _unlimit_memory():
+    # 报错前先放开限制，否则连错误消息都发不出去
+    if resource is not None:
+        soft, hard = resource.getrlimit(resource.RLIMIT_AS)
+        resource.setrlimit(resource.RLIMIT_AS, (hard, hard))
+
+
+def _worker_main(conn, target: Callable[..., Iterator[Any]], args, kwargs, memory_mb: int):
+    try:
+        _limit_memory(memory_mb)
+        for item in target(*args, **kwargs):
+            conn.send((_ITEM, item))
+        conn.send((_END, None))
+    except Exception as e:  # 只把异常类型和消息传回（异常对象未必可序列化）
+        _unlimit_memory()
+        # MuPDF reports allocation failures as its own error type ("malloc (...) failed")
+        if isinstance(e, MemoryError) or "malloc" in str(e):
+            conn.send((_ERROR, "memory", f"exceeded {memory_mb}MB"))
+        else:
+            conn.send((_ERROR, type(e).__name__, str(e)))
+    finally:
+        conn.close()
+
+
+def _context():
+    methods = multiprocessing.get_all_start_methods()
+    if "forkserver" in methods:
+        ctx = multiprocessing.get_context("forkserver")
+        ctx.set_forkserver_preload([__name__])
+        return ctx
+    return multiprocessing.get_context("spawn")
+
+
+class ExtractionPool:
+    def __init__(self, max_workers: int = 2, timeout: float = 60.0, memory_mb: int = 1024):
+        """
+        max_workers <= 0 runs every job inline in the calling thread (no process, no limits).
+        """
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.memory_mb = memory_mb
+        self._slots = threading.BoundedSemaphore(max(1, max_workers))
+        self._ctx = None
+        self._ctx_lock = threading.Lock()
+
+    def _get_context(self):
+        with self._ctx_lock:
+            if self._ctx is None:
+                self._ctx = _context()
+            return self._ctx
+
+    def stream(self, target: Callable[..., Iterator[Any]], *args: Any, **kwargs: Any) -> Iterator[Any]:
+        """
+        Items of target(*args, **kwargs), produced in a worker process. The time limit covers
+        only time spent waiting on the worker (waiting for a slot, and whatever the caller does
+        between items, e.g. OCR of earlier pages, excluded). Raises ExtractionTimeout /
+        ExtractionMemoryError / ExtractionError; the worker is killed if the caller stops early.
+        """
+        if self.max_workers <= 0:
+            try:
+                yield from target(*args, **kwargs)
+            except MemoryError as e:
+                raise ExtractionMemoryError(str(e))
+            except ExtractionError:
+                raise
+            except Exception as e:
+                raise ExtractionError(f"{type(e).__name__}: {e}")
+            return
+
+        with self._slots:
+            ctx = self._get_context()
+            recv, send = ctx.Pipe(duplex=False)
+            proc = ctx.Process(
+                target=_worker_main,
+                args=(send, target, args, kwargs, self.memory_mb),
+                daemon=True,
+            )
+            proc.start()
+            send.close()
+            # 只累计等子进程的时间：调用方在两项之间做的事（前几页的 OCR / 分块分析）不算
+            waited = 0.0
+            try:
+                while True:
+                    if self.timeout:
+                        t0 = time.monotonic()
+                        ready = waited < self.timeout and recv.poll(self.timeout - waited)
+                        waited += time.monotonic() - t0
+                        if not ready:
+                            raise ExtractionTimeout(self.timeout)
+                    try:
+                        tag, *payload = recv.recv()
+                    except EOFError:
+                        # 子进程没说再见就退出了（被 OOM killer / 段错误干掉）
+                        proc.join(1)
+                        raise ExtractionError(f"extraction worker died (exit code {proc.exitcode})")
+                    if tag == _ITEM:
+                        yield payload[0]
+                    elif tag == _END:
+                        return
+                    else:
+                        kind, message = payload
+                        if kind == "memory":
+                            raise ExtractionMemoryError(message)
+                        raise ExtractionError(f"{kind}: {message}")
+            finally:
+                recv.close()
+                if proc.is_alive():
+                    proc.terminate()
+                proc.join(5)
+                if proc.is_alive():  # pragma: no cover
+                    proc.kill()
+                    proc.join()
@@ -0,0 +1,103 @@
+# engine/filerange.py
+# HTTP helpers for serving stored files: single byte-range parsing (RFC 9110 §14), conditional
+# request checks, and a chunked reader over an already-open file.
+
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import BinaryIO, Iterator, Optional, Tuple
+
+
+class RangeNotSatisfiable(ValueError):
+    pass
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """
+    "bytes=a-b" / "bytes=a-" / "bytes=-n" -> inclusive (start, end). None means "send the whole
+    file" (no header, another unit, a malformed value, or several ranges — all of which a server
+    may ignore). Raises RangeNotSatisfiable when the range lies entirely past the end; an empty
+    file has no satisfiable range at all.
+    """
+    if not header:
+        return None
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, sep, last = spec.strip().partition("-")
+    if not sep:
+        return None
+    try:
+        if not first:
+            # suffix: the last n bytes
+            n = int(last)
+        else:
+            start = int(first)
+            end = int(last) if last else None
+    except ValueError:
+        return None
+    if not first:
+        if n <= 0 or size == 0:
+            raise RangeNotSatisfiable(header)
+        return max(0, size - n), size - 1
+    if start < 0 or (end is not None and end < start):
+        return None
+    if start >= size:
+        raise RangeNotSatisfiable(header)
+    return start, size - 1 if end is None else min(end, size - 1)
+
+
+def http_date(dt: datetime) -> str:
+    # naive datetimes are UTC (datetime.utcnow() everywhere in the models)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return format_datetime(dt.astimezone(timezone.utc).replace(microsecond=0), usegmt=True)
+
+
+def etag_matches(header: Optional[str], etag: str, weak: bool = True) -> bool:
+    """
+    If-None-Match uses weak comparison (W/"x" matches "x"); If-Range needs strong comparison.
+    """
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    for tag in header.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            if not weak:
+                continue
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+
+def not_modified_since(header: Optional[str], last_modified: datetime) -> bool:
+    if not header:
+        return False
+    try:
+        since = parsedate_to_datetime(header)
+    except (TypeError, ValueError):
+        return False
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=timezone.utc)
+    if last_modified.tzinfo is None:
+        last_modified = last_modified.replace(tzinfo=timezone.utc)
+    return last_modified.replace(microsecond=0) <= since
+
+
+def iter_file(f: BinaryIO, start: int, length: int, chunk_size: int = 256 * 1024) -> Iterator[bytes]:
+    """
+    length bytes of f from start, chunk by chunk; closes f when done (or when the client goes away).
+    """
+    try:
+        f.seek(start)
+        remaining = length
+        while remaining > 0:
+            data = f.read(min(chunk_size, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+    finally:
+        f.close()
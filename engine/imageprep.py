@@ -0,0 +1,191 @@
+# engine/imageprep.py
+# Image normalization before vision OCR.
+#
+# EXIF auto-rotate -> grayscale -> downsample to a target long side -> JPEG/WebP recompress,
+# plus a page signature (dHash + thumbnail) to drop duplicate pages (the same page uploaded twice).
+# Dropping a real page loses contract text, so a dHash match must also survive a pixel check.
+# Pillow is optional: without it images pass through untouched and nothing is deduplicated.
+# Whether it is active is exported as the "imageprep.available" gauge (engine.metrics), and every
+# image sent through unchanged for lack of it counts in "imageprep.passthrough".
+
+import io
+import math
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+from .metrics import metrics
+
+try:
+    from PIL import Image, ImageChops, ImageOps
+except ImportError:  # pragma: no cover - optional dependency
+    Image = None
+    ImageChops = None
+    ImageOps = None
+
+metrics.set("imageprep.available", int(Image is not None))
+
+_FORMATS = {"jpeg": ("JPEG", "image/jpeg"), "webp": ("WEBP", "image/webp")}
+
+
+def available() -> bool:
+    return Image is not None
+
+
+def vision_tokens(width: int, height: int) -> int:
+    """
+    Input tokens of one image at detail=high: fit in 2048x2048, shortest side to 768,
+    then 170 per 512px tile + 85 base.
+    """
+    if width <= 0 or height <= 0:
+        return 0
+    scale = min(1.0, 2048 / max(width, height))
+    w, h = width * scale, height * scale
+    scale = min(1.0, 768 / min(w, h))
+    w, h = w * scale, h * scale
+    return 85 + 170 * math.ceil(w / 512) * math.ceil(h / 512)
+
+
+@dataclass
+class PreparedImage:
+    data: bytes
+    mime: str
+    size_in: Tuple[int, int] = (0, 0)
+    size_out: Tuple[int, int] = (0, 0)
+    bytes_in: int = 0
+
+    @property
+    def tokens_in(self) -> int:
+        return vision_tokens(*self.size_in)
+
+    @property
+    def tokens_out(self) -> int:
+        return vision_tokens(*self.size_out)
+
+
+def dhash(img, size: int = 16) -> int:
+    """
+    Difference hash: (size+1) x size grayscale thumbnail, one bit per horizontal gradient.
+    16 (256 bits) rather than the usual 8: text pages share a layout, so small hashes collide.
+    """
+    g = img.convert("L").resize((size + 1, size), Image.BILINEAR)
+    px = list(g.getdata())
+    bits = 0
+    for row in range(size):
+        for col in range(size):
+            left = px[row * (size + 1) + col]
+            right = px[row * (size + 1) + col + 1]
+            bits = (bits << 1) | (1 if left > right else 0)
+    return bits
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+def prepare_image(
+    data: bytes,
+    mime: str,
+    *,
+    max_side: int = 2000,
+    grayscale: bool = True,
+    fmt: str = "jpeg",
+    quality: int = 80,
+) -> PreparedImage:
+    """
+    Normalized copy of one image. Undecodable input (or no Pillow) is returned as is;
+    if recompression would not make an unrotated image smaller, the original bytes are kept.
+    """
+    if Image is None:
+        metrics.inc("imageprep.passthrough")
+        return PreparedImage(data, mime, bytes_in=len(data))
+    try:
+        img = Image.open(io.BytesIO(data))
+        img.load()
+    except Exception:
+        return PreparedImage(data, mime, bytes_in=len(data))
+
+    size_in = img.size
+    turned = _has_orientation(img)
+    img = ImageOps.exif_transpose(img)
+    img = img.convert("L") if grayscale else img.convert("RGB")
+    if max_side and max(img.size) > max_side:
+        img.thumbnail((max_side, max_side), Image.LANCZOS)
+
+    pil_fmt, out_mime = _FORMATS.get(fmt.lower(), _FORMATS["jpeg"])
+    buf = io.BytesIO()
+    img.save(buf, format=pil_fmt, quality=quality, optimize=True)
+    out = buf.getvalue()
+    if len(out) >= len(data) and not turned and img.size == size_in:
+        return PreparedImage(data, mime, size_in, size_in, len(data))
+    return PreparedImage(out, out_mime, size_in, img.size, len(data))
+
+
+def _has_orientation(img) -> bool:
+    try:
+        return int(img.getexif().get(0x0112, 1)) not in (0, 1)
+    except Exception:
+        return False
+
+
+@dataclass
+class PageSignature:
+    dhash: int
+    thumb: object  # grayscale PIL image, long side _THUMB_SIDE
+
+
+_THUMB_SIDE = 384
+
+
+def page_signature(data: bytes, size: int = 16) -> Optional[PageSignature]:
+    """
+    dHash plus a small grayscale thumbnail, straight from encoded bytes (JPEG is decoded at
+    reduced scale via draft mode, so signing a whole batch is cheap). None if the image cannot
+    be decoded or Pillow is missing.
+    """
+    if Image is None:
+        return None
+    try:
+        img = Image.open(io.BytesIO(data))
+        img.draft("L", (_THUMB_SIDE, _THUMB_SIDE))
+        img = ImageOps.exif_transpose(img).convert("L")
+        img.thumbnail((_THUMB_SIDE, _THUMB_SIDE), Image.BILINEAR)
+        return PageSignature(dhash(img, size), img)
+    except Exception:
+        return None
+
+
+def changed_fraction(a, b, level: int = 32) -> float:
+    """
+    Share of thumbnail pixels that differ by more than `level` gray levels (1.0 if the sizes differ).
+    """
+    if a.size != b.size:
+        return 1.0
+    hist = ImageChops.difference(a, b).histogram()
+    return sum(hist[level:]) / max(1, sum(hist))
+
+
+def duplicate_positions(
+    signatures: List[Optional[PageSignature]],
+    max_distance: int = 4,
+    max_changed: float = 0.005,
+) -> List[int]:
+    """
+    Positions that duplicate an earlier kept page (first copy wins). The dHash only nominates
+    candidates: contract pages share a layout and distinct pages can sit ~10 bits apart, so a
+    candidate is confirmed only if (almost) no thumbnail pixel changed.
+    """
+    if max_distance < 0:
+        return []
+    kept: List[PageSignature] = []
+    dup: List[int] = []
+    for i, sig in enumerate(signatures):
+        if sig is None:
+            continue
+        if any(
+            hamming(sig.dhash, k.dhash) <= max_distance and changed_fraction(sig.thumb, k.thumb) <= max_changed
+            for k in kept
+        ):
+            dup.append(i)
+        else:
+            kept.append(sig)
+    return dup
@@ -0,0 +1,362 @@
+# engine/llm.py
+# Model provider layer: chat completion, streaming and vision OCR behind one interface.
+#
+#   openai : OpenAIProvider (client created on first use, so importing main needs no API key)
+#   fake   : FakeProvider   (in-process, deterministic output; latency / failures injected)
+#
+# FakeProvider returns schema-valid analysis JSON derived from the input text, so every
+# endpoint can be benchmarked and load-tested offline. Configured with FAKE_LLM_* env vars:
+#   FAKE_LLM_LATENCY       latency distribution per call, e.g. const:1 | uniform:0.5:2 |
+#                          normal:1.5:0.3 | lognormal:1.5:0.4 (median, sigma)   [lognormal:1.5:0.4]
+#   FAKE_LLM_FAILURE_RATE  share of calls that raise LLMError                    [0]
+#   FAKE_LLM_DRIFT_RATE    share of analyses with schema drift (a clause without level,
+#                          score as text) unless a json_schema response_format is requested [0]
+#   FAKE_LLM_CLAUSES       clauses per analysis (max 12)                          [6]
+#   FAKE_LLM_OCR_CHARS     characters of text per OCR'd image                     [1500]
+#   FAKE_LLM_SEED          seed for latency / failure draws                       [7]
+
+import base64
+import hashlib
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from .metrics import metrics
+from .tokens import count_tokens
+
+
+class LLMError(Exception):
+    """
+    Provider call failed. retryable=False for errors a retry cannot fix (bad request, auth).
+    """
+
+    def __init__(self, message: str, retryable: bool = True):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+class LLMTimeoutError(LLMError):
+    pass
+
+
+def _prompt_tokens(messages: List[Dict[str, Any]]) -> int:
+    n = 0
+    for m in messages:
+        content = m.get("content")
+        if isinstance(content, str):
+            n += count_tokens(content)
+        elif isinstance(content, list):
+            n += sum(count_tokens(p.get("text") or "") for p in content if isinstance(p, dict))
+    return n
+
+
+def _record(kind: str, t0: float, prompt_tokens: int, completion_tokens: int):
+    metrics.inc(f"llm.{kind}.calls")
+    metrics.inc("llm.prompt_tokens", prompt_tokens)
+    metrics.inc("llm.completion_tokens", completion_tokens)
+    metrics.observe(f"llm.{kind}.latency_s", time.perf_counter() - t0)
+
+
+class LLMProvider:
+    name = "base"
+
+    def chat(
+        self,
+        model: str,
+        messages: List[Dict[str, Any]],
+        *,
+        temperature: float = 0,
+        timeout: Optional[float] = None,
+        response_format: Optional[Dict[str, Any]] = None,
+    ) -> str:
+        """
+        response_format: OpenAI-style {"type": "json_object"} / {"type": "json_schema", ...}; None = free text.
+        """
+        raise NotImplementedError
+
+    def chat_stream(
+        self,
+        model: str,
+        messages: List[Dict[str, Any]],
+        *,
+        temperature: float = 0,
+        timeout: Optional[float] = None,
+        response_format: Optional[Dict[str, Any]] = None,
+    ) -> Iterator[str]:
+        """
+        Yields content deltas. Default: one delta with the whole completion.
+        """
+        yield self.chat(model, messages, temperature=temperature, timeout=timeout, response_format=response_format)
+
+    def ocr(
+        self,
+        model: str,
+        prompt: str,
+        images: List[Tuple[bytes, str]],
+        *,
+        timeout: Optional[float] = None,
+    ) -> str:
+        """
+        images: [(bytes, mime)]; one vision call for all of them.
+        """
+        parts: List[Dict[str, Any]] = [{"type": "text", "text": prompt}]
+        for b, mime in images:
+            b64 = base64.b64encode(b).decode("utf-8")
+            parts.append({"type": "image_url", "image_url": {"url": f"data:{mime};base64,{b64}"}})
+        return self.chat(model, [{"role": "user", "content": parts}], timeout=timeout)
+
+
+class OpenAIProvider(LLMProvider):
+    name = "openai"
+
+    def __init__(self):
+        self._client = None
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    from openai import OpenAI
+                    # retries / backoff are done by engine/resilience.py, not stacked on the SDK's own
+                    self._client = OpenAI(max_retries=0)
+        return self._client
+
+    @staticmethod
+    def _opts(timeout: Optional[float], response_format: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        # timeout=None would disable the client's default timeout, so only pass real values
+        opts: Dict[str, Any] = {"timeout": timeout} if timeout is not None else {}
+        if response_format is not None:
+            opts["response_format"] = response_format
+        return opts
+
+    def chat(self, model, messages, *, temperature=0, timeout=None, response_format=None) -> str:
+        t0 = time.perf_counter()
+        resp = self.client.chat.completions.create(
+            model=model,
+            temperature=temperature,
+            messages=messages,
+            **self._opts(timeout, response_format),
+        )
+        out = (resp.choices[0].message.content or "").strip()
+        usage = getattr(resp, "usage", None)
+        _record(
+            "chat", t0,
+            getattr(usage, "prompt_tokens", None) or _prompt_tokens(messages),
+            getattr(usage, "completion_tokens", None) or count_tokens(out),
+        )
+        return out
+
+    def chat_stream(self, model, messages, *, temperature=0, timeout=None, response_format=None) -> Iterator[str]:
+        t0 = time.perf_counter()
+        stream = self.client.chat.completions.create(
+            model=model,
+            temperature=temperature,
+            messages=messages,
+            stream=True,
+            **self._opts(timeout, response_format),
+        )
+        completion = 0
+        for ev in stream:
+            delta = (ev.choices[0].delta.content or "") if ev.choices else ""
+            if delta:
+                completion += count_tokens(delta)
+                yield delta
+        _record("stream", t0, _prompt_tokens(messages), completion)
+
+
+# ---- fake ----
+
+def parse_latency(spec: str) -> Callable[[random.Random], float]:
+    """
+    "const:1" | "uniform:lo:hi" | "normal:mean:sd" | "lognormal:median:sigma" -> sampler (seconds, >= 0)
+    """
+    kind, _, rest = (spec or "const:0").strip().partition(":")
+    args = [float(x) for x in rest.split(":") if x.strip()] if rest else []
+    kind = kind.lower()
+    if kind == "const":
+        v = args[0] if args else 0.0
+        return lambda rng: max(0.0, v)
+    if kind == "uniform" and len(args) == 2:
+        return lambda rng: max(0.0, rng.uniform(args[0], args[1]))
+    if kind == "normal" and len(args) == 2:
+        return lambda rng: max(0.0, rng.gauss(args[0], args[1]))
+    if kind == "lognormal" and len(args) == 2:
+        mu = math.log(max(args[0], 1e-6))
+        return lambda rng: rng.lognormvariate(mu, args[1])
+    raise ValueError(f"Bad latency spec: {spec!r}")
+
+
+_FAKE_SENTENCE_RE = re.compile(r"[^。；;！!？?\n]{6,}[。；;！!？?]?")
+_FAKE_HEADING_RE = re.compile(r"^(第[零〇一二三四五六七八九十百千0-9]+条|[一二三四五六七八九十]+、|\d{1,3}[、.．])")
+_FAKE_LEVELS = ("HIGH", "MEDIUM", "LOW")
+_FAKE_DEGREE = {"HIGH": "较大", "MEDIUM": "一定", "LOW": "轻微"}
+_FAKE_IMAGE_TOKENS = 1000  # rough vision-input cost per image, for the token counters only
+
+
+class FakeProvider(LLMProvider):
+    """
+    Output depends only on the input (same contract -> same analysis);
+    latency and failures are drawn from a seeded generator shared by all calls.
+    """
+
+    name = "fake"
+
+    def __init__(
+        self,
+        latency: str = "lognormal:1.5:0.4",
+        failure_rate: float = 0.0,
+        clauses: int = 6,
+        ocr_chars: int = 1500,
+        seed: int = 7,
+        drift_rate: float = 0.0,
+    ):
+        self._latency = parse_latency(latency)
+        self.failure_rate = failure_rate
+        self.drift_rate = drift_rate
+        self.clauses = max(0, min(12, clauses))
+        self.ocr_chars = ocr_chars
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "FakeProvider":
+        return cls(
+            latency=os.getenv("FAKE_LLM_LATENCY", "lognormal:1.5:0.4"),
+            failure_rate=float(os.getenv("FAKE_LLM_FAILURE_RATE", "0")),
+            clauses=int(os.getenv("FAKE_LLM_CLAUSES", "6")),
+            ocr_chars=int(os.getenv("FAKE_LLM_OCR_CHARS", "1500")),
+            seed=int(os.getenv("FAKE_LLM_SEED", "7")),
+            drift_rate=float(os.getenv("FAKE_LLM_DRIFT_RATE", "0")),
+        )
+
+    def _draw(self) -> Tuple[float, bool]:
+        with self._lock:
+            return self._latency(self._rng), self._rng.random() < self.failure_rate
+
+    def _wait(self, seconds: float, timeout: Optional[float]):
+        if timeout is not None and seconds > timeout:
+            time.sleep(timeout)
+            metrics.inc("llm.errors")
+            raise LLMTimeoutError(f"fake provider: timed out after {timeout:.0f}s")
+        time.sleep(seconds)
+
+    def _drifts(self, response_format: Optional[Dict[str, Any]]) -> bool:
+        if self.drift_rate <= 0 or (response_format or {}).get("type") == "json_schema":
+            return False
+        with self._lock:
+            return self._rng.random() < self.drift_rate
+
+    def _fail(self):
+        metrics.inc("llm.errors")
+        raise LLMError("fake provider: injected failure")
+
+    # -- content --
+
+    def _analysis(self, text: str) -> Dict[str, Any]:
+        h = hashlib.sha256(text.encode("utf-8")).digest()
+        sentences = [m.group(0).strip() for m in _FAKE_SENTENCE_RE.finditer(text)] or [text.strip()[:60] or "（空）"]
+        # spread picks over the whole input, deterministic per input
+        n = min(self.clauses, len(sentences))
+        step = max(1, len(sentences) // max(1, n))
+        start = h[1] % len(sentences)
+        picks = [sentences[(start + i * step) % len(sentences)] for i in range(n)]
+
+        clauses = []
+        for i, s in enumerate(picks):
+            m = _FAKE_HEADING_RE.match(s)
+            level = _FAKE_LEVELS[h[(i + 7) % len(h)] % 3]
+            clauses.append({
+                "section": m.group(1) if m else f"条款{i + 1}",
+                "title": f"{s[:14]}…存在{_FAKE_DEGREE[level]}风险",
+                "originalText": s[:120],
+                "explanation": f"该条款表述对签署方约束不对等，可能在履约或纠纷中处于不利地位（{level}）。",
+                "suggestion": "建议明确双方权利义务、触发条件与金额上限，并书面确认。",
+                "level": level,
+            })
+        return {
+            "score": 30 + h[0] % 60,
+            "riskSummary": f"共识别{len(clauses)}处需要关注的条款，整体风险{'偏高' if h[0] % 60 < 30 else '可控'}。",
+            "originalContent": "",
+            "clauses": clauses,
+        }
+
+    def _complete(self, messages: List[Dict[str, Any]], drift: bool = False) -> str:
+        system = next((m.get("content") or "" for m in messages if m.get("role") == "system"), "")
+        user = "\n".join(m.get("content") or "" for m in messages if m.get("role") == "user" and isinstance(m.get("content"), str))
+        if '{"riskSummary"' in system:
+            # summary-only merge pass
+            payload = json.loads(user or "{}")
+            return json.dumps(
+                {"riskSummary": "；".join(str(s)[:40] for s in payload.get("chunkSummaries", []))[:200]},
+                ensure_ascii=False,
+            )
+        out = self._analysis(user)
+        if drift:
+            # what free-form JSON mode occasionally does: a dropped field, a number written as text
+            out["score"] = f"{out['score']}分"
+            if out["clauses"]:
+                out["clauses"][0].pop("level", None)
+        return json.dumps(out, ensure_ascii=False)
+
+    # -- interface --
+
+    def chat(self, model, messages, *, temperature=0, timeout=None, response_format=None) -> str:
+        t0 = time.perf_counter()
+        latency, fail = self._draw()
+        self._wait(latency, timeout)
+        if fail:
+            self._fail()
+        out = self._complete(messages, self._drifts(response_format))
+        _record("chat", t0, _prompt_tokens(messages), count_tokens(out))
+        return out
+
+    def chat_stream(self, model, messages, *, temperature=0, timeout=None, response_format=None) -> Iterator[str]:
+        # ~20% of the latency before the first token, the rest spread over the deltas
+        t0 = time.perf_counter()
+        latency, fail = self._draw()
+        self._wait(latency * 0.2, timeout)
+        if fail:
+            self._fail()
+        out = self._complete(messages, self._drifts(response_format))
+        deltas = [out[i:i + 24] for i in range(0, len(out), 24)]
+        pause = latency * 0.8 / max(1, len(deltas))
+        for d in deltas:
+            time.sleep(pause)
+            yield d
+        _record("stream", t0, _prompt_tokens(messages), count_tokens(out))
+
+    def ocr(self, model, prompt, images, *, timeout=None) -> str:
+        t0 = time.perf_counter()
+        latency, fail = self._draw()
+        self._wait(latency, timeout)
+        if fail:
+            self._fail()
+        pages = []
+        for b, _ in images:
+            seed = int.from_bytes(hashlib.sha256(b).digest()[:4], "big")
+            lines, total, k = [], 0, 1
+            while total < self.ocr_chars:
+                line = f"第{seed % 90 + k}条 甲乙双方约定本条款事项，违约方应承担相应责任并赔偿损失。"
+                lines.append(line)
+                total += len(line)
+                k += 1
+            pages.append("\n".join(lines))
+        out = "\n\n".join(pages)
+        _record("ocr", t0, len(images) * _FAKE_IMAGE_TOKENS, count_tokens(out))
+        return out
+
+
+def make_provider(name: str) -> LLMProvider:
+    name = (name or "openai").strip().lower()
+    if name == "openai":
+        return OpenAIProvider()
+    if name == "fake":
+        return FakeProvider.from_env()
+    raise ValueError(f"Unknown LLM provider: {name!r} (expected openai | fake)")
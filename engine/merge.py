@@ -0,0 +1,176 @@
+# engine/merge.py
+# Deterministic local merge of chunk analyses (replaces the extra LLM merge round-trip).
+#
+# - clauses: dedupe by normalized originalText / title similarity, keep the clearer one,
+#   rank HIGH > MEDIUM > LOW (chunk order within a level), cap at MAX_CLAUSES
+# - score: chunk scores weighted by each chunk's risk mass, biased toward the worst chunk
+# - riskSummary: condensed from the chunk summaries (first sentence of every chunk first)
+
+import json
+import re
+import unicodedata
+from typing import Any, Dict, List, Optional, Set
+
+MAX_CLAUSES = 12
+SUMMARY_MAX_CHARS = 400
+
+LEVEL_RANK = {"HIGH": 0, "MEDIUM": 1, "LOW": 2}
+LEVEL_WEIGHT = {"HIGH": 3.0, "MEDIUM": 1.5, "LOW": 0.5}
+
+TEXT_SIMILARITY = 0.6    # originalText bigram overlap that counts as the same clause
+TITLE_SIMILARITY = 0.75  # title overlap that counts as the same clause
+WORST_CHUNK_BIAS = 0.3   # share of the final score taken from the riskiest chunk
+
+_PUNCT_SPACE_RE = re.compile(r"[\s\W_]+", re.UNICODE)
+_SENTENCE_RE = re.compile(r"[^。！？!?；;]+[。！？!?；;]?")
+
+
+def normalize_text(s: Any) -> str:
+    t = unicodedata.normalize("NFKC", str(s or "")).lower()
+    return _PUNCT_SPACE_RE.sub("", t)
+
+
+def _bigrams(s: str) -> Set[str]:
+    if len(s) < 2:
+        return {s} if s else set()
+    return {s[i:i + 2] for i in range(len(s) - 1)}
+
+
+def similarity(a: str, b: str) -> float:
+    """
+    Dice coefficient of character bigrams on normalized text (0..1).
+    Insensitive to whitespace/punctuation and full-/half-width differences.
+    """
+    ga, gb = _bigrams(normalize_text(a)), _bigrams(normalize_text(b))
+    if not ga or not gb:
+        return 0.0
+    return 2 * len(ga & gb) / (len(ga) + len(gb))
+
+
+def _level(c: Dict[str, Any]) -> str:
+    lv = str(c.get("level") or "").strip().upper()
+    return lv if lv in LEVEL_RANK else "LOW"
+
+
+def _clarity(c: Dict[str, Any]) -> tuple:
+    # higher severity first, then the more detailed explanation/suggestion
+    return (-LEVEL_RANK[_level(c)], len(str(c.get("explanation") or "")) + len(str(c.get("suggestion") or "")))
+
+
+def is_duplicate(a: Dict[str, Any], b: Dict[str, Any]) -> bool:
+    ta, tb = a.get("originalText") or "", b.get("originalText") or ""
+    if ta and tb and similarity(ta, tb) >= TEXT_SIMILARITY:
+        return True
+    return similarity(a.get("title") or "", b.get("title") or "") >= TITLE_SIMILARITY
+
+
+def dedupe_clauses(clauses: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Keep the first position of every distinct clause, but the clearest wording of it.
+    """
+    kept: List[Dict[str, Any]] = []
+    for c in clauses:
+        if not isinstance(c, dict):
+            continue
+        for i, k in enumerate(kept):
+            if is_duplicate(k, c):
+                if _clarity(c) > _clarity(k):
+                    kept[i] = c
+                break
+        else:
+            kept.append(c)
+    return kept
+
+
+def rank_clauses(clauses: List[Dict[str, Any]], limit: int = MAX_CLAUSES) -> List[Dict[str, Any]]:
+    # sorted() is stable: chunk order is preserved within a level
+    return sorted(clauses, key=lambda c: LEVEL_RANK[_level(c)])[:limit]
+
+
+def _score_of(r: Dict[str, Any]) -> Optional[float]:
+    try:
+        return max(0.0, min(100.0, float(r.get("score"))))
+    except (TypeError, ValueError):
+        return None
+
+
+def merge_score(chunk_results: List[Dict[str, Any]]) -> int:
+    """
+    Weighted mean of chunk scores (weight = 1 + risk mass of the chunk's clauses),
+    pulled toward the riskiest chunk: one dangerous section should not be averaged away.
+    """
+    scored = []
+    for r in chunk_results:
+        s = _score_of(r)
+        if s is None:
+            continue
+        mass = sum(LEVEL_WEIGHT[_level(c)] for c in (r.get("clauses") or []) if isinstance(c, dict))
+        scored.append((s, 1.0 + mass))
+    if not scored:
+        return 0
+
+    weighted = sum(s * w for s, w in scored) / sum(w for _, w in scored)
+    worst = min(s for s, _ in scored)
+    return int(round((1 - WORST_CHUNK_BIAS) * weighted + WORST_CHUNK_BIAS * worst))
+
+
+def condense_summaries(summaries: List[str], max_chars: int = SUMMARY_MAX_CHARS) -> str:
+    """
+    Round-robin over chunk summaries sentence by sentence (first sentence of every chunk first),
+    skipping near-duplicate sentences, until max_chars.
+    """
+    per_chunk = [[m.group(0).strip() for m in _SENTENCE_RE.finditer(s or "") if m.group(0).strip()] for s in summaries]
+    picked: List[str] = []
+    total = 0
+    depth = 0
+    while any(depth < len(ss) for ss in per_chunk):
+        for ss in per_chunk:
+            if depth >= len(ss):
+                continue
+            sent = ss[depth]
+            if any(similarity(sent, p) >= TITLE_SIMILARITY for p in picked):
+                continue
+            if picked and total + len(sent) > max_chars:
+                return "".join(picked)
+            picked.append(sent)
+            total += len(sent)
+        depth += 1
+    return "".join(picked)
+
+
+def merge_chunk_results_local(chunk_results: List[Dict[str, Any]]) -> Dict[str, Any]:
+    all_clauses: List[Dict[str, Any]] = []
+    for r in chunk_results:
+        all_clauses.extend(r.get("clauses") or [])
+
+    return {
+        "score": merge_score(chunk_results),
+        "riskSummary": condense_summaries([str(r.get("riskSummary") or "") for r in chunk_results]),
+        "originalContent": "",
+        "clauses": rank_clauses(dedupe_clauses(all_clauses)),
+    }
+
+
+def build_summary_merge_messages(
+    system_prompt: str,
+    chunk_results: List[Dict[str, Any]],
+    merged: Dict[str, Any],
+) -> List[Dict[str, str]]:
+    """
+    Opt-in LLM pass that only rewrites riskSummary; clauses and score stay local.
+    The model sees chunk summaries + merged clause titles, not the clauses in full.
+    """
+    payload = {
+        "score": merged.get("score", 0),
+        "chunkSummaries": [str(r.get("riskSummary") or "") for r in chunk_results],
+        "clauseTitles": [f"[{_level(c)}] {c.get('title', '')}" for c in merged.get("clauses") or []],
+    }
+    system = (
+        system_prompt
+        + "\n你将收到多个分块的风险摘要和已合并的风险条款标题，"
+          "请只输出JSON：{\"riskSummary\": \"...\"}，概括整份合同的整体风险（不超过200字）。"
+    )
+    return [
+        {"role": "system", "content": system},
+        {"role": "user", "content": json.dumps(payload, ensure_ascii=False)},
+    ]
@@ -0,0 +1,74 @@
+# engine/metrics.py
+# In-process counters and timings, exposed by GET /v1/metrics.
+
+import threading
+from collections import deque
+from typing import Any, Deque, Dict
+
+_RESERVOIR = 1024  # keep the most recent observations per timing for percentiles
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, float] = {}
+        self._gauges: Dict[str, Any] = {}
+        self._timings: Dict[str, Deque[float]] = {}
+        self._timing_totals: Dict[str, list] = {}  # name -> [count, sum]
+
+    def inc(self, name: str, n: float = 1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def set(self, name: str, value: Any):
+        with self._lock:
+            self._gauges[name] = value
+
+    def observe(self, name: str, value: float):
+        with self._lock:
+            dq = self._timings.get(name)
+            if dq is None:
+                dq = self._timings[name] = deque(maxlen=_RESERVOIR)
+                self._timing_totals[name] = [0, 0.0]
+            dq.append(float(value))
+            tot = self._timing_totals[name]
+            tot[0] += 1
+            tot[1] += float(value)
+
+    def get(self, name: str) -> float:
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def ratio(self, num: str, *den: str) -> float:
+        """
+        num / (sum of den counters); 0.0 when nothing was counted yet.
+        """
+        with self._lock:
+            d = sum(self._counters.get(x, 0) for x in den)
+            return (self._counters.get(num, 0) / d) if d else 0.0
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            timings = {}
+            for name, dq in self._timings.items():
+                vals = sorted(dq)
+                count, total = self._timing_totals[name]
+
+                def pct(p: float) -> float:
+                    return vals[min(len(vals) - 1, int(p * len(vals)))] if vals else 0.0
+
+                timings[name] = {
+                    "count": count,
+                    "mean": (total / count) if count else 0.0,
+                    "p50": pct(0.50),
+                    "p95": pct(0.95),
+                    "max": vals[-1] if vals else 0.0,
+                }
+            return {
+                "counters": dict(self._counters),
+                "gauges": dict(self._gauges),
+                "timings": timings,
+            }
+
+
+metrics = Metrics()
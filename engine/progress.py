@@ -0,0 +1,167 @@
+# engine/progress.py
+# Per-channel progress events (channel = job id or upload batch id), read by long-poll or SSE.
+#
+# Each channel is an append-only log of typed events owned by one user:
+#   {"seq": 3, "type": "ocr_batch", "progress": 20, "ts": "...", "processedImages": 5, "totalImages": 9}
+# Readers pass the last seq they saw and get everything after it (or wait for it).
+# Closed channels are kept for RETENTION_SECONDS so late readers still get the final event.
+# Publishers are worker threads; aread() lets a coroutine wait without holding a thread.
+
+import asyncio
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+MAX_EVENTS_PER_CHANNEL = 200
+RETENTION_SECONDS = 600.0
+
+
+class _Channel:
+    def __init__(self, owner: int):
+        self.owner = owner
+        self.events: Deque[Dict[str, Any]] = deque(maxlen=MAX_EVENTS_PER_CHANNEL)
+        self.seq = 0
+        self.closed_at: Optional[float] = None
+
+
+class ProgressHub:
+    def __init__(self, retention_seconds: float = RETENTION_SECONDS):
+        self.retention_seconds = retention_seconds
+        self._cond = threading.Condition()
+        self._channels: Dict[str, _Channel] = {}
+        # channel -> coroutines waiting in aread(), woken on publish / close
+        self._async_waiters: Dict[str, List[Tuple[asyncio.AbstractEventLoop, "asyncio.Future"]]] = {}
+
+    def _sweep(self, now: float):
+        expired = [
+            k for k, ch in self._channels.items()
+            if ch.closed_at is not None and now - ch.closed_at > self.retention_seconds
+        ]
+        for k in expired:
+            del self._channels[k]
+
+    def open(self, channel: str, owner: int) -> bool:
+        """
+        Idempotent. Returns False if the channel exists and belongs to someone else.
+        Reopening a closed channel keeps its log and seq (a retried job continues it).
+        """
+        with self._cond:
+            self._sweep(time.monotonic())
+            ch = self._channels.get(channel)
+            if ch is None:
+                self._channels[channel] = _Channel(owner)
+                return True
+            if ch.owner != owner:
+                return False
+            ch.closed_at = None
+            return True
+
+    def owner(self, channel: str) -> Optional[int]:
+        with self._cond:
+            ch = self._channels.get(channel)
+            return ch.owner if ch else None
+
+    def publish(self, channel: str, type: str, progress: Optional[int] = None, **detail: Any):
+        with self._cond:
+            ch = self._channels.get(channel)
+            if ch is None or ch.closed_at is not None:
+                # late reports (e.g. chunk threads still running after a failure) never follow the final event
+                return
+            ch.seq += 1
+            ev: Dict[str, Any] = {
+                "seq": ch.seq,
+                "type": type,
+                "progress": progress,
+                "ts": datetime.utcnow().isoformat(),
+            }
+            ev.update(detail)
+            ch.events.append(ev)
+            self._notify(channel)
+
+    def close(self, channel: str, type: str, progress: Optional[int] = None, **detail: Any):
+        # final event + close in one step, so a reader never sees "closed" without it
+        with self._cond:
+            if channel not in self._channels:
+                return
+            self.publish(channel, type, progress, **detail)
+            self._channels[channel].closed_at = time.monotonic()
+            self._notify(channel)
+
+    def _notify(self, channel: str):
+        # caller holds self._cond
+        self._cond.notify_all()
+        for loop, fut in self._async_waiters.pop(channel, []):
+            try:
+                loop.call_soon_threadsafe(_wake, fut)
+            except RuntimeError:  # loop already closed
+                pass
+
+    def _poll(self, channel: str, owner: int, after: int) -> Optional[Tuple[List[Dict[str, Any]], bool]]:
+        # caller holds self._cond
+        ch = self._channels.get(channel)
+        if ch is None or ch.owner != owner:
+            return None
+        return [e for e in ch.events if e["seq"] > after], ch.closed_at is not None
+
+    def read(
+        self,
+        channel: str,
+        owner: int,
+        after: int = 0,
+        timeout: float = 0.0,
+    ) -> Optional[Tuple[List[Dict[str, Any]], bool]]:
+        """
+        Events with seq > after, waiting up to timeout for the first one.
+        Returns (events, closed), or None if the channel does not exist for this owner.
+        """
+        deadline = time.monotonic() + max(0.0, timeout)
+        with self._cond:
+            while True:
+                got = self._poll(channel, owner, after)
+                remaining = deadline - time.monotonic()
+                if got is None or got[0] or got[1] or remaining <= 0:
+                    return got
+                self._cond.wait(remaining)
+
+    async def aread(
+        self,
+        channel: str,
+        owner: int,
+        after: int = 0,
+        timeout: float = 0.0,
+    ) -> Optional[Tuple[List[Dict[str, Any]], bool]]:
+        """
+        read() for coroutines: waits on the event loop instead of blocking a thread.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = time.monotonic() + max(0.0, timeout)
+        while True:
+            with self._cond:
+                got = self._poll(channel, owner, after)
+                remaining = deadline - time.monotonic()
+                if got is None or got[0] or got[1] or remaining <= 0:
+                    return got
+                fut = loop.create_future()
+                waiter = (loop, fut)
+                self._async_waiters.setdefault(channel, []).append(waiter)
+            try:
+                await asyncio.wait_for(fut, remaining)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                with self._cond:
+                    waiters = self._async_waiters.get(channel)
+                    if waiters and waiter in waiters:
+                        waiters.remove(waiter)
+                        if not waiters:
+                            del self._async_waiters[channel]
+
+
+def _wake(fut: "asyncio.Future"):
+    if not fut.done():
+        fut.set_result(None)
+
+
+progress_hub = ProgressHub()
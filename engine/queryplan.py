@@ -0,0 +1,54 @@
+# engine/queryplan.py
+# EXPLAIN QUERY PLAN for SQLAlchemy statements on SQLite, and a check that flags bad plans.
+#
+# A step "SCAN <table>" (with or without "USING [COVERING] INDEX") reads every row / index entry
+# of that table; a hot query should only SEARCH. "USE TEMP B-TREE" means SQLite collects and sorts
+# every matching row before LIMIT applies (the index does not deliver them in ORDER BY / GROUP BY /
+# DISTINCT order), which grows with the data just like a scan, so it is flagged too.
+
+from typing import Any, Dict, List, Tuple
+
+
+def explain(conn, stmt) -> List[str]:
+    """
+    Plan steps (the "detail" column) of stmt, compiled for conn's dialect with its own
+    bound parameter values.
+    """
+    compiled = stmt.compile(dialect=conn.dialect)
+    params: Any = compiled.params
+    if compiled.positiontup is not None:
+        params = tuple(compiled.params[k] for k in compiled.positiontup)
+    rows = conn.exec_driver_sql("EXPLAIN QUERY PLAN " + str(compiled), params).fetchall()
+    return [str(r[-1]) for r in rows]
+
+
+def full_scans(steps: List[str]) -> List[str]:
+    out = []
+    for step in steps:
+        s = step.strip()
+        if not s.startswith("SCAN "):
+            continue
+        target = s[5:].split(" ", 1)[0]
+        if target in ("CONSTANT", "(subquery") or target.startswith("(subquery"):
+            continue
+        out.append(s)
+    return out
+
+
+def temp_sorts(steps: List[str]) -> List[str]:
+    return [step.strip() for step in steps if step.strip().startswith("USE TEMP B-TREE")]
+
+
+def bad_steps(steps: List[str]) -> List[str]:
+    return full_scans(steps) + temp_sorts(steps)
+
+
+def audit(conn, queries: Dict[str, Any]) -> List[Tuple[str, List[str], List[str]]]:
+    """
+    [(name, plan steps, offending steps)] for every query, in order.
+    """
+    report = []
+    for name, stmt in queries.items():
+        steps = explain(conn, stmt)
+        report.append((name, steps, bad_steps(steps)))
+    return report
@@ -0,0 +1,246 @@
+# engine/resilience.py
+# Retry / hedging / circuit breaker around any LLMProvider.
+#
+# - retry: retryable errors (timeouts, connection errors, 408/409/429/5xx) are retried with
+#   full-jitter exponential backoff; anything else fails immediately
+# - hedging (opt-in): if a chat/OCR call has not answered after hedge_after seconds, a duplicate
+#   is sent and the first success wins (the loser finishes in the background)
+# - circuit breaker: after `threshold` consecutive retryable failures all calls fail fast with
+#   CircuitOpenError for `cooldown` seconds; then one trial call decides (half-open)
+# - streams are retried only until the first delta has been handed to the caller
+#
+# Everything that escapes is an LLMError; state is exported through engine.metrics.
+
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Iterator, List, Optional, Tuple
+
+from .llm import LLMError, LLMProvider, LLMTimeoutError
+from .metrics import metrics
+
+_RETRYABLE_STATUS = {408, 409, 429}
+_RETRYABLE_NAMES = {"APITimeoutError", "APIConnectionError", "RateLimitError", "InternalServerError"}
+
+
+class CircuitOpenError(LLMError):
+    """
+    Raised without calling the provider while the breaker is open. retry_in is in seconds.
+    """
+
+    def __init__(self, retry_in: float):
+        super().__init__(f"model circuit open, retry in {retry_in:.0f}s", retryable=False)
+        self.retry_in = retry_in
+
+
+def is_retryable(exc: BaseException) -> bool:
+    # openai's exception classes are matched by name / status_code so this module never imports openai
+    if isinstance(exc, LLMError):
+        return exc.retryable
+    if isinstance(exc, (TimeoutError, ConnectionError)):
+        return True
+    if type(exc).__name__ in _RETRYABLE_NAMES:
+        return True
+    status = getattr(exc, "status_code", None)
+    return isinstance(status, int) and (status in _RETRYABLE_STATUS or status >= 500)
+
+
+def _as_llm_error(exc: BaseException) -> LLMError:
+    if isinstance(exc, LLMError):
+        return exc
+    if type(exc).__name__ == "APITimeoutError" or isinstance(exc, TimeoutError):
+        err: LLMError = LLMTimeoutError(f"{type(exc).__name__}: {exc}")
+    else:
+        err = LLMError(f"{type(exc).__name__}: {exc}", retryable=is_retryable(exc))
+    err.__cause__ = exc
+    return err
+
+
+class CircuitBreaker:
+    """
+    closed -> open after `threshold` consecutive failures -> half_open after `cooldown` seconds
+    (exactly one trial call) -> closed on success / open again on failure.
+    """
+
+    def __init__(self, threshold: int = 5, cooldown: float = 30.0, name: str = "llm"):
+        self.threshold = max(1, threshold)
+        self.cooldown = cooldown
+        self.name = name
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._trial = False  # a half-open trial call is in flight
+        metrics.set(f"{name}.breaker.state", "closed")
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state(time.monotonic())
+
+    def _state(self, now: float) -> str:
+        if self._opened_at is None:
+            return "closed"
+        return "open" if now - self._opened_at < self.cooldown else "half_open"
+
+    def before_call(self):
+        with self._lock:
+            now = time.monotonic()
+            state = self._state(now)
+            if state == "closed":
+                return
+            if state == "half_open" and not self._trial:
+                self._trial = True
+                metrics.set(f"{self.name}.breaker.state", "half_open")
+                return
+            metrics.inc(f"{self.name}.breaker.rejected")
+            retry_in = max(0.0, self.cooldown - (now - self._opened_at)) if state == "open" else 1.0
+            raise CircuitOpenError(retry_in)
+
+    def on_success(self):
+        with self._lock:
+            self._failures = 0
+            self._trial = False
+            if self._opened_at is not None:
+                self._opened_at = None
+                metrics.set(f"{self.name}.breaker.state", "closed")
+
+    def on_failure(self):
+        with self._lock:
+            self._failures += 1
+            reopen = self._trial
+            self._trial = False
+            if reopen or (self._opened_at is None and self._failures >= self.threshold):
+                self._opened_at = time.monotonic()
+                metrics.inc(f"{self.name}.breaker.trips")
+                metrics.set(f"{self.name}.breaker.state", "open")
+
+
+class ResilientProvider(LLMProvider):
+    """
+    Wraps another provider; same interface, so callers do not know it is there.
+    max_retries counts extra attempts (2 = up to 3 calls); hedge_after <= 0 disables hedging.
+    """
+
+    def __init__(
+        self,
+        inner: LLMProvider,
+        *,
+        max_retries: int = 2,
+        backoff_base: float = 0.5,
+        backoff_max: float = 8.0,
+        hedge_after: float = 0.0,
+        breaker: Optional[CircuitBreaker] = None,
+        hedge_workers: int = 32,
+        sleep: Callable[[float], None] = time.sleep,
+    ):
+        self.inner = inner
+        self.max_retries = max(0, max_retries)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge_after = hedge_after
+        self.breaker = breaker or CircuitBreaker()
+        self._sleep = sleep
+        self._rng = random.Random()
+        self._hedge_pool = (
+            ThreadPoolExecutor(max_workers=hedge_workers, thread_name_prefix="llm-hedge") if hedge_after > 0 else None
+        )
+
+    @property
+    def name(self) -> str:
+        return self.inner.name
+
+    def max_call_seconds(self, timeout: float) -> float:
+        """
+        Longest one chat/ocr call can take when every attempt runs into timeout: each attempt
+        (plus hedge_after, when the hedge only starts then) and the largest jittered backoff
+        before each retry. Callers waiting on such a call from outside use it as their deadline.
+        """
+        per_attempt = timeout + (self.hedge_after if self._hedge_pool is not None else 0.0)
+        backoff = sum(min(self.backoff_max, self.backoff_base * (2 ** a)) for a in range(self.max_retries))
+        return (self.max_retries + 1) * per_attempt + backoff
+
+    def _backoff(self, attempt: int) -> float:
+        # full jitter: uniform(0, min(max, base * 2^attempt))
+        return self._rng.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def _hedged(self, call: Callable[[], Any]) -> Any:
+        if self._hedge_pool is None:
+            return call()
+        first = self._hedge_pool.submit(call)
+        done, _ = wait([first], timeout=self.hedge_after)
+        if done:
+            return first.result()
+
+        metrics.inc("llm.hedge.launched")
+        second = self._hedge_pool.submit(call)
+        pending = {first, second}
+        error: Optional[BaseException] = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for f in done:
+                if f.exception() is None:
+                    if f is second:
+                        metrics.inc("llm.hedge.won")
+                    return f.result()
+                error = f.exception()
+        raise error  # both failed
+
+    def _call(self, kind: str, call: Callable[[], Any], hedge: bool) -> Any:
+        attempt = 0
+        while True:
+            self.breaker.before_call()
+            try:
+                out = self._hedged(call) if hedge else call()
+            except BaseException as e:
+                retryable = is_retryable(e)
+                if retryable:
+                    self.breaker.on_failure()
+                else:
+                    # the request was bad, not the service: a half-open trial still counts as "service up"
+                    self.breaker.on_success()
+                if not retryable or attempt >= self.max_retries:
+                    if retryable:
+                        metrics.inc("llm.retry.exhausted")
+                    raise _as_llm_error(e)
+                metrics.inc("llm.retry.attempts")
+                metrics.inc(f"llm.retry.{kind}")
+                self._sleep(self._backoff(attempt))
+                attempt += 1
+                continue
+            self.breaker.on_success()
+            return out
+
+    def chat(self, model, messages, *, temperature=0, timeout=None, response_format=None) -> str:
+        return self._call(
+            "chat",
+            lambda: self.inner.chat(
+                model, messages, temperature=temperature, timeout=timeout, response_format=response_format,
+            ),
+            hedge=True,
+        )
+
+    def ocr(self, model, prompt, images, *, timeout=None) -> str:
+        return self._call(
+            "ocr",
+            lambda: self.inner.ocr(model, prompt, images, timeout=timeout),
+            hedge=True,
+        )
+
+    def chat_stream(self, model, messages, *, temperature=0, timeout=None, response_format=None) -> Iterator[str]:
+        # open the stream and pull the first delta under retry; after that errors surface as-is
+        def start() -> Tuple[Iterator[str], List[str]]:
+            it = iter(self.inner.chat_stream(
+                model, messages, temperature=temperature, timeout=timeout, response_format=response_format,
+            ))
+            head = [d for d in [next(it, None)] if d is not None]
+            return it, head
+
+        it, head = self._call("stream", start, hedge=False)
+        yield from head
+        try:
+            yield from it
+        except Exception as e:
+            if is_retryable(e):
+                self.breaker.on_failure()
+            raise _as_llm_error(e)
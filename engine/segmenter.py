@@ -0,0 +1,275 @@
+# engine/segmenter.py
+# Clause-boundary-aware chunking for Chinese contracts.
+#
+# 1) split_articles: cut the text at structural headings
+#    (第X章/第X条, 一、, （一）, 1.1, 附件/附录/附表) so every segment is a whole article.
+# 2) pack_chunks: greedily pack whole segments into chunks up to a token budget;
+#    a segment is only split (paragraph -> sentence -> hard cut) if it alone exceeds the budget.
+# 3) Each chunk after the first carries a short overlap (tail of the previous chunk)
+#    as read-only context, so a clause that refers back to the previous article still reads right.
+
+import re
+from dataclasses import dataclass
+from typing import Callable, List, Optional
+
+from .tokens import count_tokens
+
+_CN_NUM = "零〇一二三四五六七八九十百千"
+
+# (level, pattern) — level 0 = chapter/annex, 1 = article, 2 = sub-item
+_HEADING_PATTERNS = [
+    (0, re.compile(r"^(附件|附录|附表)\s*[0-9一二三四五六七八九十]*\s*[:：、.．]?")),
+    (0, re.compile(rf"^第[{_CN_NUM}0-9]+[章编节]")),
+    (1, re.compile(rf"^第[{_CN_NUM}0-9]+条")),
+    (1, re.compile(r"^[一二三四五六七八九十]+[、.．]")),
+    (2, re.compile(r"^[（(][一二三四五六七八九十]+[）)]")),
+    (2, re.compile(r"^\d{1,3}(\.\d{1,3})+(?![\d%])")),
+    (1, re.compile(r"^\d{1,3}[、.．](?!\d)")),
+]
+
+_SENTENCE_END_RE = re.compile(r"(?<=[。；;！!？?])")
+_LINE_END_RE = re.compile(r"(?<=\n)")
+
+
+@dataclass
+class Segment:
+    level: int        # -1 = preamble (text before the first heading)
+    heading: str
+    text: str         # includes the heading line
+
+
+@dataclass
+class Chunk:
+    text: str         # body to analyze
+    overlap: str      # read-only context copied from the previous chunk ("" for the first chunk)
+    tokens: int       # estimated tokens of text (overlap excluded)
+
+
+def heading_level(line: str) -> Optional[int]:
+    s = (line or "").strip()
+    if not s:
+        return None
+    for level, pat in _HEADING_PATTERNS:
+        if pat.match(s):
+            return level
+    return None
+
+
+def split_articles(text: str) -> List[Segment]:
+    """
+    Cut text at heading lines. Non-heading lines stick to the segment above them.
+    """
+    segments: List[Segment] = []
+    cur_lines: List[str] = []
+    cur_level, cur_heading = -1, ""
+
+    for line in (text or "").splitlines():
+        level = heading_level(line)
+        if level is not None and cur_lines:
+            body = "\n".join(cur_lines).strip()
+            if body:
+                segments.append(Segment(level=cur_level, heading=cur_heading, text=body))
+            cur_lines = []
+        if level is not None:
+            cur_level, cur_heading = level, line.strip()[:40]
+        cur_lines.append(line)
+
+    body = "\n".join(cur_lines).strip()
+    if body:
+        segments.append(Segment(level=cur_level, heading=cur_heading, text=body))
+    return segments
+
+
+def _hard_split(text: str, budget: int, count: Callable[[str], int]) -> List[str]:
+    # last resort: cut by characters, sized from the observed tokens/char ratio
+    n = max(1, count(text))
+    step = max(1, int(len(text) * budget / n))
+    return [text[i:i + step] for i in range(0, len(text), step)]
+
+
+def _exact_units(pieces: List[str]) -> List[str]:
+    # whitespace-only pieces are glued to the previous unit, so "".join(units) is the original text
+    units: List[str] = []
+    for p in pieces:
+        if units and not p.strip():
+            units[-1] += p
+        elif p:
+            units.append(p)
+    return units
+
+
+def _split_oversized(text: str, budget: int, count: Callable[[str], int]) -> List[str]:
+    """
+    Split one segment that alone exceeds the budget: paragraphs, then sentences, then characters.
+    Pieces are cut out of text as-is (line breaks stay where they were, none are added).
+    """
+    for splitter in (_LINE_END_RE.split, _SENTENCE_END_RE.split):
+        units = _exact_units(splitter(text))
+        if sum(1 for u in units if u.strip()) <= 1:
+            continue
+        out: List[str] = []
+        buf: List[str] = []
+        buf_tokens = 0
+
+        def flush():
+            nonlocal buf, buf_tokens
+            piece = "".join(buf).strip()
+            if piece:
+                out.append(piece)
+            buf, buf_tokens = [], 0
+
+        for u in units:
+            ut = count(u)
+            if ut > budget:
+                flush()
+                out.extend(_split_oversized(u.strip(), budget, count))
+                continue
+            if buf and buf_tokens + ut > budget:
+                flush()
+            buf.append(u)
+            buf_tokens += ut
+        flush()
+        return out
+    return _hard_split(text, budget, count)
+
+
+def _tail_overlap(text: str, overlap_chars: int) -> str:
+    """
+    Last ~overlap_chars of text, snapped forward to a line or sentence start.
+    """
+    if overlap_chars <= 0 or not text:
+        return ""
+    if len(text) <= overlap_chars:
+        return text
+    tail = text[-overlap_chars:]
+    nl = tail.find("\n")
+    if 0 <= nl < len(tail) - 1:
+        return tail[nl + 1:]
+    m = re.search(r"[。；;！!？?]", tail)
+    if m and m.end() < len(tail):
+        return tail[m.end():]
+    return tail
+
+
+def pack_chunks(
+    segments: List[Segment],
+    budget_tokens: int,
+    overlap_chars: int = 0,
+    count: Callable[[str], int] = count_tokens,
+) -> List[Chunk]:
+    budget_tokens = max(1, int(budget_tokens))
+    bodies: List[str] = []
+    buf: List[str] = []
+    buf_tokens = 0
+
+    def flush():
+        nonlocal buf, buf_tokens
+        if buf:
+            bodies.append("\n".join(buf))
+        buf, buf_tokens = [], 0
+
+    for seg in segments:
+        st = count(seg.text)
+        if st > budget_tokens:
+            flush()
+            bodies.extend(_split_oversized(seg.text, budget_tokens, count))
+            continue
+        # prefer starting a chapter/annex on a fresh chunk once the current one is half full
+        if buf and (buf_tokens + st > budget_tokens or (seg.level == 0 and buf_tokens * 2 >= budget_tokens)):
+            flush()
+        buf.append(seg.text)
+        buf_tokens += st + 1
+    flush()
+
+    chunks: List[Chunk] = []
+    for i, body in enumerate(bodies):
+        overlap = _tail_overlap(bodies[i - 1], overlap_chars) if i > 0 else ""
+        chunks.append(Chunk(text=body, overlap=overlap, tokens=count(body)))
+    return chunks
+
+
+def chunk_contract(
+    text: str,
+    budget_tokens: int,
+    overlap_chars: int = 0,
+    count: Callable[[str], int] = count_tokens,
+) -> List[Chunk]:
+    return pack_chunks(split_articles(text), budget_tokens, overlap_chars, count)
+
+
+class StreamingPacker:
+    """
+    pack_chunks for text that arrives in pieces (PDF pages, in order): feeding pieces p1..pn gives
+    the same chunks as chunk_contract(sep.join([p1..pn])) (how the PDF path joins its pages).
+    feed() returns the chunks that are already final: everything from the last heading line on
+    may continue on the next page, so it stays open (as raw text) until the next heading.
+    """
+
+    def __init__(
+        self,
+        budget_tokens: int,
+        overlap_chars: int = 0,
+        count: Callable[[str], int] = count_tokens,
+        sep: str = "\n\n",
+    ):
+        self.budget = max(1, int(budget_tokens))
+        self.overlap_chars = overlap_chars
+        self.count = count
+        self.sep = sep
+        self._fed = False
+        self._tail = ""         # raw text from the last heading line on (possibly unfinished article)
+        self._buf: List[str] = []
+        self._buf_tokens = 0
+        self._last_body = ""    # body of the last emitted chunk (for the next overlap)
+
+    def _emit(self, body: str, out: List[Chunk]):
+        overlap = _tail_overlap(self._last_body, self.overlap_chars) if self._last_body else ""
+        out.append(Chunk(text=body, overlap=overlap, tokens=self.count(body)))
+        self._last_body = body
+
+    def _flush(self, out: List[Chunk]):
+        if self._buf:
+            self._emit("\n".join(self._buf), out)
+        self._buf, self._buf_tokens = [], 0
+
+    def _add(self, seg: Segment, out: List[Chunk]):
+        # same rules as pack_chunks
+        st = self.count(seg.text)
+        if st > self.budget:
+            self._flush(out)
+            for part in _split_oversized(seg.text, self.budget, self.count):
+                self._emit(part, out)
+            return
+        if self._buf and (
+            self._buf_tokens + st > self.budget or (seg.level == 0 and self._buf_tokens * 2 >= self.budget)
+        ):
+            self._flush(out)
+        self._buf.append(seg.text)
+        self._buf_tokens += st + 1
+
+    def feed(self, text: str) -> List[Chunk]:
+        if not text:
+            return []
+        raw = self._tail + self.sep + text if self._fed else text
+        self._fed = True
+        # split_articles cuts before every heading line that follows some text, so whatever comes
+        # before the last such line is final; cut the raw text there (separators kept as they are)
+        lines = raw.splitlines(keepends=True)
+        cut = 0
+        for i in range(len(lines) - 1, 0, -1):
+            if heading_level(lines[i]) is not None:
+                cut = i
+                break
+        self._tail = "".join(lines[cut:])
+        out: List[Chunk] = []
+        for seg in split_articles("".join(lines[:cut])):
+            self._add(seg, out)
+        return out
+
+    def close(self) -> List[Chunk]:
+        out: List[Chunk] = []
+        for seg in split_articles(self._tail):
+            self._add(seg, out)
+        self._tail = ""
+        self._flush(out)
+        return out
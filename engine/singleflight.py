@@ -0,0 +1,60 @@
+# engine/singleflight.py
+# Coalesce identical in-flight calls: the first caller (leader) runs fn,
+# duplicates with the same key wait and receive the leader's result.
+
+import threading
+from typing import Any, Callable, Dict, Optional, Tuple
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[str, _Call] = {}
+
+    def in_flight(self) -> int:
+        with self._lock:
+            return len(self._calls)
+
+    def do(
+        self,
+        key: str,
+        fn: Callable[[], Any],
+        on_wait: Optional[Callable[[], None]] = None,
+    ) -> Tuple[Any, bool]:
+        """
+        Returns (result, shared). shared=True means another caller's result was reused.
+
+        If the leader fails, its error is not handed to waiters (it may be caller-specific,
+        e.g. insufficient credits): one waiter becomes the new leader and retries.
+        """
+        while True:
+            with self._lock:
+                call = self._calls.get(key)
+                leader = call is None
+                if leader:
+                    call = self._calls[key] = _Call()
+
+            if leader:
+                try:
+                    call.result = fn()
+                    return call.result, False
+                except BaseException as e:
+                    call.error = e
+                    raise
+                finally:
+                    with self._lock:
+                        self._calls.pop(key, None)
+                    call.done.set()
+
+            if on_wait:
+                on_wait()
+            call.done.wait()
+            if call.error is None:
+                return call.result, True
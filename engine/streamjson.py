@@ -0,0 +1,133 @@
+# engine/streamjson.py
+# Incremental parser for the analysis JSON while the model is still writing it.
+#
+#   {"score": 62, "riskSummary": "...", "clauses": [{...}, {...}], "originalContent": "..."}
+#
+# feed(delta) returns the members completed by that delta, in order:
+#   ("clause", dict)  every complete element of the top-level "clauses" array
+#   (key, value)      every other complete top-level member (score, riskSummary, ...)
+# The caller keeps the full text and parses it once more at the end, so nothing here
+# decides what gets persisted; a member that fails to parse is simply not emitted.
+
+import json
+from typing import Any, List, Optional, Tuple
+
+_WS = " \t\r\n"
+
+
+class AnalysisStreamParser:
+    def __init__(self, array_key: str = "clauses", item_event: str = "clause"):
+        self.array_key = array_key
+        self.item_event = item_event
+        self._buf = ""
+        self._pos = 0
+        self._started = False
+        self._done = False
+        self._depth = 0
+        self._in_str = False
+        self._esc = False
+        # top-level member state: key -> key_str -> colon -> value -> (str_value | scalar | container) -> after
+        self._state = "key"
+        self._key: Optional[str] = None
+        self._start = 0          # start of the current key / value
+        self._in_items = False   # inside the top-level array_key array
+        self._item_start: Optional[int] = None
+
+    @property
+    def text(self) -> str:
+        return self._buf
+
+    def feed(self, delta: str) -> List[Tuple[str, Any]]:
+        self._buf += delta or ""
+        out: List[Tuple[str, Any]] = []
+        buf = self._buf
+        i = self._pos
+        n = len(buf)
+
+        while i < n and not self._done:
+            ch = buf[i]
+
+            if not self._started:
+                # skip ```json fences / chatter before the object
+                if ch == "{":
+                    self._started = True
+                    self._depth = 1
+                i += 1
+                continue
+
+            if self._in_str:
+                if self._esc:
+                    self._esc = False
+                elif ch == "\\":
+                    self._esc = True
+                elif ch == '"':
+                    self._in_str = False
+                    if self._depth == 1:
+                        if self._state == "key_str":
+                            self._key = self._loads(buf[self._start:i + 1])
+                            self._state = "colon"
+                        elif self._state == "str_value":
+                            self._emit(out, self._key, buf[self._start:i + 1])
+                            self._state = "after"
+                i += 1
+                continue
+
+            if self._depth == 1 and self._state == "scalar" and ch in ",}":
+                self._emit(out, self._key, buf[self._start:i].strip())
+                self._state = "after"
+
+            if ch == '"':
+                self._in_str = True
+                if self._depth == 1 and self._state == "key":
+                    self._start = i
+                    self._state = "key_str"
+                elif self._depth == 1 and self._state == "value":
+                    self._start = i
+                    self._state = "str_value"
+            elif ch in "{[":
+                if self._depth == 1 and self._state == "value":
+                    self._start = i
+                    self._state = "container"
+                    self._in_items = ch == "[" and self._key == self.array_key
+                elif self._depth == 2 and self._in_items and ch == "{":
+                    self._item_start = i
+                self._depth += 1
+            elif ch in "}]":
+                self._depth -= 1
+                if self._depth == 2 and self._in_items and ch == "}" and self._item_start is not None:
+                    self._emit(out, self.item_event, buf[self._item_start:i + 1])
+                    self._item_start = None
+                elif self._depth == 1 and self._state == "container":
+                    if not self._in_items:
+                        self._emit(out, self._key, buf[self._start:i + 1])
+                    self._in_items = False
+                    self._state = "after"
+                elif self._depth == 0:
+                    self._done = True
+            elif self._depth == 1:
+                if ch == ":" and self._state == "colon":
+                    self._state = "value"
+                elif ch == "," and self._state == "after":
+                    self._state = "key"
+                elif self._state == "value" and ch not in _WS:
+                    self._start = i
+                    self._state = "scalar"
+            i += 1
+
+        self._pos = i
+        return out
+
+    @staticmethod
+    def _loads(s: str) -> Any:
+        try:
+            return json.loads(s)
+        except ValueError:
+            return None
+
+    def _emit(self, out: List[Tuple[str, Any]], name: Optional[str], raw: str):
+        if name is None:
+            return
+        try:
+            out.append((name, json.loads(raw)))
+        except ValueError:
+            pass
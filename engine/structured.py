@@ -0,0 +1,90 @@
+# engine/structured.py
+# Structured (JSON-schema-constrained) model output: schema building and field-level checks.
+#
+# - strict_json_schema: turn a pydantic JSON schema into the strict form OpenAI's
+#   response_format={"type": "json_schema", "strict": true} accepts
+#   (every property required, no additional properties, no titles / defaults).
+# - coerce_*: cheap local repairs of the usual drift (score as "72分", level as "高"/"high"),
+#   so only fields that cannot be repaired locally are sent back to the model.
+
+import copy
+import re
+from typing import Any, Dict, Optional
+
+_DROP_KEYS = ("title", "default", "examples")
+
+_LEVEL_ALIASES = {
+    "HIGH": "HIGH", "H": "HIGH", "高": "HIGH", "高风险": "HIGH", "严重": "HIGH",
+    "MEDIUM": "MEDIUM", "MED": "MEDIUM", "MIDDLE": "MEDIUM", "M": "MEDIUM", "中": "MEDIUM", "中风险": "MEDIUM",
+    "LOW": "LOW", "L": "LOW", "低": "LOW", "低风险": "LOW",
+}
+
+_NUMBER_RE = re.compile(r"-?\d+(?:\.\d+)?")
+
+
+def strict_json_schema(schema: Dict[str, Any]) -> Dict[str, Any]:
+    out = copy.deepcopy(schema)
+
+    def walk(node: Any):
+        if isinstance(node, list):
+            for v in node:
+                walk(v)
+            return
+        if not isinstance(node, dict):
+            return
+        for k in _DROP_KEYS:
+            node.pop(k, None)
+        props = node.get("properties")
+        if isinstance(props, dict):
+            # property names (RiskClause has one called "title") are not keywords: walk their schemas only
+            node["required"] = list(props.keys())
+            node["additionalProperties"] = False
+            for v in props.values():
+                walk(v)
+        for k in ("$defs", "definitions"):
+            if isinstance(node.get(k), dict):
+                for v in node[k].values():
+                    walk(v)
+        for k in ("items", "anyOf", "allOf", "oneOf"):
+            if k in node:
+                walk(node[k])
+
+    walk(out)
+    return out
+
+
+def response_format(name: str, schema: Dict[str, Any]) -> Dict[str, Any]:
+    return {"type": "json_schema", "json_schema": {"name": name, "strict": True, "schema": schema}}
+
+
+def coerce_score(v: Any) -> Optional[float]:
+    """
+    0..100 from a number or a numeric string ("72", "72分", "72/100"); None if there is no number.
+    """
+    if isinstance(v, bool):
+        return None
+    if isinstance(v, (int, float)):
+        x = float(v)
+    elif isinstance(v, str):
+        m = _NUMBER_RE.search(v)
+        if not m:
+            return None
+        x = float(m.group(0))
+    else:
+        return None
+    return max(0.0, min(100.0, x))
+
+
+def coerce_level(v: Any) -> Optional[str]:
+    if not isinstance(v, str):
+        return None
+    return _LEVEL_ALIASES.get(v.strip().upper()) or _LEVEL_ALIASES.get(v.strip())
+
+
+def coerce_text(v: Any) -> Optional[str]:
+    # numbers are fine as text; containers / null are not
+    if isinstance(v, str):
+        return v.strip()
+    if isinstance(v, (int, float)) and not isinstance(v, bool):
+        return str(v)
+    return None
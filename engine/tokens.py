@@ -0,0 +1,74 @@
+# engine/tokens.py
+# Token accounting for single-pass / chunk budgets.
+#
+# Uses tiktoken when it is installed (TOKENIZER_ENCODING, default o200k_base — the gpt-4o /
+# gpt-4.1 family), otherwise a CJK-aware heuristic. tiktoken downloads its BPE file on first
+# use; if that fails (offline box) the heuristic is used and tokenizer_name() says so, with the
+# reason; the choice is also exported as the "tokens.tokenizer" gauge (engine.metrics).
+
+import os
+import re
+import threading
+from typing import Any, Optional
+
+from .metrics import metrics
+
+TOKENIZER_ENCODING = os.getenv("TOKENIZER_ENCODING", "o200k_base")
+
+# CJK ideographs + CJK/full-width punctuation: roughly one token per character.
+_CJK_RE = re.compile(r"[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uff00-\uffef]")
+
+_lock = threading.Lock()
+_encoding: Optional[Any] = None
+_fallback_reason = ""
+_loaded = False
+
+
+def _get_encoding() -> Optional[Any]:
+    global _encoding, _fallback_reason, _loaded
+    if not _loaded:
+        with _lock:
+            if not _loaded:
+                try:
+                    import tiktoken
+                    _encoding = tiktoken.get_encoding(TOKENIZER_ENCODING)
+                except ImportError:
+                    _encoding, _fallback_reason = None, "tiktoken not installed"
+                except Exception as e:
+                    _encoding, _fallback_reason = None, f"{TOKENIZER_ENCODING} unavailable: {type(e).__name__}"
+                _loaded = True
+                metrics.set("tokens.tokenizer", tokenizer_name())
+                if _encoding is None:
+                    metrics.inc("tokens.heuristic_fallback")
+    return _encoding
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Cheap token estimate: 1 per CJK char, ~4 chars per token for everything else.
+    """
+    if not text:
+        return 0
+    cjk = len(_CJK_RE.findall(text))
+    rest = len(text) - cjk
+    return cjk + (rest + 3) // 4
+
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    enc = _get_encoding()
+    if enc is None:
+        return estimate_tokens(text)
+    # special-token text inside a contract is just text
+    return len(enc.encode(text, disallowed_special=()))
+
+
+def tokenizer_name() -> str:
+    if _get_encoding() is not None:
+        return f"tiktoken:{TOKENIZER_ENCODING}"
+    return f"heuristic ({_fallback_reason})"
+
+
+def is_exact() -> bool:
+    return _get_encoding() is not None
@@ -7,34 +7,63 @@
 # - prompt_version persisted + migrated
 # - history returns promptVersion
 
-from fastapi import FastAPI, HTTPException, Header, UploadFile, File, Form
+from fastapi import FastAPI, HTTPException, Header, UploadFile, File, Form, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import Response
+from fastapi.responses import Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
+from fastapi.concurrency import run_in_threadpool
 import uuid
-from pydantic import BaseModel
-from typing import Literal, List, Optional, Any, Dict, Tuple
+from pydantic import BaseModel, ValidationError
+from typing import Literal, List, Optional, Any, Dict, Tuple, Callable
 import json, os, hashlib
+import contextlib
+import functools
+import threading
+import queue
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 import urllib.request
 import urllib.parse
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import re
-import fitz  # pymupdf
-from docx import Document
 import io
-from openai import OpenAI
 
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, LargeBinary, delete
+from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, LargeBinary, UniqueConstraint, delete, func, select, tuple_
 from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy.exc import IntegrityError
 
 from passlib.context import CryptContext
 import jwt
 
 from prompts.registry import PROMPT_VERSION, validate_contract_type, build_system_prompt
+from engine.blobstore import BlobStore
+from engine.concurrency import AsyncHandoff, run_ordered, TaskTimeoutError
+from engine.filerange import (
+    RangeNotSatisfiable, etag_matches, http_date, iter_file, not_modified_since, parse_range,
+)
+from engine.extract import (
+    ExtractionError, ExtractionMemoryError, ExtractionPool, ExtractionTimeout, iter_docx_blocks, iter_pdf_pages,
+)
+from engine.imageprep import available as imageprep_available, duplicate_positions, page_signature, prepare_image
+from engine.llm import LLMError, LLMTimeoutError, make_provider
+from engine.lru import LRUCache
+from engine.metrics import metrics
+from engine.queryplan import audit as audit_query_plans
+from engine.progress import progress_hub
+from engine.resilience import CircuitBreaker, CircuitOpenError, ResilientProvider
+from engine.merge import merge_chunk_results_local, build_summary_merge_messages
+from engine.segmenter import Chunk, StreamingPacker, chunk_contract
+from engine.singleflight import SingleFlight
+from engine.structured import coerce_level, coerce_score, coerce_text, response_format, strict_json_schema
+from engine.streamjson import AnalysisStreamParser
+from engine.tokens import count_tokens, is_exact as tokenizer_is_exact, tokenizer_name
 
 APP_DIR = os.path.dirname(os.path.abspath(__file__))
-DB_PATH = os.path.join(APP_DIR, "contract_ai.db")
+DB_PATH = os.getenv("CONTRACT_AI_DB", os.path.join(APP_DIR, "contract_ai.db"))
 DATABASE_URL = f"sqlite:///{DB_PATH}"
+# 上传的原文件按 sha256 存在磁盘上（同内容只存一份，引用计数见 blobs 表），不再放进 analyses 表
+BLOB_DIR = os.getenv("BLOB_DIR", os.path.join(APP_DIR, "blobs"))
 
 JWT_SECRET = os.getenv("JWT_SECRET", "change-me-now")
 JWT_ALG = "HS256"
@@ -42,8 +71,91 @@ JWT_EXPIRE_HOURS = 24
 WECHAT_APPID = os.getenv("WECHAT_APPID", "")
 WECHAT_SECRET = os.getenv("WECHAT_SECRET", "")
 
-# OpenAI
-client = OpenAI()
+# LLM：openai（默认）| fake（进程内假模型，离线压测用，见 engine/llm.py 的 FAKE_LLM_* 配置）
+LLM_PROVIDER = os.getenv("LLM_PROVIDER", "openai")
+ANALYSIS_MODEL = os.getenv("ANALYSIS_MODEL", "gpt-4.1-mini")
+OCR_MODEL = os.getenv("OCR_MODEL", "gpt-4o-mini")
+OCR_PROMPT = "请对图片进行OCR，输出完整可读的中文合同文本。只输出纯文本，不要解释。"
+# 多图 OCR：每次调用最多 OCR_BATCH_SIZE 张（1~5），各批并发发送，按页序拼接；
+# OCR_PER_PAGE=1 则每页单独调用（某一页失败只重试这一页）
+OCR_BATCH_SIZE = max(1, min(5, int(os.getenv("OCR_BATCH_SIZE", "5"))))
+OCR_PER_PAGE = os.getenv("OCR_PER_PAGE", "0").strip().lower() in ("1", "true", "yes")
+OCR_CONCURRENCY = int(os.getenv("OCR_CONCURRENCY", "9"))
+OCR_TIMEOUT_SECONDS = float(os.getenv("OCR_TIMEOUT_SECONDS", "120"))
+# 批量拍照上传：每收到一页就在后台 OCR（finalize 只需拼接文本再分析）；0 = finalize 时统一 OCR
+OCR_PREFETCH = os.getenv("OCR_PREFETCH", "1").strip().lower() in ("1", "true", "yes")
+OCR_PREFETCH_WORKERS = int(os.getenv("OCR_PREFETCH_WORKERS", "8"))
+# OCR 前图片预处理（engine/imageprep.py，需要 Pillow）：EXIF 旋正、灰度、长边缩到 IMAGE_MAX_SIDE、
+# 重新压缩为 JPEG/WebP；近似重复的页面（同一页传了两次）只识别一次，IMAGE_DEDUPE_DISTANCE=-1 关闭
+IMAGE_PREP = os.getenv("IMAGE_PREP", "1").strip().lower() in ("1", "true", "yes")
+IMAGE_MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", "2000"))
+IMAGE_FORMAT = os.getenv("IMAGE_FORMAT", "jpeg").strip().lower()  # jpeg | webp
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "80"))
+IMAGE_GRAYSCALE = os.getenv("IMAGE_GRAYSCALE", "1").strip().lower() in ("1", "true", "yes")
+IMAGE_DEDUPE_DISTANCE = int(os.getenv("IMAGE_DEDUPE_DISTANCE", "4"))  # dHash 位差（共 256 位），命中后再比对缩略图像素
+# 没装 Pillow 时预处理和去重都不生效（图片原样上传）：/v1/metrics 的 gauges["imageprep.available"] = 0，
+# 原样送出的图片计入 imageprep.passthrough；IMAGE_PREP_REQUIRED=1 时没有 Pillow 直接启动失败
+IMAGE_PREP_REQUIRED = os.getenv("IMAGE_PREP_REQUIRED", "0").strip().lower() in ("1", "true", "yes")
+if IMAGE_PREP and IMAGE_PREP_REQUIRED and not imageprep_available():
+    raise RuntimeError("IMAGE_PREP_REQUIRED is set but Pillow is not installed")
+OCR_PDF_DPI = int(os.getenv("OCR_PDF_DPI", "150"))
+# 上传文件的文本提取结果按 (文件 sha256, EXTRACTOR_VERSION) 存一份（extracted_texts 表），
+# 同一文件换身份 / 换合同类型 / 提示词升级后再分析都直接复用；提取逻辑有改动时升级版本号
+EXTRACTOR_VERSION = "3"  # 3: DOCX 按正文顺序直读 document.xml，带自动编号
+# PDF 逐页判断：文本层 >= PDF_TEXT_PAGE_MIN_CHARS 字的页直接取文本；图片覆盖 >= PDF_IMAGE_MIN_COVERAGE
+# 且几乎没有文本层的页（扫描页 / 签字页 / 附件照片）渲染后 OCR；整页被扫描图覆盖（>= PDF_SCAN_COVERAGE）
+# 而文本层不足 200 字的也按扫描页处理。超出页数上限的页不处理，在 meta.skippedPages 里列出
+PDF_MAX_PAGES = int(os.getenv("PDF_MAX_PAGES", "300"))
+PDF_MAX_OCR_PAGES = int(os.getenv("PDF_MAX_OCR_PAGES", "50"))
+PDF_TEXT_PAGE_MIN_CHARS = int(os.getenv("PDF_TEXT_PAGE_MIN_CHARS", "30"))
+PDF_IMAGE_MIN_COVERAGE = float(os.getenv("PDF_IMAGE_MIN_COVERAGE", "0.05"))
+PDF_SCAN_COVERAGE = float(os.getenv("PDF_SCAN_COVERAGE", "0.6"))
+# PDF/DOCX 解析放到独立子进程（engine/extract.py），不占请求线程；同时最多 EXTRACT_WORKERS 个，
+# 每个限时 EXTRACT_TIMEOUT_SECONDS、限内存 EXTRACT_MEMORY_MB（超了直接杀掉）；0 = 在当前线程解析
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", "2"))
+EXTRACT_TIMEOUT_SECONDS = float(os.getenv("EXTRACT_TIMEOUT_SECONDS", "60"))
+EXTRACT_MEMORY_MB = int(os.getenv("EXTRACT_MEMORY_MB", "1024"))
+# 长 PDF 边解析边分块：确定要分块后，凑满一块就先发模型调用，不必等最后一页解析/识别完
+STREAM_CHUNKS = os.getenv("STREAM_CHUNKS", "1").strip().lower() in ("1", "true", "yes")
+# OCR 结果持久缓存（ocr_cache 表）：key = 图片 sha256 + OCR 模型/提示词/预处理参数，
+# 重拍一页后整批重传、同一份扫描件换身份再分析，都只识别变了的页；超过条数按最久未用淘汰
+OCR_CACHE = os.getenv("OCR_CACHE", "1").strip().lower() in ("1", "true", "yes")
+OCR_CACHE_MAX_ENTRIES = int(os.getenv("OCR_CACHE_MAX_ENTRIES", "50000"))
+# 每次模型调用都经过 engine/resilience.py：可重试错误（超时/连接/429/5xx）抖动退避重试；
+# 连续失败达到阈值后熔断（快速失败 503），冷却后放行一次试探调用；可选对慢调用发对冲请求
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+LLM_BACKOFF_BASE_SECONDS = float(os.getenv("LLM_BACKOFF_BASE_SECONDS", "0.5"))
+LLM_BACKOFF_MAX_SECONDS = float(os.getenv("LLM_BACKOFF_MAX_SECONDS", "8"))
+LLM_HEDGE_AFTER_SECONDS = float(os.getenv("LLM_HEDGE_AFTER_SECONDS", "0"))  # 0 = no hedging
+LLM_BREAKER_THRESHOLD = int(os.getenv("LLM_BREAKER_THRESHOLD", "5"))
+LLM_BREAKER_COOLDOWN_SECONDS = float(os.getenv("LLM_BREAKER_COOLDOWN_SECONDS", "30"))
+# 模型输出不是合法 JSON 时，让模型修正自己的输出的次数
+ANALYSIS_JSON_REPAIRS = int(os.getenv("ANALYSIS_JSON_REPAIRS", "1"))
+# 输出模式：json_schema = 按 RiskClause / OUTPUT_TEMPLATE 生成的严格 JSON Schema 约束输出（默认）；
+# json_object = 只保证输出是 JSON；text = 仅靠提示词约束
+ANALYSIS_OUTPUT_MODE = os.getenv("ANALYSIS_OUTPUT_MODE", "json_schema").strip().lower()
+# 字段缺失/不合法且本地修不好时，只把这些字段发回模型修正的次数
+ANALYSIS_SCHEMA_REPAIRS = int(os.getenv("ANALYSIS_SCHEMA_REPAIRS", "1"))
+llm_breaker = CircuitBreaker(LLM_BREAKER_THRESHOLD, LLM_BREAKER_COOLDOWN_SECONDS)
+llm = ResilientProvider(
+    make_provider(LLM_PROVIDER),
+    max_retries=LLM_MAX_RETRIES,
+    backoff_base=LLM_BACKOFF_BASE_SECONDS,
+    backoff_max=LLM_BACKOFF_MAX_SECONDS,
+    hedge_after=LLM_HEDGE_AFTER_SECONDS,
+    breaker=llm_breaker,
+)
+
+
+def _call_deadline(timeout: float, calls: int = 1) -> float:
+    # 在线程池外等一次（或 calls 次）模型调用的上限：每次尝试都超时 + 最大退避 + 对冲延迟（见 ResilientProvider）
+    per_call = llm.max_call_seconds(timeout) if isinstance(llm, ResilientProvider) else timeout
+    return calls * per_call
+
+
+def _chunk_deadline() -> float:
+    # 一个分块 = 分析调用 + 至多 ANALYSIS_JSON_REPAIRS 次 JSON 修正 + ANALYSIS_SCHEMA_REPAIRS 次字段补问
+    return _call_deadline(CHUNK_TIMEOUT_SECONDS, 1 + ANALYSIS_JSON_REPAIRS + ANALYSIS_SCHEMA_REPAIRS)
 
 pwd_context = CryptContext(schemes=["pbkdf2_sha256"], deprecated="auto")
 
@@ -53,9 +165,29 @@ Base = declarative_base()
 
 # ---- Limits ----
 MAX_UPLOAD_BYTES = 50 * 1024 * 1024  # 50MB
-MAX_TEXT_CHARS = 80_000
-CHUNK_CHARS = 20_000  # per chunk
-MAX_CHUNKS = 12        # safeguard (12 * 20k = 240k chars)
+# 原文件下载按块流式发送（支持 Range 断点续传 / ETag 304）
+DOWNLOAD_CHUNK_BYTES = int(os.getenv("DOWNLOAD_CHUNK_BYTES", str(256 * 1024)))
+# 预算都按 token 计（engine/tokens.py：装了 tiktoken 用真实分词器，否则按中文字符估算），
+# 且都是“一次模型调用的完整输入”：系统提示词 + 合同正文（分块时再加分块标题和上文衔接）
+# 整份合同 + 系统提示词不超过 SINGLE_PASS_TOKENS 时单次分析，否则分块
+SINGLE_PASS_TOKENS = int(os.getenv("SINGLE_PASS_TOKENS", "80000"))
+# 估算时中英混排/数字偏差较大：启动时就加载分词器，当前用的是哪个看 /v1/metrics 的
+# gauges["tokens.tokenizer"]（估算时带原因）；TOKENIZER_REQUIRED=1 时没有 tiktoken 直接启动失败
+TOKENIZER_REQUIRED = os.getenv("TOKENIZER_REQUIRED", "0").strip().lower() in ("1", "true", "yes")
+if not tokenizer_is_exact() and TOKENIZER_REQUIRED:
+    raise RuntimeError(f"TOKENIZER_REQUIRED is set but the tokenizer is {tokenizer_name()}")
+# 分块按条款边界打包（不再按固定 20k 字符硬切），每次分块调用不超过 CHUNK_TOKENS
+CHUNK_TOKENS = int(os.getenv("CHUNK_TOKENS", "16000"))
+CHUNK_OVERLAP_CHARS = int(os.getenv("CHUNK_OVERLAP_CHARS", "300"))
+MAX_CHUNKS = 12        # safeguard: longer documents get bigger chunks, never silently dropped text
+MAX_CHUNK_TOKENS = int(os.getenv("MAX_CHUNK_TOKENS", "60000"))  # hard ceiling per chunk call
+# 分块并发：上限默认等于 MAX_CHUNKS（整份合同约等于一次分块调用 + 一次合并）
+CHUNK_CONCURRENCY = int(os.getenv("CHUNK_CONCURRENCY", str(MAX_CHUNKS)))
+CHUNK_TIMEOUT_SECONDS = float(os.getenv("CHUNK_TIMEOUT_SECONDS", "120"))
+# 已完成的分块结果在进程内保留（LRU），某一块失败后重试整份合同时不必重做其余分块
+CHUNK_MEMO_SIZE = int(os.getenv("CHUNK_MEMO_SIZE", "256"))
+# 分块合并：local = 本地去重/排序/评分（无额外模型调用）；llm = 另外让模型只重写 riskSummary
+MERGE_MODE = os.getenv("MERGE_MODE", "local").strip().lower()
 
 
 class User(Base):
@@ -83,12 +215,39 @@ class Analysis(Base):
 
     original_content = Column(Text, nullable=False)
     result_json = Column(Text, nullable=False)
+    # result_json 里的 score 冗余一份：历史列表只查小字段，不读 result_json / 原文
+    score = Column(Integer, nullable=True)
 
     file_name = Column(String(255), nullable=True)
     file_mime = Column(String(100), nullable=True)
-    file_bytes = Column(LargeBinary, nullable=True)
+    # 原文件在 BLOB_DIR 里（blobs 表记引用数）；旧库的 file_bytes 列启动时迁出
+    file_sha = Column(String(64), index=True, nullable=True)
+    file_size = Column(Integer, nullable=True)
     display_name = Column(String(255), nullable=True)
+    # 上传文件的原文引用 extracted_texts（此时 original_content 留空，不再重复存一份）
+    extracted_text_id = Column(Integer, index=True, nullable=True)
+
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+
+class Blob(Base):
+    __tablename__ = "blobs"
+    id = Column(Integer, primary_key=True)
+    sha256 = Column(String(64), unique=True, index=True, nullable=False)
+    size = Column(Integer, nullable=False)
+    refcount = Column(Integer, nullable=False, default=0)  # 引用它的 analyses 行数，归零即删文件
+    created_at = Column(DateTime, default=datetime.utcnow)
+
 
+class ExtractedText(Base):
+    __tablename__ = "extracted_texts"
+    __table_args__ = (UniqueConstraint("file_sha", "extractor_version", name="uq_extracted_texts_sha_version"),)
+    id = Column(Integer, primary_key=True)
+    file_sha = Column(String(64), nullable=False)
+    extractor_version = Column(String(100), nullable=False)  # _extractor_version(kind)
+    kind = Column(String(16), nullable=False)  # docx / pdf / image
+    text = Column(Text, nullable=False)
+    meta_json = Column(Text, nullable=True)  # PDF：totalPages / textPages / ocrPages / skippedPages ...
     created_at = Column(DateTime, default=datetime.utcnow)
 
 class UploadBatch(Base):
@@ -113,10 +272,63 @@ class UploadBatchFile(Base):
     file_mime = Column(String(100), nullable=True)
     file_bytes = Column(LargeBinary, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
+    # 后台逐页 OCR 的结果（上传即开始识别）；ocr_sha = 识别时图片的 sha256，重传该页会清空
+    ocr_text = Column(Text, nullable=True)
+    ocr_status = Column(String(16), nullable=True)  # PENDING / DONE / FAILED
+    ocr_sha = Column(String(64), nullable=True)
+
+class OcrCacheEntry(Base):
+    __tablename__ = "ocr_cache"
+    id = Column(Integer, primary_key=True)
+    # sha256(_ocr_cache_version() | 每张图的 sha256)；一次调用识别多张图时整组作为一条
+    cache_key = Column(String(64), unique=True, index=True, nullable=False)
+    ocr_model = Column(String(100), nullable=False)
+    pages = Column(Integer, nullable=False, default=1)
+    text = Column(Text, nullable=False)
+    hits = Column(Integer, nullable=False, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    last_used_at = Column(DateTime, index=True, default=datetime.utcnow)
 
 class BatchFinalizeRequest(BaseModel):
     batch_id: str
 
+
+# =========================
+# Analysis Jobs (async submit/poll)
+# =========================
+class AnalysisJob(Base):
+    __tablename__ = "analysis_jobs"
+    id = Column(Integer, primary_key=True)
+    job_id = Column(String(64), unique=True, index=True, nullable=False)
+    user_id = Column(Integer, index=True, nullable=False)
+
+    kind = Column(String(16), nullable=False)  # text / upload / batch
+    status = Column(String(16), nullable=False, default="QUEUED")  # QUEUED / RUNNING / SUCCEEDED / FAILED
+    stage = Column(String(32), nullable=False, default="queued")
+    progress = Column(Integer, nullable=False, default=0)  # 0..100
+
+    contract_type = Column(String(100), nullable=False)
+    identity = Column(String(1), nullable=False)
+
+    # 任务输入（完成后清空）
+    input_text = Column(Text, nullable=True)
+    file_name = Column(String(255), nullable=True)
+    file_mime = Column(String(100), nullable=True)
+    file_bytes = Column(LargeBinary, nullable=True)
+    batch_id = Column(String(64), nullable=True)
+
+    # 提交时预留额度，完成时结算：成功 -> SETTLED；失败/命中自己的缓存 -> REFUNDED
+    credits_reserved = Column(Integer, nullable=False, default=0)
+    credit_state = Column(String(16), nullable=False, default="RESERVED")  # RESERVED / SETTLED / REFUNDED
+
+    analysis_id = Column(Integer, nullable=True)
+    result_json = Column(Text, nullable=True)  # final AnalysisResult
+    error = Column(Text, nullable=True)
+
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True)
+
 # =========================
 # Share (NEW)
 # =========================
@@ -156,11 +368,18 @@ def _migrate_sqlite_schema():
     Base.metadata.create_all(bind=engine)
     _sqlite_add_column_if_missing("analyses", "file_name", "TEXT")
     _sqlite_add_column_if_missing("analyses", "file_mime", "TEXT")
-    _sqlite_add_column_if_missing("analyses", "file_bytes", "BLOB")
+    _sqlite_add_column_if_missing("analyses", "file_sha", "TEXT")
+    _sqlite_add_column_if_missing("analyses", "file_size", "INTEGER")
     _sqlite_add_column_if_missing("analyses", "prompt_version", "TEXT")
     _sqlite_add_column_if_missing("analyses", "display_name", "TEXT")
+    _sqlite_add_column_if_missing("analyses", "extracted_text_id", "INTEGER")
+    _sqlite_add_column_if_missing("analyses", "score", "INTEGER")
+    _sqlite_add_column_if_missing("extracted_texts", "meta_json", "TEXT")
     _sqlite_add_column_if_missing("upload_batches", "created_at", "DATETIME")
     _sqlite_add_column_if_missing("upload_batch_files", "created_at", "DATETIME")
+    _sqlite_add_column_if_missing("upload_batch_files", "ocr_text", "TEXT")
+    _sqlite_add_column_if_missing("upload_batch_files", "ocr_status", "TEXT")
+    _sqlite_add_column_if_missing("upload_batch_files", "ocr_sha", "TEXT")
     _sqlite_add_column_if_missing("users", "phone", "TEXT")
     _sqlite_add_column_if_missing("users", "display_name", "TEXT")
     _sqlite_add_column_if_missing("users", "avatar_url", "TEXT")
@@ -171,11 +390,202 @@ def _migrate_sqlite_schema():
         conn.exec_driver_sql("CREATE UNIQUE INDEX IF NOT EXISTS ix_users_phone ON users (phone);")
         conn.exec_driver_sql("CREATE UNIQUE INDEX IF NOT EXISTS ix_analysis_shares_share_id ON analysis_shares (share_id);")
         conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_analysis_shares_expires_at ON analysis_shares (expires_at);")
+        conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_analysis_jobs_status ON analysis_jobs (status);")
+        conn.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_analyses_file_sha ON analyses (file_sha);")
+        # 历史列表的覆盖索引：列表字段都在索引里，不用回表（回表要跨过 original_content / result_json 的溢出页）
+        conn.exec_driver_sql(
+            "CREATE INDEX IF NOT EXISTS ix_analyses_history ON analyses "
+            "(user_id, created_at, id, contract_type, identity, score, display_name, file_sha);"
+        )
+        # 分析缓存探测（每次分析都查）：等值列在前，created_at 排序，id 取回 —— 覆盖索引
+        conn.exec_driver_sql(
+            "CREATE INDEX IF NOT EXISTS ix_analyses_cache_probe ON analyses "
+            "(content_hash, contract_type, identity, prompt_version, user_id, created_at, id);"
+        )
+        # 全局探测（不带 user_id）：user_id 夹在等值列和 created_at 之间会让上面的索引排不了序
+        # （USE TEMP B-TREE FOR ORDER BY），所以单独一条不含 user_id 的覆盖索引
+        conn.exec_driver_sql(
+            "CREATE INDEX IF NOT EXISTS ix_analyses_cache_probe_global ON analyses "
+            "(content_hash, contract_type, identity, prompt_version, created_at, id);"
+        )
+        # 删除分析时检查 extracted_texts 是否还有别的记录引用
+        conn.exec_driver_sql(
+            "CREATE INDEX IF NOT EXISTS ix_analyses_extracted_text_id ON analyses (extracted_text_id);"
+        )
+        # 多图上传：按 (user_id, batch_id) 找批次，按 idx 取页
+        conn.exec_driver_sql(
+            "CREATE INDEX IF NOT EXISTS ix_upload_batches_user_batch ON upload_batches (user_id, batch_id);"
+        )
+        conn.exec_driver_sql(
+            "CREATE INDEX IF NOT EXISTS ix_upload_batch_files_user_batch_idx "
+            "ON upload_batch_files (user_id, batch_id, idx);"
+        )
+    _backfill_analysis_scores()
+
+
+def _backfill_analysis_scores():
+    # 旧记录的 score 只在 result_json 里：一次性回填（JSON1 一条 UPDATE；没有 JSON1 时逐行解析）
+    with engine.begin() as conn:
+        try:
+            conn.exec_driver_sql(
+                "UPDATE analyses SET score = CAST(ROUND(COALESCE(json_extract(result_json, '$.score'), 0)) AS INTEGER) "
+                "WHERE score IS NULL AND json_valid(result_json);"
+            )
+        except Exception:
+            rows = conn.exec_driver_sql("SELECT id, result_json FROM analyses WHERE score IS NULL;").fetchall()
+            for row_id, raw in rows:
+                try:
+                    score = int(round(float(json.loads(raw).get("score") or 0)))
+                except (ValueError, TypeError, AttributeError):
+                    continue
+                conn.exec_driver_sql("UPDATE analyses SET score = ? WHERE id = ?;", (score, row_id))
 
 
 _migrate_sqlite_schema()
 
 
+# =========================
+# File Blobs
+# =========================
+# 原文件存 BLOB_DIR/<sha[:2]>/<sha[2:4]>/<sha>，blobs 表记录每个 sha 被多少条 analyses 引用。
+# 加引用：写文件 + refcount+1 + 插入 analyses 行在同一事务里提交；减引用：删行 + refcount-1 同一事务，
+# 归零的 sha 在提交后删文件。两边都持有 _blob_store.lock(sha)，并发上传同一文件不会被误删。
+_blob_store = BlobStore(BLOB_DIR)
+
+
+def _blob_add_ref(db, data: bytes, sha: str) -> int:
+    """
+    Writes the file (if not stored yet) and adds one reference in db's open transaction.
+    The caller commits while still holding _blob_store.lock(sha). Returns the size.
+    """
+    existed = _blob_store.exists(sha)
+    _blob_store.put(data, sha)
+    metrics.inc("blob.put.dedup" if existed else "blob.put.new")
+    updated = (
+        db.query(Blob)
+        .filter(Blob.sha256 == sha)
+        .update({Blob.refcount: Blob.refcount + 1}, synchronize_session=False)
+    )
+    if not updated:
+        db.add(Blob(sha256=sha, size=len(data), refcount=1))
+    return len(data)
+
+
+def _blob_release(db, shas: List[str]) -> List[str]:
+    """
+    Drops one reference per entry (a sha may repeat) in db's open transaction and deletes
+    blobs rows that reach zero. Returns those shas: pass them to _blob_unlink after commit.
+    """
+    counts: Dict[str, int] = {}
+    for sha in shas:
+        if sha:
+            counts[sha] = counts.get(sha, 0) + 1
+    for sha, n in counts.items():
+        db.query(Blob).filter(Blob.sha256 == sha).update(
+            {Blob.refcount: Blob.refcount - n}, synchronize_session=False
+        )
+    if not counts:
+        return []
+    freed = [
+        sha for (sha,) in db.query(Blob.sha256).filter(Blob.sha256.in_(list(counts)), Blob.refcount <= 0)
+    ]
+    if freed:
+        db.query(Blob).filter(Blob.sha256.in_(freed)).delete(synchronize_session=False)
+    metrics.inc("blob.released", sum(counts.values()))
+    return freed
+
+
+def _extracted_text_release(db, ids: List[Optional[int]]) -> int:
+    """
+    In db's open transaction (after the analyses are deleted): deletes the extracted_texts rows
+    among ids that no analysis references any more. Call it holding _blob_store.lock_many() of
+    the deleted rows' file_sha, the lock _save_analysis holds while it links a row to one.
+    """
+    ids = list({i for i in ids if i})
+    if not ids:
+        return 0
+    db.flush()
+    referenced = select(Analysis.id).where(Analysis.extracted_text_id == ExtractedText.id).exists()
+    n = (
+        db.query(ExtractedText)
+        .filter(ExtractedText.id.in_(ids), ~referenced)
+        .delete(synchronize_session=False)
+    )
+    if n:
+        metrics.inc("extract.cache.released", n)
+    return n
+
+
+def _blob_unlink(shas: List[str]):
+    # 提交后再删文件；锁内再查一次，期间有新上传重新引用了它就保留
+    for sha in shas:
+        with _blob_store.lock(sha):
+            db = SessionLocal()
+            try:
+                if db.query(Blob.id).filter(Blob.sha256 == sha).first() is not None:
+                    continue
+            finally:
+                db.close()
+            if _blob_store.remove(sha):
+                metrics.inc("blob.unlinked")
+
+
+def _open_file_blob(sha: Optional[str]):
+    # 先打开再返回：下载过程中该文件即使被删除（引用归零），已打开的句柄仍可读完
+    if not sha:
+        return None
+    try:
+        return open(_blob_store.path(sha), "rb")
+    except FileNotFoundError:
+        # 引用还在但文件丢了：bench/migrate_blobs --fsck 会列出缺失的 sha
+        metrics.inc("blob.missing")
+        return None
+
+
+def _migrate_legacy_file_blobs(batch: int = 50) -> int:
+    """
+    Moves analyses.file_bytes (databases from before the blob store) into BLOB_DIR and
+    NULLs the column, batch by batch. Idempotent; returns the number of rows moved.
+    bench/migrate_blobs.py runs it too, then drops the column and VACUUMs.
+    """
+    with engine.connect() as conn:
+        cols = {r[1] for r in conn.exec_driver_sql("PRAGMA table_info(analyses);").fetchall()}
+    if "file_bytes" not in cols:
+        return 0
+    moved = 0
+    db = SessionLocal()
+    try:
+        while True:
+            # file_bytes 已不在 ORM 模型里，直接用 SQL
+            rows = db.connection().exec_driver_sql(
+                "SELECT id, file_bytes FROM analyses WHERE file_bytes IS NOT NULL LIMIT ?;", (batch,)
+            ).fetchall()
+            if not rows:
+                break
+            for row_id, data in rows:
+                if data:
+                    sha = hashlib.sha256(data).hexdigest()
+                    with _blob_store.lock(sha):
+                        size = _blob_add_ref(db, data, sha)
+                        db.connection().exec_driver_sql(
+                            "UPDATE analyses SET file_sha = ?, file_size = ?, file_bytes = NULL WHERE id = ?;",
+                            (sha, size, row_id),
+                        )
+                        db.commit()
+                else:
+                    db.connection().exec_driver_sql("UPDATE analyses SET file_bytes = NULL WHERE id = ?;", (row_id,))
+                    db.commit()
+                moved += 1
+        if moved:
+            metrics.inc("blob.migrated", moved)
+        return moved
+    finally:
+        db.close()
+
+
+_migrate_legacy_file_blobs()
+
+
 app = FastAPI()
 
 # ===== Static uploads (avatars) =====
@@ -258,6 +668,17 @@ class AnalysisResult(BaseModel):
     meta: Optional[Dict[str, Any]] = None
 
 OUTPUT_TEMPLATE = {"score": 0, "riskSummary": "", "originalContent": "", "clauses": []}
+MAX_OUTPUT_CLAUSES = 12
+
+# 结构化输出的 JSON Schema 由 OUTPUT_TEMPLATE / RiskClause 生成，与接口返回的模型保持一致
+_OUTPUT_FIELD_SCHEMAS: Dict[str, Dict[str, Any]] = {
+    "score": {"type": "number"},
+    "riskSummary": {"type": "string"},
+    "originalContent": {"type": "string"},
+    "clauses": {"type": "array", "items": RiskClause.model_json_schema()},
+}
+# section / originalText 缺失时记为空串即可；其余条款字段缺失则需要模型补全
+_CLAUSE_OPTIONAL_FIELDS = ("section", "originalText")
 
 _CONTROL_CHARS_RE = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f]")
 
@@ -421,9 +842,9 @@ def _seed_demo_analyses_if_needed(db, user_id: int):
             content_hash="demo_" + hashlib.sha256((d["display_name"]).encode("utf-8")).hexdigest(),
             original_content=d["original_content"],
             result_json=json.dumps(d["result_json"], ensure_ascii=False),
+            score=_row_score(d["result_json"]),
             file_name=None,
             file_mime=None,
-            file_bytes=None,
             display_name=d["display_name"],
         )
         db.add(row)
@@ -453,25 +874,234 @@ def _ensure_wechat_user(db, openid: str) -> User:
     _seed_demo_analyses_if_needed(db, u.id)
     return u
 
-def _analyze_text_once(extracted_text: str, contract_type: str, identity: str) -> Dict[str, Any]:
+_JSON_REPAIR_PROMPT = "上面的输出不是合法的 JSON。请按系统提示要求的结构重新输出完整、严格合法的 JSON，不要输出任何其他内容。"
+
+
+def _try_json_load(raw: str) -> Optional[dict]:
+    try:
+        return _safe_json_load(raw)
+    except ValueError:
+        pass
+    # 前后夹带说明文字 / 代码块没闭合：取最外层 {...}
+    start, end = raw.find("{"), raw.rfind("}")
+    if 0 <= start < end:
+        try:
+            parsed = _safe_json_load(raw[start:end + 1])
+            metrics.inc("analysis.json_repair.local")
+            return parsed
+        except ValueError:
+            pass
+    return None
+
+
+def _output_format(fields: Tuple[str, ...] = tuple(OUTPUT_TEMPLATE), name: str = "contract_analysis") -> Optional[Dict[str, Any]]:
     """
-    Single-pass analysis call.
+    response_format for ANALYSIS_OUTPUT_MODE, restricted to the given top-level fields.
     """
-    system = build_system_prompt(contract_type, identity)
-    resp = client.chat.completions.create(
-        model="gpt-4.1-mini",
-        temperature=0,
-        messages=[
-            {"role": "system", "content": system},
-            {"role": "user", "content": extracted_text},
-        ],
+    if ANALYSIS_OUTPUT_MODE == "json_schema":
+        schema = {"type": "object", "properties": {f: _OUTPUT_FIELD_SCHEMAS[f] for f in fields}}
+        return response_format(name, strict_json_schema(schema))
+    if ANALYSIS_OUTPUT_MODE == "json_object":
+        return {"type": "json_object"}
+    return None
+
+
+def _load_analysis_json(raw: str, messages: List[Dict[str, Any]], timeout: Optional[float]) -> Tuple[dict, str]:
+    """
+    Parse the model's JSON. If it is malformed, ask the model to fix its own output
+    (ANALYSIS_JSON_REPAIRS times) before giving up with a 502.
+    Returns (parsed, raw text it was parsed from).
+    """
+    parsed = _try_json_load(raw)
+    attempts = 0
+    while parsed is None and attempts < ANALYSIS_JSON_REPAIRS:
+        attempts += 1
+        metrics.inc("analysis.json_repair.reask")
+        raw = llm.chat(
+            ANALYSIS_MODEL,
+            messages + [
+                {"role": "assistant", "content": raw},
+                {"role": "user", "content": _JSON_REPAIR_PROMPT},
+            ],
+            timeout=timeout,
+            response_format=_output_format(),
+        )
+        parsed = _try_json_load(raw)
+    if parsed is None:
+        metrics.inc("analysis.json_repair.failed")
+        raise HTTPException(status_code=502, detail="Model returned malformed JSON")
+    return parsed, raw
+
+
+def _check_clause(c: Any) -> Optional[Dict[str, Any]]:
+    """
+    One clause against RiskClause, after local coercion (level "高"/"high" -> HIGH, numbers -> text).
+    None if it still is not a valid clause.
+    """
+    if not isinstance(c, dict):
+        return None
+    fixed: Dict[str, Any] = {}
+    for name in RiskClause.model_fields:
+        v = coerce_level(c.get(name)) if name == "level" else coerce_text(c.get(name))
+        if not v:
+            if name not in _CLAUSE_OPTIONAL_FIELDS:
+                return None
+            v = ""
+        fixed[name] = v
+    try:
+        return RiskClause.model_validate(fixed).model_dump()
+    except ValidationError:
+        return None
+
+
+def _check_analysis(parsed: Any) -> Tuple[Dict[str, Any], List[str], List[int]]:
+    """
+    Validate model output field by field in one pass.
+    Returns (result, invalid top-level fields, positions of invalid clauses); invalid clauses
+    are left in place (as the model wrote them) so a repair can replace them by position.
+    """
+    data = parsed if isinstance(parsed, dict) else {}
+    out = dict(OUTPUT_TEMPLATE)
+    bad_fields: List[str] = []
+
+    score = coerce_score(data.get("score"))
+    if score is None:
+        bad_fields.append("score")
+    else:
+        out["score"] = score
+    summary = coerce_text(data.get("riskSummary"))
+    if not summary:
+        bad_fields.append("riskSummary")
+    else:
+        out["riskSummary"] = summary
+    out["originalContent"] = coerce_text(data.get("originalContent")) or ""
+
+    clauses: List[Any] = []
+    bad_clauses: List[int] = []
+    raw_clauses = data.get("clauses")
+    if not isinstance(raw_clauses, list):
+        bad_fields.append("clauses")
+        raw_clauses = []
+    for i, c in enumerate(raw_clauses[:MAX_OUTPUT_CLAUSES]):
+        fixed = _check_clause(c)
+        if fixed is None:
+            bad_clauses.append(i)
+            clauses.append(c)
+        else:
+            clauses.append(fixed)
+    out["clauses"] = clauses
+    return out, bad_fields, bad_clauses
+
+
+def _repair_prompt(bad_fields: List[str], bad_clauses: List[int]) -> str:
+    problems = bad_fields + [f"clauses 第{i + 1}条" for i in bad_clauses]
+    ask = bad_fields + (["clauses"] if bad_clauses and "clauses" not in bad_fields else [])
+    prompt = (
+        f"上面输出中以下内容缺失或不合法：{'、'.join(problems)}。"
+        f"请只输出一个 JSON 对象，只包含字段：{', '.join(ask)}，其他字段不要重复输出。"
     )
-    raw = (resp.choices[0].message.content or "").strip()
-    parsed = _safe_json_load(raw)
+    if bad_clauses and "clauses" not in bad_fields:
+        prompt += (
+            f"其中 clauses 只需按顺序给出第 {'、'.join(str(i + 1) for i in bad_clauses)} 条修正后的完整条款"
+            "（section,title,originalText,explanation,suggestion,level(HIGH/MEDIUM/LOW)）。"
+        )
+    return prompt
 
-    merged = dict(OUTPUT_TEMPLATE)
-    if isinstance(parsed, dict):
-        merged.update(parsed)
+
+def _validate_analysis(
+    parsed: Any,
+    raw: str,
+    messages: List[Dict[str, Any]],
+    timeout: Optional[float],
+) -> Dict[str, Any]:
+    """
+    Schema-check the model output. Fields that cannot be fixed locally are re-asked on their own
+    (ANALYSIS_SCHEMA_REPAIRS times) instead of re-running the whole analysis; clauses that are
+    still invalid afterwards are dropped, and a score / riskSummary still missing keeps the
+    OUTPUT_TEMPLATE default (as before schema validation existed). Only unparseable output is a 502.
+    """
+    result, bad_fields, bad_clauses = _check_analysis(parsed)
+    attempts = 0
+    while (bad_fields or bad_clauses) and attempts < ANALYSIS_SCHEMA_REPAIRS:
+        attempts += 1
+        metrics.inc("analysis.schema.reask")
+        metrics.inc("analysis.schema.invalid_fields", len(bad_fields) + len(bad_clauses))
+        ask = tuple(bad_fields + (["clauses"] if bad_clauses and "clauses" not in bad_fields else []))
+        fix_raw = llm.chat(
+            ANALYSIS_MODEL,
+            messages + [
+                {"role": "assistant", "content": raw},
+                {"role": "user", "content": _repair_prompt(bad_fields, bad_clauses)},
+            ],
+            timeout=timeout,
+            response_format=_output_format(ask, "contract_analysis_fix"),
+        )
+        fix = _try_json_load(fix_raw)
+        if not isinstance(fix, dict):
+            continue
+
+        patched = dict(result)
+        for f in ("score", "riskSummary"):
+            if f in bad_fields:
+                # 仍缺的字段保持缺失（不拿 OUTPUT_TEMPLATE 的默认值当作已修好）
+                patched[f] = fix.get(f)
+        fixed_clauses = fix.get("clauses") if isinstance(fix.get("clauses"), list) else []
+        if "clauses" in bad_fields:
+            patched["clauses"] = fixed_clauses
+        else:
+            patched["clauses"] = list(result["clauses"])
+            for k, i in enumerate(bad_clauses[:len(fixed_clauses)]):
+                patched["clauses"][i] = fixed_clauses[k]
+        result, bad_fields, bad_clauses = _check_analysis(patched)
+
+    if bad_clauses:
+        metrics.inc("analysis.schema.dropped_clauses", len(bad_clauses))
+        result["clauses"] = [c for i, c in enumerate(result["clauses"]) if i not in set(bad_clauses)]
+    if "clauses" in bad_fields:
+        metrics.inc("analysis.schema.dropped_clauses")
+        bad_fields.remove("clauses")
+    for f in bad_fields:
+        # _check_analysis 已经从 OUTPUT_TEMPLATE 填好默认值（score 0 / 空 riskSummary）
+        metrics.inc(f"analysis.schema.defaulted.{f}")
+    return result
+
+
+def _analyze_text_once(
+    extracted_text: str,
+    contract_type: str,
+    identity: str,
+    timeout: Optional[float] = None,
+    on_event: Optional[Callable[[str, Any], None]] = None,
+) -> Dict[str, Any]:
+    """
+    Single-pass analysis call.
+    With on_event the completion is streamed: every finished clause / top-level member is
+    reported while the model is still writing; the result is parsed from the full text
+    exactly like the non-streaming call.
+    """
+    system = build_system_prompt(contract_type, identity)
+    messages = [
+        {"role": "system", "content": system},
+        {"role": "user", "content": extracted_text},
+    ]
+    fmt = _output_format()
+    if on_event is None:
+        raw = llm.chat(ANALYSIS_MODEL, messages, timeout=timeout, response_format=fmt)
+    else:
+        parser = AnalysisStreamParser()
+        for delta in llm.chat_stream(ANALYSIS_MODEL, messages, timeout=timeout, response_format=fmt):
+            for name, value in parser.feed(delta):
+                # 只推送本地校验通过的条款/分数；最终 result 以完整校验后的结果为准
+                if name == "clause":
+                    value = _check_clause(value)
+                elif name == "score":
+                    value = coerce_score(value)
+                if value is not None:
+                    on_event(name, value)
+        raw = parser.text.strip()
+    parsed, raw = _load_analysis_json(raw, messages, timeout)
+
+    merged = _validate_analysis(parsed, raw, messages, timeout)
     if not merged.get("originalContent"):
         merged["originalContent"] = extracted_text
     return merged
@@ -483,195 +1113,610 @@ def _merge_chunk_results(
     identity: str,
 ) -> Dict[str, Any]:
     """
-    Merge multiple chunk analyses into a single JSON using a final model pass.
-    Keeps output schema strict.
-    """
-    # Prepare an input that the model can reliably merge.
-    # Keep it compact: only score/riskSummary/clauses per chunk.
-    compact = []
-    for i, r in enumerate(chunk_results, start=1):
-        compact.append(
-            {
-                "chunkIndex": i,
-                "score": r.get("score", 0),
-                "riskSummary": r.get("riskSummary", ""),
-                "clauses": r.get("clauses", []) or [],
-            }
+    Merge multiple chunk analyses into a single JSON locally (dedupe/rank/score, no model call).
+    MERGE_MODE=llm additionally asks the model to rewrite riskSummary only.
+    """
+    merged = dict(OUTPUT_TEMPLATE)
+    merged.update(merge_chunk_results_local(chunk_results))
+
+    if MERGE_MODE == "llm":
+        messages = build_summary_merge_messages(
+            build_system_prompt(contract_type, identity), chunk_results, merged
         )
+        try:
+            parsed = _try_json_load(
+                llm.chat(ANALYSIS_MODEL, messages, response_format=_output_format(("riskSummary",), "risk_summary"))
+            )
+        except LLMError:
+            # 摘要重写只是锦上添花：失败时保留本地合并的 riskSummary，不丢掉已完成的分块
+            metrics.inc("merge.llm_fallback")
+            parsed = None
+        if isinstance(parsed, dict) and str(parsed.get("riskSummary") or "").strip():
+            merged["riskSummary"] = str(parsed["riskSummary"]).strip()
+    return merged
 
-    merge_system = (
-        build_system_prompt(contract_type, identity)
-        + "\n你将收到多个分块审阅结果，请合并去重并输出最终JSON。"
-        + "合并规则：\n"
-          "- clauses 去重：若 originalText/标题/含义高度相似则只保留更清晰的一条。\n"
-          "- 保留最重要的风险点，最多12条。\n"
-          "- score 取整体风险评估（不是简单平均，可偏向更高风险）。\n"
-    )
 
-    resp = client.chat.completions.create(
-        model="gpt-4.1-mini",
-        temperature=0,
-        messages=[
-            {"role": "system", "content": merge_system},
-            {"role": "user", "content": json.dumps(compact, ensure_ascii=False)},
-        ],
+@functools.lru_cache(maxsize=64)
+def _prompt_overhead_tokens(contract_type: str, identity: str) -> int:
+    # 每次分析调用的固定开销：系统提示词（随合同类型/身份变化，结果缓存）
+    return count_tokens(build_system_prompt(contract_type, identity))
+
+
+# 分块标题 + 上文衔接标记（见 _chunk_input）；衔接正文按 CHUNK_OVERLAP_CHARS 预留（每字至多约 1 token）
+_CHUNK_FRAME = "【分块 12/12】\n【上文衔接（仅供理解上下文，请勿重复审阅）】\n\n【本块正文】\n"
+
+
+def _fits_single_pass(text_tokens: int, contract_type: str, identity: str) -> bool:
+    return _prompt_overhead_tokens(contract_type, identity) + text_tokens <= SINGLE_PASS_TOKENS
+
+
+def _split_for_analysis(
+    text: str,
+    contract_type: str,
+    identity: str,
+    text_tokens: Optional[int] = None,
+) -> List[Chunk]:
+    """
+    Pack whole articles into at most MAX_CHUNKS chunks, each call (system prompt + frame +
+    overlap + body) within CHUNK_TOKENS.
+    If CHUNK_TOKENS would need more chunks, the budget grows instead of dropping the tail;
+    only documents that exceed MAX_CHUNKS * MAX_CHUNK_TOKENS are rejected (413).
+    """
+    overhead = _prompt_overhead_tokens(contract_type, identity) + count_tokens(_CHUNK_FRAME) + CHUNK_OVERLAP_CHARS
+    if text_tokens is None:
+        text_tokens = count_tokens(text)
+
+    budget = CHUNK_TOKENS
+    chunks = chunk_contract(text, budget - overhead, CHUNK_OVERLAP_CHARS)
+    if len(chunks) > MAX_CHUNKS:
+        budget = max(budget, -(-text_tokens // MAX_CHUNKS) + overhead)
+    while len(chunks) > MAX_CHUNKS and budget < MAX_CHUNK_TOKENS:
+        budget = min(MAX_CHUNK_TOKENS, budget * 11 // 10 + 1)
+        chunks = chunk_contract(text, budget - overhead, CHUNK_OVERLAP_CHARS)
+    if len(chunks) > MAX_CHUNKS:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Contract too long: needs {len(chunks)} chunks (max {MAX_CHUNKS})",
+        )
+    return chunks
+
+
+def _chunk_input(idx: int, total: Optional[int], chunk: Chunk) -> str:
+    # Add a small header so model understands chunk context (total unknown while still extracting)
+    head = f"【分块 {idx}/{total}】" if total else f"【分块 {idx}】"
+    if not chunk.overlap:
+        return f"{head}\n{chunk.text}"
+    return (
+        f"{head}\n"
+        f"【上文衔接（仅供理解上下文，请勿重复审阅）】\n{chunk.overlap}\n"
+        f"【本块正文】\n{chunk.text}"
     )
-    raw = (resp.choices[0].message.content or "").strip()
-    parsed = _safe_json_load(raw)
 
-    merged = dict(OUTPUT_TEMPLATE)
-    if isinstance(parsed, dict):
-        merged.update(parsed)
-    return merged
+
+def _model_error(e: LLMError) -> HTTPException:
+    if isinstance(e, CircuitOpenError):
+        return HTTPException(
+            status_code=503,
+            detail="Model service temporarily unavailable, please retry later",
+            headers={"Retry-After": str(max(1, int(e.retry_in + 0.5)))},
+        )
+    if isinstance(e, LLMTimeoutError):
+        return HTTPException(status_code=504, detail="Model call timed out")
+    return HTTPException(status_code=502, detail=f"Model call failed: {e}")
+
+
+_chunk_memo = LRUCache(CHUNK_MEMO_SIZE)
 
 
 def _analyze_with_chunking(
     full_text: str,
     contract_type: str,
     identity: str,
+    report: Optional[Callable[..., None]] = None,
+    on_event: Optional[Callable[[str, Any], None]] = None,
 ) -> Dict[str, Any]:
     """
-    If text <= 80k chars -> single pass.
-    If > 80k -> chunk into ~20k parts (max 12 chunks), analyze each, then merge.
+    If system prompt + text <= SINGLE_PASS_TOKENS -> single pass (streamed to on_event when given).
+    Otherwise split at clause boundaries into chunk calls of <= CHUNK_TOKENS (max 12 chunks),
+    analyze them concurrently (CHUNK_CONCURRENCY in flight, CHUNK_TIMEOUT_SECONDS per model call;
+    a chunk may take _chunk_deadline() with retries and re-asks), then merge in chunk order. Merged clauses only exist after the merge, so the chunked
+    path does not stream.
+    """
+    try:
+        return _analyze_with_chunking_inner(full_text, contract_type, identity, report, on_event)
+    except LLMError as e:
+        raise _model_error(e)
+
+
+def _analyze_chunk(chunk_input: str, contract_type: str, identity: str) -> Dict[str, Any]:
+    memo_key = hashlib.sha256(
+        "|".join((PROMPT_VERSION, ANALYSIS_MODEL, contract_type, identity, chunk_input)).encode("utf-8")
+    ).hexdigest()
+    r = _chunk_memo.get(memo_key)
+    if r is None:
+        r = _analyze_text_once(chunk_input, contract_type, identity, timeout=CHUNK_TIMEOUT_SECONDS)
+        _chunk_memo.put(memo_key, r)
+    else:
+        metrics.inc("chunk_memo.hit")
+    return r
+
+
+class _ChunkStream:
+    """
+    Chunked analysis that starts while a long document is still being extracted.
+    feed(page_text) collects pages; once the text no longer fits a single pass, whole articles
+    are packed (StreamingPacker, same packing as _split_for_analysis at CHUNK_TOKENS) and each
+    finished chunk is sent to the model right away. finish(full_text) waits for them and merges.
+    The per-chunk budget is re-estimated from the page count on every page, and the last of the
+    MAX_CHUNKS slots is held back: chunks past MAX_CHUNKS - 1 wait for finish(), which packs them
+    at MAX_CHUNK_TOKENS into that slot (a few more if it must), so the chunk calls already made
+    are never thrown away. Short documents, and documents too long to analyze at all (413),
+    take the regular path in finish().
     """
+
+    def __init__(self, contract_type: str, identity: str, report: Optional[Callable[..., None]] = None):
+        self.contract_type = contract_type
+        self.identity = identity
+        self.report = report or _noop_report
+        self._overhead = _prompt_overhead_tokens(contract_type, identity) + count_tokens(_CHUNK_FRAME) + CHUNK_OVERLAP_CHARS
+        self._packer: Optional[StreamingPacker] = None
+        self._pages: List[str] = []
+        self._tokens = 0
+        self._sent_tokens = 0
+        self._futures: List[Future] = []
+        self._rest: List[Chunk] = []
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self.started = False
+        self.gave_up = False
+
+    def feed(self, page_text: str, index: Optional[int] = None, total: Optional[int] = None):
+        if self.gave_up:
+            return
+        self._tokens += count_tokens(page_text)
+        if self.started:
+            self._grow_budget(index, total)
+            self._submit(self._packer.feed(page_text))
+            return
+        self._pages.append(page_text)
+        if _fits_single_pass(self._tokens, self.contract_type, self.identity):
+            return
+        self.started = True
+        metrics.inc("analysis.stream_chunks.started")
+        self._packer = StreamingPacker(CHUNK_TOKENS - self._overhead, CHUNK_OVERLAP_CHARS)
+        self._grow_budget(index, total)
+        self._executor = ThreadPoolExecutor(max_workers=CHUNK_CONCURRENCY, thread_name_prefix="chunk")
+        self._submit(self._packer.feed("\n\n".join(self._pages)))
+        self._pages = []
+
+    def _grow_budget(self, index: Optional[int], total: Optional[int]):
+        # 同 _split_for_analysis：按已读页数外推剩余长度，分摊到还没用掉的块上（每读一页重估，只增不减）
+        if index is None or not total:
+            return
+        remaining = self._tokens * total // (index + 1) - self._sent_tokens
+        slots = MAX_CHUNKS - len(self._futures)
+        if remaining <= 0 or slots <= 0:
+            return
+        budget = min(-(-remaining * 11 // 10 // slots) + self._overhead, MAX_CHUNK_TOKENS)
+        self._packer.budget = max(self._packer.budget, budget - self._overhead)
+
+    def _submit(self, chunks: List[Chunk]):
+        for c in chunks:
+            if self._rest or len(self._futures) >= MAX_CHUNKS - 1:
+                self._rest.append(c)
+                continue
+            self._submit_one(c)
+
+    def _submit_one(self, c: Chunk):
+        chunk_input = _chunk_input(len(self._futures) + 1, None, c)
+        self._sent_tokens += c.tokens
+        self._futures.append(self._executor.submit(_analyze_chunk, chunk_input, self.contract_type, self.identity))
+
+    def _submit_rest(self):
+        # 剩下的块重新按 MAX_CHUNK_TOKENS 打包进最后一块（装不下就多用几块，超出 MAX_CHUNKS），
+        # 已发出的分块结果照常使用；只有整份都会被 413 拒绝时才走常规路径
+        if not self._rest:
+            return
+        if self._tokens > MAX_CHUNKS * (MAX_CHUNK_TOKENS - self._overhead):
+            metrics.inc("analysis.stream_chunks.fallback")
+            self.gave_up = True
+            return
+        body = "\n".join(c.text for c in self._rest)
+        tail = chunk_contract(body, MAX_CHUNK_TOKENS - self._overhead, CHUNK_OVERLAP_CHARS)
+        tail[0].overlap = self._rest[0].overlap
+        if len(self._rest) > 1:
+            metrics.inc("analysis.stream_chunks.tail_merged")
+        if len(tail) > 1:
+            metrics.inc("analysis.stream_chunks.extra", len(tail) - 1)
+        for c in tail:
+            self._submit_one(c)
+        self._rest = []
+
+    def close(self):
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def finish(self, full_text: str, on_event: Optional[Callable[[str, Any], None]] = None) -> Dict[str, Any]:
+        if not self.started or self.gave_up:
+            self.close()
+            return _analyze_with_chunking(full_text, self.contract_type, self.identity, report=self.report, on_event=on_event)
+        try:
+            self._submit(self._packer.close())
+            self._submit_rest()
+            if self.gave_up:
+                self.close()
+                return _analyze_with_chunking(
+                    full_text, self.contract_type, self.identity, report=self.report, on_event=on_event
+                )
+            metrics.observe("analysis.input_tokens", count_tokens(full_text))
+            n = len(self._futures)
+            results: List[Dict[str, Any]] = []
+            deadline = _chunk_deadline()
+            self.report("analyzing", 40)
+            for k, f in enumerate(self._futures, start=1):
+                try:
+                    results.append(f.result(timeout=deadline))
+                except FutureTimeoutError:
+                    raise HTTPException(
+                        status_code=504,
+                        detail=f"Chunk {k}/{n} analysis timed out ({int(deadline)}s)",
+                    )
+                except LLMError as e:
+                    raise _model_error(e)
+                self.report("chunk_analyzed", 40 + 50 * k // n, chunk=k, totalChunks=n)
+            self.report("merge_started", 90, totalChunks=n)
+            try:
+                final = _merge_chunk_results(results, self.contract_type, self.identity)
+            except LLMError as e:
+                raise _model_error(e)
+            final["originalContent"] = full_text
+            return final
+        finally:
+            self.close()
+
+
+def _analyze_with_chunking_inner(
+    full_text: str,
+    contract_type: str,
+    identity: str,
+    report: Optional[Callable[..., None]],
+    on_event: Optional[Callable[[str, Any], None]],
+) -> Dict[str, Any]:
+    report = report or _noop_report
     text = (full_text or "").strip()
     if not text:
         return dict(OUTPUT_TEMPLATE)
 
-    if len(text) <= MAX_TEXT_CHARS:
-        out = _analyze_text_once(text, contract_type, identity)
+    text_tokens = count_tokens(text)
+    metrics.observe("analysis.input_tokens", text_tokens)
+    if _fits_single_pass(text_tokens, contract_type, identity):
+        report("analyzing", 40)
+        out = _analyze_text_once(text, contract_type, identity, on_event=on_event)
         # Ensure originalContent present
         if not out.get("originalContent"):
             out["originalContent"] = text
         return out
 
-    # Chunking
-    chunks: List[str] = []
-    start = 0
-    while start < len(text) and len(chunks) < MAX_CHUNKS:
-        chunks.append(text[start:start + CHUNK_CHARS])
-        start += CHUNK_CHARS
+    chunks = _split_for_analysis(text, contract_type, identity, text_tokens)
+    chunk_inputs = [_chunk_input(idx, len(chunks), c) for idx, c in enumerate(chunks, start=1)]
+
+    done_lock = threading.Lock()
+    done = [0]
 
-    chunk_results: List[Dict[str, Any]] = []
-    for idx, chunk in enumerate(chunks, start=1):
-        # Add a small header so model understands chunk context
-        chunk_input = f"【分块 {idx}/{len(chunks)}】\n{chunk}"
-        r = _analyze_text_once(chunk_input, contract_type, identity)
-        chunk_results.append(r)
+    def analyze_chunk(chunk_input: str) -> Dict[str, Any]:
+        r = _analyze_chunk(chunk_input, contract_type, identity)
+        with done_lock:
+            done[0] += 1
+            report("chunk_analyzed", 40 + 50 * done[0] // len(chunks), chunk=done[0], totalChunks=len(chunks))
+        return r
+
+    report("analyzing", 40)
+    try:
+        chunk_results: List[Dict[str, Any]] = run_ordered(
+            analyze_chunk,
+            chunk_inputs,
+            max_workers=CHUNK_CONCURRENCY,
+            item_timeout=_chunk_deadline(),
+            thread_name_prefix="chunk",
+        )
+    except TaskTimeoutError as e:
+        raise HTTPException(
+            status_code=504,
+            detail=f"Chunk {e.index + 1}/{len(chunks)} analysis timed out ({int(e.timeout)}s)",
+        )
 
+    report("merge_started", 90, totalChunks=len(chunks))
     final = _merge_chunk_results(chunk_results, contract_type, identity)
     # Preserve original full content for UI
     final["originalContent"] = text
     return final
 
-def _ocr_images_with_openai_single(image_bytes_list: List[bytes], mime_list: List[str]) -> str:
+def _prepare_for_ocr(image_bytes: bytes, mime: str) -> Tuple[bytes, str]:
+    if not IMAGE_PREP:
+        return image_bytes, mime
+    p = prepare_image(
+        image_bytes, mime,
+        max_side=IMAGE_MAX_SIDE, grayscale=IMAGE_GRAYSCALE, fmt=IMAGE_FORMAT, quality=IMAGE_QUALITY,
+    )
+    metrics.inc("imageprep.bytes_in", p.bytes_in)
+    metrics.inc("imageprep.bytes_out", len(p.data))
+    metrics.inc("imageprep.tokens_in", p.tokens_in)
+    metrics.inc("imageprep.tokens_out", p.tokens_out)
+    return p.data, p.mime
+
+
+def _duplicate_pages(image_bytes_list: List[bytes]) -> List[int]:
+    # 近似重复页（位置下标，保留第一份）；无法解码的图片不参与比较
+    if not IMAGE_PREP or IMAGE_DEDUPE_DISTANCE < 0 or len(image_bytes_list) < 2:
+        return []
+    dup = duplicate_positions([page_signature(b) for b in image_bytes_list], IMAGE_DEDUPE_DISTANCE)
+    if dup:
+        metrics.inc("imageprep.pages_dropped", len(dup))
+    return dup
+
+
+def _is_duplicate_page(image_bytes: bytes, earlier: List[bytes]) -> bool:
+    if not IMAGE_PREP or IMAGE_DEDUPE_DISTANCE < 0 or not earlier:
+        return False
+    sigs = [page_signature(b) for b in earlier + [image_bytes]]
+    return len(earlier) in duplicate_positions(sigs, IMAGE_DEDUPE_DISTANCE)
+
+
+@functools.lru_cache(maxsize=1)
+def _ocr_cache_version() -> str:
+    # 任何会改变识别结果的配置都进 key：换模型 / 改提示词 / 改预处理参数后旧结果自然失效
+    prep = f"{IMAGE_MAX_SIDE}:{IMAGE_GRAYSCALE}:{IMAGE_FORMAT}:{IMAGE_QUALITY}" if IMAGE_PREP else "raw"
+    prompt = hashlib.sha256(OCR_PROMPT.encode("utf-8")).hexdigest()[:16]
+    return f"{OCR_MODEL}|{prompt}|{prep}"
+
+
+def _ocr_cache_key(image_bytes_list: List[bytes]) -> str:
+    shas = "|".join(hashlib.sha256(b).hexdigest() for b in image_bytes_list)
+    return hashlib.sha256(f"{_ocr_cache_version()}|{shas}".encode("utf-8")).hexdigest()
+
+
+def _ocr_cache_get(key: str) -> Optional[str]:
+    db = SessionLocal()
+    try:
+        row = db.query(OcrCacheEntry).filter(OcrCacheEntry.cache_key == key).first()
+        if row is None:
+            metrics.inc("ocr.cache.miss")
+            return None
+        row.hits = (row.hits or 0) + 1
+        row.last_used_at = datetime.utcnow()
+        db.commit()
+        metrics.inc("ocr.cache.hit")
+        return row.text
+    finally:
+        db.close()
+
+
+_ocr_cache_puts = [0]
+
+
+def _ocr_cache_put(key: str, pages: int, text: str):
+    db = SessionLocal()
+    try:
+        if db.query(OcrCacheEntry.id).filter(OcrCacheEntry.cache_key == key).first():
+            return  # 并发识别同一张图，先写入的为准
+        db.add(OcrCacheEntry(cache_key=key, ocr_model=OCR_MODEL, pages=pages, text=text))
+        try:
+            db.commit()
+        except IntegrityError:
+            db.rollback()
+            return
+        metrics.inc("ocr.cache.store")
+        _ocr_cache_puts[0] += 1
+        # 每写入 100 条检查一次容量，按 last_used_at 淘汰最久未用的
+        if _ocr_cache_puts[0] % 100 == 0:
+            _ocr_cache_evict(db)
+    finally:
+        db.close()
+
+
+def _ocr_cache_evict(db) -> int:
+    stale = (
+        db.query(OcrCacheEntry.id)
+        .order_by(OcrCacheEntry.last_used_at.desc())
+        .offset(OCR_CACHE_MAX_ENTRIES)
+        .subquery()
+    )
+    n = db.query(OcrCacheEntry).filter(OcrCacheEntry.id.in_(select(stale.c.id))).delete(synchronize_session=False)
+    db.commit()
+    if n:
+        metrics.inc("ocr.cache.evicted", n)
+    return n
+
+
+def _ocr_images_with_openai_single(
+    image_bytes_list: List[bytes],
+    mime_list: List[str],
+    timeout: Optional[float] = None,
+) -> str:
     """
-    单次 OCR（最多 5 张图），只做一次 OpenAI 调用。
+    单次 OCR（最多 5 张图），只做一次 OpenAI 调用；图片先经 _prepare_for_ocr 压缩。
+    同一组图片识别过就直接用 ocr_cache 里的结果（按原图 sha 查，不必先做预处理）。
     """
     max_n = 5
     image_bytes_list = image_bytes_list[:max_n]
-    mime_list = mime_list[:max_n]
+    if not image_bytes_list:
+        return ""
+    key = _ocr_cache_key(image_bytes_list) if OCR_CACHE else ""
+    if key:
+        cached = _ocr_cache_get(key)
+        if cached is not None:
+            return cached
 
-    parts: List[Dict[str, Any]] = [
-        {"type": "text", "text": "请对图片进行OCR，输出完整可读的中文合同文本。只输出纯文本，不要解释。"}
+    images = [_prepare_for_ocr(b, m) for b, m in zip(image_bytes_list, mime_list[:max_n])]
+    try:
+        text = llm.ocr(OCR_MODEL, OCR_PROMPT, images, timeout=timeout)
+    except LLMError as e:
+        raise _model_error(e)
+    if key and text is not None:
+        _ocr_cache_put(key, len(images), text)
+    return text
+
+
+def _ocr_images_with_openai_multi(
+    image_bytes_list: List[bytes],
+    mime_list: List[str],
+    on_batch: Optional[Callable[[int, int, int, int], None]] = None,
+) -> str:
+    """
+    支持 1~9 张图：按 OCR_BATCH_SIZE 分批（OCR_PER_PAGE 时每页一批），各批并发 OCR，
+    再按页序合并文本；总耗时约等于最慢的一次 OCR 调用。
+    on_batch(batch, totalBatches, processedImages, totalImages) 在每批完成后回调（按完成顺序计数）。
+    """
+    total = len(image_bytes_list)
+    if not total:
+        return ""
+    dup = set(_duplicate_pages(image_bytes_list))
+    if dup:
+        image_bytes_list = [b for i, b in enumerate(image_bytes_list) if i not in dup]
+        mime_list = [m for i, m in enumerate(mime_list) if i not in dup]
+    # 按去重后的页数分批（按 total 分会多出没有图片的空批）
+    batch_size = 1 if OCR_PER_PAGE else OCR_BATCH_SIZE
+    batches = [
+        (image_bytes_list[i:i + batch_size], mime_list[i:i + batch_size])
+        for i in range(0, len(image_bytes_list), batch_size)
     ]
 
-    for b, mime in zip(image_bytes_list, mime_list):
-        b64 = __import__("base64").b64encode(b).decode("utf-8")
-        parts.append({"type": "image_url", "image_url": {"url": f"data:{mime};base64,{b64}"}})
+    done_lock = threading.Lock()
+    done = [0, 0]  # batches, images
 
-    resp = client.chat.completions.create(
-        model="gpt-4o-mini",
-        temperature=0,
-        messages=[{"role": "user", "content": parts}],
-    )
-    return (resp.choices[0].message.content or "").strip()
+    def ocr_batch(batch: Tuple[List[bytes], List[str]]) -> str:
+        t = _ocr_images_with_openai_single(batch[0], batch[1], timeout=OCR_TIMEOUT_SECONDS)
+        with done_lock:
+            done[0] += 1
+            done[1] += len(batch[0])
+            if on_batch:
+                on_batch(done[0], len(batches), done[1] + len(dup), total)
+        return (t or "").strip()
 
+    try:
+        texts = run_ordered(
+            ocr_batch,
+            batches,
+            max_workers=OCR_CONCURRENCY,
+            item_timeout=_call_deadline(OCR_TIMEOUT_SECONDS),
+            thread_name_prefix="ocr",
+        )
+    except TaskTimeoutError as e:
+        raise HTTPException(
+            status_code=504,
+            detail=f"OCR batch {e.index + 1}/{len(batches)} timed out ({int(e.timeout)}s)",
+        )
+    return "\n\n".join(t for t in texts if t).strip()
 
-def _ocr_images_with_openai_multi(image_bytes_list: List[bytes], mime_list: List[str]) -> str:
-    """
-    支持 1~9 张图：分批（每批最多 5 张）做 OCR，然后合并文本。
-    """
-    texts: List[str] = []
-    batch_size = 5
 
-    for i in range(0, len(image_bytes_list), batch_size):
-        sub_bytes = image_bytes_list[i:i + batch_size]
-        sub_mimes = mime_list[i:i + batch_size]
-        t = _ocr_images_with_openai_single(sub_bytes, sub_mimes)
-        if t:
-            texts.append(t.strip())
+# ✅ 兼容旧调用：如果你代码里还有 _ocr_images_with_openai(...)，同样分批并发
+def _ocr_images_with_openai(image_bytes_list: List[bytes], mime_list: List[str]) -> str:
+    return _ocr_images_with_openai_multi(image_bytes_list, mime_list)
 
-    return "\n\n".join(texts).strip()
 
+_extract_pool = ExtractionPool(EXTRACT_WORKERS, EXTRACT_TIMEOUT_SECONDS, EXTRACT_MEMORY_MB)
 
-# ✅ 兼容旧调用：如果你代码里还有 _ocr_images_with_openai(...)，让它默认走 single
-def _ocr_images_with_openai(image_bytes_list: List[bytes], mime_list: List[str]) -> str:
-    return _ocr_images_with_openai_single(image_bytes_list, mime_list)
 
-    parts: List[Dict[str, Any]] = [{"type": "text", "text": "请对图片进行OCR，输出完整可读的中文合同文本。只输出纯文本，不要解释。"}]
-    for b, mime in zip(image_bytes_list, mime_list):
-        b64 = __import__("base64").b64encode(b).decode("utf-8")
-        parts.append({"type": "image_url", "image_url": {"url": f"data:{mime};base64,{b64}"}})
+def _extraction_error(e: ExtractionError) -> HTTPException:
+    if isinstance(e, ExtractionTimeout):
+        return HTTPException(status_code=504, detail=f"File parsing timed out ({int(e.timeout)}s)")
+    if isinstance(e, ExtractionMemoryError):
+        return HTTPException(status_code=413, detail="File too complex to parse")
+    return HTTPException(status_code=400, detail=f"Could not parse file: {e}")
 
-    resp = client.chat.completions.create(
-        model="gpt-4o-mini",
-        temperature=0,
-        messages=[{"role": "user", "content": parts}],
-    )
-    return (resp.choices[0].message.content or "").strip()
-
-
-def _extract_pdf_text_or_ocr(pdf_bytes: bytes) -> str:
-    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
-
-    # 1) Extract selectable text (first 10 pages)
-    texts = []
-    for i in range(min(doc.page_count, 10)):
-        t = doc.load_page(i).get_text("text").strip()
-        if t:
-            texts.append(t)
-    extracted = "\n\n".join(texts).strip()
-    if len(extracted) >= 200:
-        return extracted
-
-    # 2) OCR: render first 3 pages
-    images: List[bytes] = []
-    mimes: List[str] = []
-    for i in range(min(doc.page_count, 3)):
-        page = doc.load_page(i)
-        pix = page.get_pixmap(dpi=200)
-        images.append(pix.tobytes("png"))
-        mimes.append("image/png")
-
-    if not images:
-        return extracted
-    return _ocr_images_with_openai(images, mimes)
+
+def _extract_pdf_text_or_ocr(
+    pdf_bytes: bytes,
+    on_batch: Optional[Callable[[int, int, int, int], None]] = None,
+    on_page: Optional[Callable[[str, int, int], None]] = None,
+) -> Tuple[str, Dict[str, Any]]:
+    """
+    Per-page hybrid extraction: pages come from a worker process as they are parsed
+    (engine/extract.py); text-layer pages are used as is, image-only pages are OCR'd (one call
+    per page, OCR_CONCURRENCY in flight) while parsing continues. on_page(text, index, total_pages)
+    gets the page texts in page order as soon as all earlier pages are done.
+    Returns (text, meta); meta lists the pages left out because of PDF_MAX_PAGES / PDF_MAX_OCR_PAGES.
+    """
+    texts: List[str] = []
+    pending: "deque[Tuple[int, Any]]" = deque()  # (page index, text or OCR future), page order
+    ocr_pages: List[int] = []
+    skipped: List[int] = []
+    blank = 0
+    total = 0
+    done_lock = threading.Lock()
+    done = [0]
+
+    def ocr_one(png: bytes) -> str:
+        t = _ocr_images_with_openai_single([png], ["image/png"], timeout=OCR_TIMEOUT_SECONDS)
+        with done_lock:
+            done[0] += 1
+            if on_batch:
+                on_batch(done[0], len(ocr_pages), done[0], len(ocr_pages))
+        return (t or "").strip()
+
+    def deliver(wait: bool):
+        while pending and (wait or not isinstance(pending[0][1], Future) or pending[0][1].done()):
+            i, v = pending.popleft()
+            if isinstance(v, Future):
+                deadline = _call_deadline(OCR_TIMEOUT_SECONDS)
+                try:
+                    v = v.result(timeout=deadline)
+                except FutureTimeoutError:
+                    raise HTTPException(
+                        status_code=504,
+                        detail=f"OCR of PDF page {i + 1}/{total} timed out ({int(deadline)}s)",
+                    )
+            texts.append(v)
+            if on_page and v:
+                on_page(v, i, total)
+
+    ocr_ex = ThreadPoolExecutor(max_workers=OCR_CONCURRENCY, thread_name_prefix="ocr")
+    try:
+        pages = _extract_pool.stream(
+            iter_pdf_pages,
+            pdf_bytes,
+            max_pages=PDF_MAX_PAGES,
+            max_ocr_pages=PDF_MAX_OCR_PAGES,
+            min_chars=PDF_TEXT_PAGE_MIN_CHARS,
+            image_min_coverage=PDF_IMAGE_MIN_COVERAGE,
+            scan_coverage=PDF_SCAN_COVERAGE,
+            dpi=OCR_PDF_DPI,
+        )
+        for page in pages:
+            total = page.total
+            if page.kind == "text":
+                pending.append((page.index, page.text))
+            elif page.kind == "ocr":
+                ocr_pages.append(page.index)
+                pending.append((page.index, ocr_ex.submit(ocr_one, page.png)))
+            elif page.kind == "blank":
+                blank += 1
+            else:
+                skipped.append(page.index + 1)
+            deliver(wait=False)
+        deliver(wait=True)
+    except ExtractionError as e:
+        raise _extraction_error(e)
+    finally:
+        ocr_ex.shutdown(wait=False, cancel_futures=True)
+
+    meta = {
+        "totalPages": total,
+        "textPages": len(texts) - len(ocr_pages),
+        "ocrPages": len(ocr_pages),
+        "blankPages": blank,
+        "skippedPages": skipped,
+    }
+    if skipped:
+        metrics.inc("pdf.pages_skipped", len(skipped))
+    metrics.inc("pdf.pages_text", meta["textPages"])
+    metrics.inc("pdf.pages_ocr", len(ocr_pages))
+    return "\n\n".join(t for t in texts if t).strip(), meta
 
 def _extract_docx_text(docx_bytes: bytes) -> str:
-    f = io.BytesIO(docx_bytes)
-    doc = Document(f)
-
-    parts = []
-
-    # 段落
-    for p in doc.paragraphs:
-        t = (p.text or "").strip()
-        if t:
-            parts.append(t)
-
-    # 表格（合同关键信息经常在表格里）
-    for table in doc.tables:
-        for row in table.rows:
-            cells = []
-            for cell in row.cells:
-                ct = (cell.text or "").strip()
-                if ct:
-                    cells.append(ct)
-            if cells:
-                parts.append(" | ".join(cells))
-
-    return "\n".join(parts).strip()
+    try:
+        return "\n".join(_extract_pool.stream(iter_docx_blocks, docx_bytes)).strip()
+    except ExtractionError as e:
+        raise _extraction_error(e)
 
 @app.post("/v1/auth/register")
 def register(req: RegisterRequest):
@@ -791,19 +1836,54 @@ def _require_credits(db, user_id: int, cost: int = 1) -> int:
     return int(u.credits or 0)
 
 
-# =========================
-# Share Helpers (NEW)
-# =========================
-def _score_to_title(score: int) -> str:
+def _refund_credits(db, user_id: int, amount: int = 1):
     """
-    Share 页用的标题，后端保证一致性（不要依赖前端）。
+    Give back credits deducted for an analysis that did not complete.
     """
-    try:
-        s = int(round(float(score)))
-    except Exception:
-        s = 0
-
-    if s >= 90:
+    u = db.query(User).filter(User.id == user_id).first()
+    if not u:
+        return
+    u.credits = int(u.credits or 0) + int(amount)
+    db.add(u)
+    db.commit()
+
+
+def _refundable_charge(db, user_id: int, cost: int = 1) -> Tuple[Callable[[], None], Callable[[], None]]:
+    """
+    Sync endpoints: charge() deducts once; refund() gives the credit back if it was taken.
+    Call refund() when the analysis fails after charging (model outage, malformed JSON,
+    timeout), so a failed request costs nothing.
+    """
+    charged = [0]
+
+    def charge():
+        if not charged[0]:
+            _require_credits(db, user_id, cost=cost)
+            charged[0] = cost
+
+    def refund():
+        if charged[0]:
+            db.rollback()
+            _refund_credits(db, user_id, charged[0])
+            charged[0] = 0
+            metrics.inc("credits.refunded")
+
+    return charge, refund
+
+
+# =========================
+# Share Helpers (NEW)
+# =========================
+def _score_to_title(score: int) -> str:
+    """
+    Share 页用的标题，后端保证一致性（不要依赖前端）。
+    """
+    try:
+        s = int(round(float(score)))
+    except Exception:
+        s = 0
+
+    if s >= 90:
         return "整体安全"
     if s >= 70:
         return "整体安全"
@@ -965,6 +2045,681 @@ async def upload_my_avatar(
     finally:
         db.close()
 
+# =========================
+# Analysis Cache
+# =========================
+# content_hash = sha256(PROMPT_VERSION|type|identity|<content or file sha>)，与用户无关，
+# 所以同一份标准模板（租赁/劳动合同）被任何用户分析过一次，其他用户都能直接命中。
+
+def _cache_probe_stmt(t: str, identity: str, content_hash: str, user_id: Optional[int] = None):
+    # 只取 id：整条探测在 ix_analyses_cache_probe(_global) 里完成（覆盖索引），命中后再按主键取整行
+    stmt = select(Analysis.id).where(
+        Analysis.content_hash == content_hash,
+        Analysis.contract_type == t,
+        Analysis.identity == identity,
+        Analysis.prompt_version == PROMPT_VERSION,
+    )
+    if user_id is not None:
+        stmt = stmt.where(Analysis.user_id == user_id)
+    return stmt.order_by(Analysis.created_at.desc()).limit(1)
+
+
+def _find_cached_analysis(db, user_id: int, t: str, identity: str, content_hash: str) -> Tuple[Optional[Analysis], str]:
+    """
+    Returns (row, scope): scope = "own" (caller's history), "global" (another user's row) or "" (miss).
+    """
+    own_id = db.execute(_cache_probe_stmt(t, identity, content_hash, user_id)).scalar()
+    if own_id is not None:
+        metrics.inc("analysis_cache.hit_own")
+        return db.get(Analysis, own_id), "own"
+
+    shared_id = db.execute(_cache_probe_stmt(t, identity, content_hash)).scalar()
+    if shared_id is not None:
+        metrics.inc("analysis_cache.hit_global")
+        return db.get(Analysis, shared_id), "global"
+
+    metrics.inc("analysis_cache.miss")
+    return None, ""
+
+
+def _save_analysis(
+    db,
+    user_id: int,
+    t: str,
+    identity: str,
+    content_hash: str,
+    original_content: str,
+    data: Dict[str, Any],
+    file_name: Optional[str] = None,
+    file_mime: Optional[str] = None,
+    file_bytes: Optional[bytes] = None,
+    extracted_text_id: Optional[int] = None,
+) -> Analysis:
+    display_name = _gen_contract_display_name(db, user_id, t)
+    file_sha = hashlib.sha256(file_bytes).hexdigest() if file_bytes else None
+    row = Analysis(
+        user_id=user_id,
+        contract_type=t,
+        identity=identity,
+        prompt_version=PROMPT_VERSION,
+        content_hash=content_hash,
+        original_content="" if extracted_text_id else original_content,
+        result_json=json.dumps(data, ensure_ascii=False),
+        score=_row_score(data),
+        file_name=file_name,
+        file_mime=file_mime,
+        file_sha=file_sha,
+        file_size=len(file_bytes) if file_bytes else None,
+        display_name=display_name,
+        extracted_text_id=extracted_text_id,
+    )
+    with _blob_store.lock(file_sha) if file_sha else contextlib.nullcontext():
+        if file_sha:
+            _blob_add_ref(db, file_bytes, file_sha)
+        if extracted_text_id and db.query(ExtractedText.id).filter(ExtractedText.id == extracted_text_id).first() is None:
+            # 提取结果已随最后一条引用它的记录删除：原文直接存在本行
+            row.extracted_text_id = None
+            row.original_content = original_content
+        db.add(row)
+        db.commit()
+    db.refresh(row)
+    return row
+
+
+def _row_score(data: Dict[str, Any]) -> int:
+    try:
+        return int(round(float(data.get("score", 0) or 0)))
+    except (TypeError, ValueError):
+        return 0
+
+
+def _original_content(db, row: Analysis) -> str:
+    if row.extracted_text_id and not row.original_content:
+        text = db.query(ExtractedText.text).filter(ExtractedText.id == row.extracted_text_id).scalar()
+        return text or ""
+    return row.original_content or ""
+
+
+def _reuse_own_analysis(db, cached: Analysis, user_id: int, t: str) -> Tuple[Dict[str, Any], int, str]:
+    data = json.loads(cached.result_json)
+    display_name = (cached.display_name or "").strip()
+    if not display_name:
+        display_name = _gen_contract_display_name(db, user_id, t)
+        cached.display_name = display_name
+        db.add(cached)
+        db.commit()
+    return data, cached.id, display_name
+
+
+# =========================
+# Extracted Text Cache
+# =========================
+# 文本提取（docx 解析 / PDF 文本层 / OCR）只与文件本身有关：按 (file_sha, 提取器版本) 存一份，
+# 分析缓存（content_hash 里还有 PROMPT_VERSION / type / identity）未命中时也不必重新提取。
+
+_extract_flight = SingleFlight()
+
+
+def _extractor_version(kind: str) -> str:
+    # PDF（扫描件）和图片要走 OCR，结果随 OCR 模型变化
+    return EXTRACTOR_VERSION if kind == "docx" else f"{EXTRACTOR_VERSION}+{OCR_MODEL}"
+
+
+def _extract_text(
+    kind: str,
+    mime: str,
+    file_bytes: bytes,
+    on_batch: Optional[Callable[[int, int, int, int], None]] = None,
+    on_page: Optional[Callable[[str, int, int], None]] = None,
+) -> Tuple[str, Dict[str, Any]]:
+    if kind == "docx":
+        return _extract_docx_text(file_bytes), {}
+    if kind == "pdf":
+        return _extract_pdf_text_or_ocr(file_bytes, on_batch=on_batch, on_page=on_page)
+    return _ocr_images_with_openai([file_bytes], [mime]), {}
+
+
+def _get_extracted_text(
+    db,
+    kind: str,
+    mime: str,
+    file_bytes: bytes,
+    file_sha: str,
+    on_batch: Optional[Callable[[int, int, int, int], None]] = None,
+    on_page: Optional[Callable[[str, int, int], None]] = None,
+) -> Tuple[Optional[int], str, Dict[str, Any]]:
+    """
+    Returns (extracted_texts.id, text, meta). id is None when nothing was extracted (not stored,
+    so the next upload tries again). on_page only sees pages when this call really extracts
+    (cache hits and joined extractions return the whole text at once).
+    """
+    version = _extractor_version(kind)
+
+    def lookup() -> Optional[Tuple[int, str, Dict[str, Any]]]:
+        row = (
+            db.query(ExtractedText.id, ExtractedText.text, ExtractedText.meta_json)
+            .filter(ExtractedText.file_sha == file_sha, ExtractedText.extractor_version == version)
+            .first()
+        )
+        return (row[0], row[1], json.loads(row[2]) if row[2] else {}) if row else None
+
+    found = lookup()
+    if found:
+        metrics.inc("extract.cache.hit")
+        return found
+
+    def extract() -> Tuple[str, Dict[str, Any]]:
+        metrics.inc("extract.cache.miss")
+        text, meta = _extract_text(kind, mime, file_bytes, on_batch=on_batch, on_page=on_page)
+        text = (text or "").strip()
+        if text:
+            s = SessionLocal()
+            try:
+                s.add(ExtractedText(
+                    file_sha=file_sha, extractor_version=version, kind=kind, text=text,
+                    meta_json=json.dumps(meta, ensure_ascii=False) if meta else None,
+                ))
+                s.commit()
+            except IntegrityError:
+                s.rollback()
+            finally:
+                s.close()
+        return text, meta
+
+    # 同一文件同时被分析成不同身份/类型时只提取一次
+    (text, meta), shared = _extract_flight.do(f"extract:{file_sha}:{version}", extract)
+    if shared:
+        metrics.inc("extract.cache.joined")
+    if not text:
+        return None, "", meta
+    found = lookup()
+    return (found[0] if found else None), text, meta
+
+
+def _extraction_meta(db, analysis_id: int) -> Optional[Dict[str, Any]]:
+    # 命中分析缓存时也带上提取信息（PDF 的 skippedPages 等）
+    raw = (
+        db.query(ExtractedText.meta_json)
+        .join(Analysis, Analysis.extracted_text_id == ExtractedText.id)
+        .filter(Analysis.id == analysis_id)
+        .scalar()
+    )
+    return json.loads(raw) if raw else None
+
+
+# =========================
+# Analysis Pipelines
+# =========================
+# 同步接口与异步任务（/v1/jobs/...）共用同一套流水线：
+# - charge(): 流水线真正需要扣费时调用（同步接口 = 立即扣费；任务 = 消耗提交时预留的额度）
+# - report(stage, progress, **detail): 阶段/进度事件（任务状态 + /v1/progress 进度通道）
+#   阶段：extracting / ocr_batch / text_extracted / analyzing / chunk_analyzed / merge_started /
+#         persisting / persisted / waiting；字段沿用 AnalysisResult.meta 的 processedImages/totalImages
+# - 同一 content_hash 同时只跑一次分析（_analysis_flight），重复请求等待并复用结果
+
+_analysis_flight = SingleFlight()
+
+def _noop_report(stage: str, progress: int, **detail: Any):
+    pass
+
+
+def _text_content_hash(t: str, identity: str, content: str) -> str:
+    cache_key_raw = (PROMPT_VERSION + "|" + t + "|" + identity + "|" + content).encode("utf-8")
+    return hashlib.sha256(cache_key_raw).hexdigest()
+
+
+def _detect_upload_kind(filename: str, mime: str) -> Tuple[str, str]:
+    """
+    Returns (kind, mime): kind in docx / pdf / image. Raises 400 for anything else,
+    before any credit is charged.
+    """
+    ext = (os.path.splitext(filename)[1] or "").lower()
+    mime = (mime or "application/octet-stream").lower()
+
+    # ✅ 新增：docx 先抽文本（不 OCR、不转 PDF）
+    if ext == ".docx" or mime == "application/vnd.openxmlformats-officedocument.wordprocessingml.document":
+        return "docx", mime
+    if ext == ".pdf" or mime == "application/pdf":
+        return "pdf", mime
+    if mime.startswith("image/") or ext in [".png", ".jpg", ".jpeg", ".webp", ".gif"]:
+        # mime 兜底：如果 mime 不像 image，就按扩展名推断
+        if not mime.startswith("image/"):
+            if ext in [".jpg", ".jpeg"]:
+                mime = "image/jpeg"
+            elif ext == ".webp":
+                mime = "image/webp"
+            else:
+                mime = "image/png"
+        return "image", mime
+    raise HTTPException(status_code=400, detail=f"Unsupported file type: {mime} ({ext})")
+
+
+def _analysis_result(
+    row_id: int,
+    display_name: str,
+    data: Dict[str, Any],
+    t: str,
+    identity: str,
+    original_fallback: str = "",
+    file_url: Optional[str] = None,
+    file_name: Optional[str] = None,
+    meta: Optional[Dict[str, Any]] = None,
+) -> Dict[str, Any]:
+    out = {
+        "id": str(row_id),
+        "name": display_name,
+        "date": datetime.now().isoformat(),
+        "score": float(data.get("score", 0) or 0),
+        "riskSummary": str(data.get("riskSummary", "") or ""),
+        "clauses": data.get("clauses", []) or [],
+        "originalContent": str(data.get("originalContent", original_fallback) or original_fallback),
+        "status": "completed",
+        "type": t,
+        "identity": identity,
+        "promptVersion": PROMPT_VERSION,
+        "imagePreview": None,
+        "fileUrl": file_url,
+    }
+    if file_name is not None:
+        out["fileName"] = file_name
+    if meta is not None:
+        out["meta"] = meta
+    return out
+
+
+def _coalesce_analysis(
+    db,
+    user_id: int,
+    content_hash: str,
+    lead: Callable[[], Tuple[int, Dict[str, Any], str]],
+    report: Callable[..., None],
+) -> Tuple[Optional[Analysis], str, Optional[Tuple[int, Dict[str, Any], str]]]:
+    """
+    Single-flight on content_hash: concurrent identical requests (double tap / client retry)
+    share one analysis. Returns (row, scope, led):
+    - leader: (None, "", lead()) — lead() charged, analyzed and persisted
+    - duplicate: (leader's row, "own" | "global", None) — handled like a cache hit, never charged twice
+    """
+    led, shared = _analysis_flight.do(content_hash, lead, on_wait=lambda: report("waiting", 30))
+    if not shared:
+        metrics.inc("singleflight.leader")
+        return None, "", led
+
+    metrics.inc("singleflight.coalesced")
+    row = db.query(Analysis).filter(Analysis.id == led[0]).first()
+    if not row:
+        # leader's row vanished (deleted meanwhile): run our own analysis
+        return None, "", lead()
+    return row, ("own" if row.user_id == user_id else "global"), None
+
+
+def _coalesce_request(
+    user_id: int,
+    content_hash: str,
+    report: Callable[..., None],
+    resolve: Callable[[], Dict[str, Any]],
+) -> Dict[str, Any]:
+    """
+    Identical requests of the same user share one whole run (one charge, one history row),
+    also when the analysis itself is led by another user's request.
+    """
+    result, shared = _analysis_flight.do(
+        f"user:{user_id}:{content_hash}", resolve, on_wait=lambda: report("waiting", 30)
+    )
+    if shared:
+        metrics.inc("singleflight.coalesced")
+    return result
+
+
+def _run_text_analysis(
+    db,
+    user_id: int,
+    t: str,
+    identity: str,
+    content: str,
+    charge: Callable[[], Any],
+    report: Callable[..., None] = _noop_report,
+    on_event: Optional[Callable[[str, Any], None]] = None,
+) -> Dict[str, Any]:
+    content_hash = _text_content_hash(t, identity, content)
+
+    def lead() -> Tuple[int, Dict[str, Any], str]:
+        charge()
+        data = _analyze_with_chunking(content, t, identity, report=report, on_event=on_event)
+        report("persisting", 95)
+        row = _save_analysis(db, user_id, t, identity, content_hash, content, data)
+        report("persisted", 98, analysisId=row.id)
+        return row.id, data, row.display_name
+
+    def resolve() -> Dict[str, Any]:
+        cached, scope = _find_cached_analysis(db, user_id, t, identity, content_hash)
+        if not cached:
+            cached, scope, led = _coalesce_analysis(db, user_id, content_hash, lead, report)
+            if led:
+                row_id, data, display_name = led
+
+        if scope == "own":
+            data, row_id, display_name = _reuse_own_analysis(db, cached, user_id, t)
+        elif scope == "global":
+            # 其他用户分析过同一内容：复制结果到自己的历史（不复用对方的行/文件名）
+            charge()
+            data = json.loads(cached.result_json)
+            report("persisting", 95)
+            new_row = _save_analysis(db, user_id, t, identity, content_hash, content, data)
+            report("persisted", 98, analysisId=new_row.id)
+            row_id, display_name = new_row.id, new_row.display_name
+
+        # TEXT analysis has no original file to download
+        return _analysis_result(row_id, display_name, data, t, identity, original_fallback=content)
+
+    return _coalesce_request(user_id, content_hash, report, resolve)
+
+
+def _run_upload_analysis(
+    db,
+    user_id: int,
+    t: str,
+    identity: str,
+    filename: str,
+    mime: str,
+    file_bytes: bytes,
+    charge: Callable[[], Any],
+    report: Callable[..., None] = _noop_report,
+    on_event: Optional[Callable[[str, Any], None]] = None,
+) -> Dict[str, Any]:
+    kind, mime = _detect_upload_kind(filename, mime)
+
+    # cache based on raw file hash + prompt version + identity/type
+    file_sha = hashlib.sha256(file_bytes).hexdigest()
+    cache_key_raw = (PROMPT_VERSION + "|" + t + "|" + identity + "|" + file_sha).encode("utf-8")
+    content_hash = hashlib.sha256(cache_key_raw).hexdigest()
+
+    def lead() -> Tuple[int, Dict[str, Any], str]:
+        charge()
+        # 1) extract text
+        report("extracting", 5)
+        stream = _ChunkStream(t, identity, report=report)
+        try:
+            extracted_id, extracted_text, _ = _get_extracted_text(
+                db, kind, mime, file_bytes, file_sha,
+                on_batch=lambda k, n, done, total_images: report(
+                    "ocr_batch", 5 + 25 * done // total_images,
+                    batch=k, totalBatches=n, processedImages=done, totalImages=total_images,
+                ),
+                on_page=stream.feed if STREAM_CHUNKS else None,
+            )
+            extracted_text = extracted_text or "（解析失败：未提取到文本）"
+            report("text_extracted", 35, chars=len(extracted_text))
+
+            # 2) analyze (with chunking if needed; long PDFs may already have chunk calls in flight)
+            data = stream.finish(extracted_text, on_event=on_event)
+        finally:
+            stream.close()
+
+        report("persisting", 95)
+        row = _save_analysis(
+            db, user_id, t, identity, content_hash, extracted_text, data,
+            file_name=filename, file_mime=mime, file_bytes=file_bytes, extracted_text_id=extracted_id,
+        )
+        report("persisted", 98, analysisId=row.id)
+        return row.id, data, row.display_name
+
+    def resolve() -> Dict[str, Any]:
+        cached, scope = _find_cached_analysis(db, user_id, t, identity, content_hash)
+        if not cached:
+            cached, scope, led = _coalesce_analysis(db, user_id, content_hash, lead, report)
+            if led:
+                row_id, data, display_name = led
+
+        if scope == "own":
+            data, row_id, display_name = _reuse_own_analysis(db, cached, user_id, t)
+        elif scope == "global":
+            # 同一文件（sha 相同）已被其他用户分析过：复制结果，文件与文件名仍用自己的
+            charge()
+            data = json.loads(cached.result_json)
+            report("persisting", 95)
+            new_row = _save_analysis(
+                db, user_id, t, identity, content_hash, _original_content(db, cached), data,
+                file_name=filename, file_mime=mime, file_bytes=file_bytes,
+                extracted_text_id=cached.extracted_text_id,
+            )
+            report("persisted", 98, analysisId=new_row.id)
+            row_id, display_name = new_row.id, new_row.display_name
+
+        return _analysis_result(
+            row_id, display_name, data, t, identity,
+            file_url=f"/v1/contracts/{row_id}/file", file_name=filename,
+            meta=_extraction_meta(db, row_id),
+        )
+
+    return _coalesce_request(user_id, content_hash, report, resolve)
+
+
+# ---- Batch OCR prefetch ----
+# 上传每一页后立即提交后台 OCR，结果写回该页的 UploadBatchFile；finalize 时已完成的页直接复用，
+# 仍在识别中的页通过 _ocr_flight 等待同一次调用，失败/缺失的页再并发补做。
+_ocr_prefetch_executor = ThreadPoolExecutor(max_workers=OCR_PREFETCH_WORKERS, thread_name_prefix="ocr-prefetch")
+_ocr_flight = SingleFlight()
+
+
+def _ocr_page(image_bytes: bytes, mime: str, sha: str) -> str:
+    # 同一张图同时只识别一次（后台预取与 finalize 撞上时共用结果）
+    text, shared = _ocr_flight.do(
+        f"ocr:{sha}",
+        lambda: (_ocr_images_with_openai_single([image_bytes], [mime], timeout=OCR_TIMEOUT_SECONDS) or "").strip(),
+    )
+    if shared:
+        metrics.inc("ocr.prefetch.joined")
+    return text
+
+
+def _store_page_ocr(row_id: int, sha: str, text: Optional[str], status: str):
+    # 只在该页没有被重传（sha 未变）时写回
+    db = SessionLocal()
+    try:
+        db.query(UploadBatchFile).filter(
+            UploadBatchFile.id == row_id,
+            UploadBatchFile.ocr_sha == sha,
+        ).update({"ocr_text": text, "ocr_status": status}, synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+
+
+def _prefetch_page_ocr(row_id: int, sha: str):
+    db = SessionLocal()
+    try:
+        row = db.query(UploadBatchFile).filter(UploadBatchFile.id == row_id).first()
+        if not row or row.ocr_sha != sha or row.ocr_status == "DONE":
+            return
+        image_bytes, mime = row.file_bytes, row.file_mime or "image/png"
+        earlier = [
+            b for (b,) in db.query(UploadBatchFile.file_bytes).filter(
+                UploadBatchFile.user_id == row.user_id,
+                UploadBatchFile.batch_id == row.batch_id,
+                UploadBatchFile.idx < row.idx,
+            )
+        ]
+    finally:
+        db.close()
+
+    if _is_duplicate_page(image_bytes, earlier):
+        # 留在 PENDING：finalize 会再判一次重复（前面那页可能已被重传）
+        metrics.inc("ocr.prefetch.skipped_duplicate")
+        return
+    try:
+        text = _ocr_page(image_bytes, mime, sha)
+    except Exception:
+        # finalize 会重新识别这一页
+        metrics.inc("ocr.prefetch.failed")
+        _store_page_ocr(row_id, sha, None, "FAILED")
+        return
+    metrics.inc("ocr.prefetch.done")
+    _store_page_ocr(row_id, sha, text, "DONE")
+
+
+def _batch_ocr_text(
+    rows: List[UploadBatchFile],
+    on_batch: Optional[Callable[[int, int, int, int], None]] = None,
+) -> str:
+    """
+    Page texts in idx order: prefetched pages as stored, the rest OCR'd now, one call per page,
+    concurrently (joining a prefetch of the same image that is still running).
+    """
+    total = len(rows)
+    texts: List[Optional[str]] = [
+        r.ocr_text if (r.ocr_status == "DONE" and r.ocr_text is not None and r.ocr_sha) else None
+        for r in rows
+    ]
+    dup = set(_duplicate_pages([r.file_bytes for r in rows]))
+    for i in dup:
+        texts[i] = ""
+    todo = [i for i, t in enumerate(texts) if t is None]
+    metrics.inc("ocr.prefetch.hit", total - len(todo))
+    metrics.inc("ocr.prefetch.miss", len(todo))
+    if not todo:
+        if on_batch:
+            on_batch(1, 1, total, total)
+        return "\n\n".join(t.strip() for t in texts if t and t.strip()).strip()
+
+    done_lock = threading.Lock()
+    done = [0]
+
+    def ocr_row(i: int) -> str:
+        r = rows[i]
+        sha = r.ocr_sha or hashlib.sha256(r.file_bytes).hexdigest()
+        text = _ocr_page(r.file_bytes, r.file_mime or "image/png", sha)
+        if r.ocr_sha:
+            _store_page_ocr(r.id, sha, text, "DONE")  # finalize 失败重试时不必再识别
+        with done_lock:
+            done[0] += 1
+            if on_batch:
+                on_batch(done[0], len(todo), total - len(todo) + done[0], total)
+        return text
+
+    try:
+        page_texts = run_ordered(
+            ocr_row,
+            todo,
+            max_workers=OCR_CONCURRENCY,
+            item_timeout=_call_deadline(OCR_TIMEOUT_SECONDS),
+            thread_name_prefix="ocr",
+        )
+    except TaskTimeoutError as e:
+        raise HTTPException(
+            status_code=504,
+            detail=f"OCR of page {rows[todo[e.index]].idx}/{total} timed out ({int(e.timeout)}s)",
+        )
+    for i, t in zip(todo, page_texts):
+        texts[i] = t
+    return "\n\n".join(t.strip() for t in texts if t and t.strip()).strip()
+
+
+def _check_batch_ready(db, user_id: int, batch_id: str) -> UploadBatch:
+    batch = (
+        db.query(UploadBatch)
+        .filter(UploadBatch.user_id == user_id, UploadBatch.batch_id == batch_id)
+        .first()
+    )
+    if not batch:
+        raise HTTPException(status_code=404, detail="Batch not found")
+
+    received = (
+        db.query(UploadBatchFile)
+        .filter(UploadBatchFile.user_id == user_id, UploadBatchFile.batch_id == batch_id)
+        .count()
+    )
+    if received < batch.total:
+        raise HTTPException(status_code=400, detail=f"Batch not complete: received {received}/{batch.total}")
+    return batch
+
+
+def _run_batch_finalize(
+    db,
+    user_id: int,
+    batch_id: str,
+    charge: Callable[[], Any],
+    report: Callable[..., None] = _noop_report,
+) -> Dict[str, Any]:
+    """
+    Duplicate finalize calls for the same batch wait for the running one and get its result
+    (the batch rows are deleted by the first call, so a second run could not succeed anyway).
+    """
+    result, shared = _analysis_flight.do(
+        f"batch:{user_id}:{batch_id}",
+        lambda: _finalize_batch_once(db, user_id, batch_id, charge, report),
+        on_wait=lambda: report("waiting", 30),
+    )
+    metrics.inc("singleflight.coalesced" if shared else "singleflight.leader")
+    return result
+
+
+def _finalize_batch_once(
+    db,
+    user_id: int,
+    batch_id: str,
+    charge: Callable[[], Any],
+    report: Callable[..., None],
+) -> Dict[str, Any]:
+    batch = _check_batch_ready(db, user_id, batch_id)
+    total = batch.total
+    t = batch.contract_type
+    identity = batch.identity
+
+    charge()
+
+    report("extracting", 5)
+    rows = (
+        db.query(UploadBatchFile)
+        .filter(UploadBatchFile.user_id == user_id, UploadBatchFile.batch_id == batch_id)
+        .order_by(UploadBatchFile.idx.asc())
+        .all()
+    )
+    on_batch = lambda k, n, done, total_images: report(
+        "ocr_batch", 5 + 25 * done // total_images,
+        batch=k, totalBatches=n, processedImages=done, totalImages=total_images,
+    )
+    if OCR_PREFETCH:
+        extracted_text = _batch_ocr_text(rows, on_batch=on_batch)
+    else:
+        extracted_text = _ocr_images_with_openai_multi(
+            [r.file_bytes for r in rows],
+            [(r.file_mime or "image/png") for r in rows],
+            on_batch=on_batch,
+        )
+    extracted_text = (extracted_text or "").strip() or "（解析失败：未提取到文本）"
+    report("text_extracted", 35, chars=len(extracted_text))
+
+    content_hash = _text_content_hash(t, identity, hashlib.sha256(extracted_text.encode("utf-8")).hexdigest())
+
+    # OCR 结果相同（同一批照片被任何用户分析过）则跳过模型调用
+    cached, _ = _find_cached_analysis(db, user_id, t, identity, content_hash)
+    if cached:
+        data = json.loads(cached.result_json)
+    else:
+        data = _analyze_with_chunking(extracted_text, t, identity, report=report)
+
+    report("persisting", 95)
+    new_row = _save_analysis(db, user_id, t, identity, content_hash, extracted_text, data)
+    report("persisted", 98, analysisId=new_row.id)
+
+    # cleanup
+    db.query(UploadBatchFile).filter(
+        UploadBatchFile.user_id == user_id,
+        UploadBatchFile.batch_id == batch_id
+    ).delete(synchronize_session=False)
+    db.query(UploadBatch).filter(
+        UploadBatch.user_id == user_id,
+        UploadBatch.batch_id == batch_id
+    ).delete(synchronize_session=False)
+    db.commit()
+
+    return _analysis_result(
+        new_row.id, new_row.display_name, data, t, identity, original_fallback=extracted_text,
+        meta={"processedImages": total, "totalImages": total, "batchId": batch_id, "pending": False},
+    )
+
+
 @app.post("/v1/contracts/analyze/text", response_model=AnalysisResult)
 def analyze_text(req: AnalyzeTextRequest, authorization: Optional[str] = Header(default=None)):
     user_id = _get_user_id_from_auth(authorization)
@@ -974,76 +2729,28 @@ def analyze_text(req: AnalyzeTextRequest, authorization: Optional[str] = Header(
     if not content:
         raise HTTPException(status_code=400, detail="Empty content")
 
-    cache_key_raw = (PROMPT_VERSION + "|" + t + "|" + req.identity + "|" + content).encode("utf-8")
-    content_hash = hashlib.sha256(cache_key_raw).hexdigest()
-
     db = SessionLocal()
+    charge, refund = _refundable_charge(db, user_id)
     try:
-        cached = (
-            db.query(Analysis)
-            .filter(
-                Analysis.user_id == user_id,
-                Analysis.contract_type == t,
-                Analysis.identity == req.identity,
-                Analysis.prompt_version == PROMPT_VERSION,
-                Analysis.content_hash == content_hash,
-            )
-            .order_by(Analysis.created_at.desc())
-            .first()
-        )
-        if cached:
-            data = json.loads(cached.result_json)
-            row_id = cached.id
-            display_name = (cached.display_name or "").strip()
-            if not display_name:
-                display_name = _gen_contract_display_name(db, user_id, t)
-                cached.display_name = display_name
-                db.add(cached)
-                db.commit()
-        else:
-            _require_credits(db, user_id, cost=1)
-            data = _analyze_with_chunking(content, t, req.identity)
-            display_name = _gen_contract_display_name(db, user_id, t)
-            new_row = Analysis(
-                user_id=user_id,
-                contract_type=t,
-                identity=req.identity,
-                prompt_version=PROMPT_VERSION,
-                content_hash=content_hash,
-                original_content=content,
-                result_json=json.dumps(data, ensure_ascii=False),
-                file_name=None,
-                file_mime=None,
-                file_bytes=None,
-                display_name=display_name,
-            )
-            db.add(new_row)
-            db.commit()
-            db.refresh(new_row)
-            row_id = new_row.id
-
-        now = datetime.now().isoformat()
-        display_name = _gen_contract_display_name(db, user_id, t)
-
-        return {
-            "id": str(row_id),
-            "name": display_name,
-            "date": now,
-            "score": float(data.get("score", 0) or 0),
-            "riskSummary": str(data.get("riskSummary", "") or ""),
-            "clauses": data.get("clauses", []) or [],
-            "originalContent": str(data.get("originalContent", content) or content),
-            "status": "completed",
-            "type": t,
-            "identity": req.identity,
-            "promptVersion": PROMPT_VERSION,
-            "imagePreview": None,
-            "fileUrl": None,  # TEXT analysis has no original file to download
-        }
+        return _run_text_analysis(db, user_id, t, req.identity, content, charge=charge)
+    except Exception:
+        refund()
+        raise
     finally:
         db.close()
 
 
+async def _read_upload(file: UploadFile) -> bytes:
+    file_bytes = await file.read()
+    if not file_bytes:
+        raise HTTPException(status_code=400, detail="Empty file")
+
+    # Hard limit: 50MB
+    if len(file_bytes) > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail="File too large (max 50MB)")
+    return file_bytes
+
+
 @app.post("/v1/contracts/analyze/upload", response_model=AnalysisResult)
 async def analyze_upload(
     authorization: Optional[str] = Header(default=None),
@@ -1054,118 +2761,146 @@ async def analyze_upload(
     user_id = _get_user_id_from_auth(authorization)
 
     t = validate_contract_type(type)
+    file_bytes = await _read_upload(file)
+    mime = file.content_type or "application/octet-stream"
+    filename = file.filename or "upload"
 
-    file_bytes = await file.read()
-    if not file_bytes:
-        raise HTTPException(status_code=400, detail="Empty file")
+    def run() -> Dict[str, Any]:
+        db = SessionLocal()
+        charge, refund = _refundable_charge(db, user_id)
+        try:
+            return _run_upload_analysis(db, user_id, t, identity, filename, mime, file_bytes, charge=charge)
+        except Exception:
+            refund()
+            raise
+        finally:
+            db.close()
 
-    # Hard limit: 50MB
-    if len(file_bytes) > MAX_UPLOAD_BYTES:
-        raise HTTPException(status_code=413, detail="File too large (max 50MB)")
+    # 解析 / OCR / 模型调用都是阻塞的：放到线程池，别卡住事件循环上的其他请求
+    return await run_in_threadpool(run)
 
-    mime = file.content_type or "application/octet-stream"
-    filename = file.filename or "upload"
 
-    # cache based on raw file hash + prompt version + identity/type
-    file_sha = hashlib.sha256(file_bytes).hexdigest()
-    cache_key_raw = (PROMPT_VERSION + "|" + t + "|" + identity + "|" + file_sha).encode("utf-8")
-    content_hash = hashlib.sha256(cache_key_raw).hexdigest()
+# =========================
+# Streaming Analysis (SSE)
+# =========================
+# 与同步接口同一条流水线、同样落库，只是把模型正在输出的结果提前推给前端：
+#   event: clause       每条解析完成的风险条款
+#   event: score / riskSummary
+#   event: result       与同步接口相同的最终结果（缓存命中/长合同分块时只有这一条）
+#   event: error        {"status": ..., "detail": ...}
+SSE_KEEPALIVE_SECONDS = float(os.getenv("SSE_KEEPALIVE_SECONDS", "15"))
+_STREAM_EVENTS = ("clause", "score", "riskSummary")
 
-    db = SessionLocal()
-    try:
-        cached = (
-            db.query(Analysis)
-            .filter(
-                Analysis.user_id == user_id,
-                Analysis.contract_type == t,
-                Analysis.identity == identity,
-                Analysis.prompt_version == PROMPT_VERSION,
-                Analysis.content_hash == content_hash,
-            )
-            .order_by(Analysis.created_at.desc())
-            .first()
-        )
-        if cached:
-            data = json.loads(cached.result_json)
-            row_id = cached.id
-            display_name = (cached.display_name or "").strip()
-            if not display_name:
-                display_name = _gen_contract_display_name(db, user_id, t)
-                cached.display_name = display_name
-                db.add(cached)
-                db.commit()
-        else:
-            _require_credits(db, user_id, cost=1)
-            # 1) extract text
-            ext = (os.path.splitext(filename)[1] or "").lower()
-            mime = (file.content_type or "application/octet-stream").lower()
-            
-            # ✅ 新增：docx 先抽文本（不 OCR、不转 PDF）
-            if ext == ".docx" or mime == "application/vnd.openxmlformats-officedocument.wordprocessingml.document":
-                extracted_text = _extract_docx_text(file_bytes)
-
-            elif ext == ".pdf" or mime == "application/pdf":
-                extracted_text = _extract_pdf_text_or_ocr(file_bytes)
-
-            # （如果你要保留图片，就加上 image 分支；你现在说只要 pdf/docx，就不加）
-            elif mime.startswith("image/") or ext in [".png", ".jpg", ".jpeg", ".webp", ".gif"]:
-              # mime 兜底：如果 mime 不像 image，就按扩展名推断
-                if not mime.startswith("image/"):
-                    if ext in [".jpg", ".jpeg"]:
-                        mime = "image/jpeg"
-                    elif ext == ".webp":
-                        mime = "image/webp"
-                    else:
-                        mime = "image/png"
-
-                extracted_text = _ocr_images_with_openai([file_bytes], [mime])
-            
-            else:
-                raise HTTPException(status_code=400, detail=f"Unsupported file type: {mime} ({ext})")
 
-            extracted_text = (extracted_text or "").strip() or "（解析失败：未提取到文本）"
+def _sse(event: str, data: Any, event_id: Optional[int] = None) -> str:
+    head = f"id: {event_id}\n" if event_id is not None else ""
+    return f"{head}event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
 
-            # 2) analyze (with chunking if needed)
-            data = _analyze_with_chunking(extracted_text, t, identity)
-            display_name = _gen_contract_display_name(db, user_id, t)
-            new_row = Analysis(
-                user_id=user_id,
-                contract_type=t,
-                identity=identity,
-                prompt_version=PROMPT_VERSION,
-                content_hash=content_hash,
-                original_content=extracted_text,
-                result_json=json.dumps(data, ensure_ascii=False),
-                file_name=filename,
-                file_mime=mime,
-                file_bytes=file_bytes,
-                display_name=display_name,
+
+def _stream_analysis(run: Callable[[Callable[[str, Any], None]], Dict[str, Any]]) -> StreamingResponse:
+    """
+    run(on_event) executes the pipeline in a worker thread (with its own db session);
+    its events are relayed to the client as they arrive. A client disconnect does not
+    cancel the analysis: it is charged and saved exactly like the non-streaming call.
+    Waiting for the next event happens on the event loop, not in a threadpool worker.
+    """
+    q = AsyncHandoff()
+    t0 = time.perf_counter()
+    first_clause = [True]
+
+    def on_event(name: str, value: Any):
+        if name not in _STREAM_EVENTS:
+            return
+        if name == "clause" and first_clause[0]:
+            first_clause[0] = False
+            metrics.observe("analysis.stream.time_to_first_clause_s", time.perf_counter() - t0)
+        q.put((name, value))
+
+    def work():
+        try:
+            result = run(on_event)
+            metrics.observe("analysis.stream.time_to_result_s", time.perf_counter() - t0)
+            q.put(("result", result))
+        except HTTPException as e:
+            q.put(("error", {"status": e.status_code, "detail": e.detail}))
+        except Exception as e:
+            q.put(("error", {"status": 500, "detail": f"{type(e).__name__}: {e}"}))
+        finally:
+            q.put(None)
+
+    threading.Thread(target=work, name="sse-analysis", daemon=True).start()
+
+    async def events():
+        while True:
+            try:
+                item = await q.get(timeout=SSE_KEEPALIVE_SECONDS)
+            except queue.Empty:
+                yield ": keepalive\n\n"
+                continue
+            if item is None:
+                return
+            yield _sse(*item)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.post("/v1/contracts/analyze/text/stream")
+def analyze_text_stream(req: AnalyzeTextRequest, authorization: Optional[str] = Header(default=None)):
+    user_id = _get_user_id_from_auth(authorization)
+
+    t = validate_contract_type(req.type)
+    content = (req.content or "").strip()
+    if not content:
+        raise HTTPException(status_code=400, detail="Empty content")
+
+    def run(on_event: Callable[[str, Any], None]) -> Dict[str, Any]:
+        db = SessionLocal()
+        charge, refund = _refundable_charge(db, user_id)
+        try:
+            return _run_text_analysis(db, user_id, t, req.identity, content, charge=charge, on_event=on_event)
+        except Exception:
+            refund()
+            raise
+        finally:
+            db.close()
+
+    return _stream_analysis(run)
+
+
+@app.post("/v1/contracts/analyze/upload/stream")
+async def analyze_upload_stream(
+    authorization: Optional[str] = Header(default=None),
+    type: str = Form("general"),
+    identity: Literal["A", "B"] = Form(...),
+    file: UploadFile = File(...),
+):
+    user_id = _get_user_id_from_auth(authorization)
+
+    t = validate_contract_type(type)
+    file_bytes = await _read_upload(file)
+    mime = file.content_type or "application/octet-stream"
+    filename = file.filename or "upload"
+    _detect_upload_kind(filename, mime)  # unsupported types fail as a plain 400, not mid-stream
+
+    def run(on_event: Callable[[str, Any], None]) -> Dict[str, Any]:
+        db = SessionLocal()
+        charge, refund = _refundable_charge(db, user_id)
+        try:
+            return _run_upload_analysis(
+                db, user_id, t, identity, filename, mime, file_bytes, charge=charge, on_event=on_event,
             )
-            db.add(new_row)
-            db.commit()
-            db.refresh(new_row)
-            row_id = new_row.id
+        except Exception:
+            refund()
+            raise
+        finally:
+            db.close()
 
-        now = datetime.now().isoformat()
+    return _stream_analysis(run)
 
-        return {
-            "id": str(row_id),
-            "name": display_name,
-            "date": now,
-            "score": float(data.get("score", 0) or 0),
-            "riskSummary": str(data.get("riskSummary", "") or ""),
-            "clauses": data.get("clauses", []) or [],
-            "originalContent": str(data.get("originalContent", "") or ""),
-            "status": "completed",
-            "type": t,
-            "identity": identity,
-            "promptVersion": PROMPT_VERSION,
-            "imagePreview": None,
-            "fileUrl": f"/v1/contracts/{row_id}/file",
-            "fileName": filename,
-        }
-    finally:
-        db.close()
 
 @app.post("/v1/contracts/analyze/upload/batch", response_model=AnalysisResult)
 async def analyze_upload_batch(
@@ -1190,11 +2925,7 @@ async def analyze_upload_batch(
 
     t = validate_contract_type(type)
 
-    file_bytes = await file.read()
-    if not file_bytes:
-        raise HTTPException(status_code=400, detail="Empty file")
-    if len(file_bytes) > MAX_UPLOAD_BYTES:
-        raise HTTPException(status_code=413, detail="File too large (max 50MB)")
+    file_bytes = await _read_upload(file)
 
     mime = (file.content_type or "application/octet-stream").lower()
     filename = file.filename or f"page_{idx}"
@@ -1248,23 +2979,33 @@ async def analyze_upload_batch(
             )
             .first()
         )
+        page_sha = hashlib.sha256(file_bytes).hexdigest()
         if existing:
+            if existing.ocr_sha != page_sha:
+                # 换了图片：作废这一页的 OCR 结果（同一张图重传则保留）
+                existing.ocr_text = None
+                existing.ocr_status = "PENDING"
+                existing.ocr_sha = page_sha
             existing.file_name = filename
             existing.file_mime = mime
             existing.file_bytes = file_bytes
             db.add(existing)
+            page = existing
         else:
-            db.add(
-                UploadBatchFile(
-                    user_id=user_id,
-                    batch_id=batch_id,
-                    idx=idx,
-                    file_name=filename,
-                    file_mime=mime,
-                    file_bytes=file_bytes,
-                )
+            page = UploadBatchFile(
+                user_id=user_id,
+                batch_id=batch_id,
+                idx=idx,
+                file_name=filename,
+                file_mime=mime,
+                file_bytes=file_bytes,
+                ocr_status="PENDING",
+                ocr_sha=page_sha,
             )
+            db.add(page)
         db.commit()
+        if OCR_PREFETCH and page.ocr_status != "DONE":
+            _ocr_prefetch_executor.submit(_prefetch_page_ocr, page.id, page_sha)
 
         # 重新统计 received
         received = (
@@ -1311,95 +3052,439 @@ def finalize_upload_batch(req: BatchFinalizeRequest, authorization: Optional[str
     if not batch_id:
         raise HTTPException(status_code=400, detail="Missing batch_id")
 
+    # 进度可通过 /v1/progress/{batch_id} 订阅（OCR 分批、抽取、分块分析、落库）
+    channel = _batch_channel(user_id, batch_id)
+    progress_hub.open(channel, user_id)
     db = SessionLocal()
+    charge, refund = _refundable_charge(db, user_id)
     try:
-        batch = (
-            db.query(UploadBatch)
-            .filter(UploadBatch.user_id == user_id, UploadBatch.batch_id == batch_id)
-            .first()
+        result = _run_batch_finalize(db, user_id, batch_id, charge=charge, report=_hub_reporter(channel))
+    except Exception as e:
+        refund()
+        _close_progress([channel], error=e)
+        raise
+    finally:
+        db.close()
+    _close_progress([channel], result=result)
+    return result
+
+# =========================
+# Analysis Jobs (async submit/poll)
+# =========================
+# POST /v1/jobs/analyze/...  -> 立即返回 jobId（提交时预留 1 额度）
+# GET  /v1/jobs/{job_id}     -> stage / progress / 最终 AnalysisResult
+# 任务落库，进程重启后未完成的任务会重新入队。
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+MAX_ACTIVE_JOBS_PER_USER = int(os.getenv("MAX_ACTIVE_JOBS_PER_USER", "3"))
+
+_job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="job")
+
+
+class AnalysisJobResponse(BaseModel):
+    jobId: str
+    kind: str
+    status: Literal["QUEUED", "RUNNING", "SUCCEEDED", "FAILED"]
+    stage: str
+    progress: int
+    result: Optional[AnalysisResult] = None
+    error: Optional[str] = None
+    createdAt: Optional[str] = None
+    updatedAt: Optional[str] = None
+
+
+def _job_response(job: AnalysisJob) -> Dict[str, Any]:
+    return {
+        "jobId": job.job_id,
+        "kind": job.kind,
+        "status": job.status,
+        "stage": job.stage,
+        "progress": int(job.progress or 0),
+        "result": json.loads(job.result_json) if job.result_json else None,
+        "error": job.error,
+        "createdAt": job.created_at.isoformat() if job.created_at else None,
+        "updatedAt": job.updated_at.isoformat() if job.updated_at else None,
+    }
+
+
+def _update_job(db, job_id: str, **fields):
+    fields["updated_at"] = datetime.utcnow()
+    db.query(AnalysisJob).filter(AnalysisJob.job_id == job_id).update(fields, synchronize_session=False)
+    db.commit()
+
+
+def _settle_job_credits(db, job: AnalysisJob, consumed: bool):
+    """
+    Idempotent: only a RESERVED job can move to SETTLED / REFUNDED.
+    """
+    state = "SETTLED" if consumed else "REFUNDED"
+    n = (
+        db.query(AnalysisJob)
+        .filter(AnalysisJob.job_id == job.job_id, AnalysisJob.credit_state == "RESERVED")
+        .update({"credit_state": state}, synchronize_session=False)
+    )
+    if n and not consumed and job.credits_reserved:
+        _refund_credits(db, job.user_id, int(job.credits_reserved))
+    db.commit()
+
+
+def _run_job(job_id: str):
+    db = SessionLocal()
+    try:
+        # claim（原子更新，防止重复执行）
+        claimed = (
+            db.query(AnalysisJob)
+            .filter(AnalysisJob.job_id == job_id, AnalysisJob.status == "QUEUED")
+            .update({"status": "RUNNING", "stage": "started", "updated_at": datetime.utcnow()}, synchronize_session=False)
         )
-        if not batch:
-            raise HTTPException(status_code=404, detail="Batch not found")
+        db.commit()
+        if not claimed:
+            return
+        job = db.query(AnalysisJob).filter(AnalysisJob.job_id == job_id).first()
+
+        consumed = [False]
+        channels = _job_channels(job)
+        for ch in channels:
+            progress_hub.open(ch, job.user_id)
+        publish = _hub_reporter(*channels)
+
+        def charge():
+            # 额度已在提交时预留，这里只记录“流水线确实用掉了”
+            consumed[0] = True
+
+        def report(stage: str, progress: int, **detail: Any):
+            # 分块分析时会在分块线程里回调：不能共用本线程的 session；
+            # 任务结束后（失败时仍在跑的分块）的回调不再覆盖状态
+            s = SessionLocal()
+            try:
+                s.query(AnalysisJob).filter(
+                    AnalysisJob.job_id == job_id, AnalysisJob.status == "RUNNING"
+                ).update(
+                    {"stage": stage, "progress": int(progress), "updated_at": datetime.utcnow()},
+                    synchronize_session=False,
+                )
+                s.commit()
+            finally:
+                s.close()
+            publish(stage, progress, **detail)
 
-        total = batch.total
-        received = (
-            db.query(UploadBatchFile)
-            .filter(UploadBatchFile.user_id == user_id, UploadBatchFile.batch_id == batch_id)
-            .count()
+        try:
+            if job.kind == "text":
+                result = _run_text_analysis(
+                    db, job.user_id, job.contract_type, job.identity, job.input_text or "", charge, report
+                )
+            elif job.kind == "upload":
+                result = _run_upload_analysis(
+                    db, job.user_id, job.contract_type, job.identity,
+                    job.file_name or "upload", job.file_mime or "", job.file_bytes or b"", charge, report,
+                )
+            elif job.kind == "batch":
+                result = _run_batch_finalize(db, job.user_id, job.batch_id or "", charge, report)
+            else:
+                raise HTTPException(status_code=400, detail=f"Unknown job kind: {job.kind}")
+        except Exception as e:
+            db.rollback()
+            detail = e.detail if isinstance(e, HTTPException) else f"{type(e).__name__}: {e}"
+            # 先结算额度再标记结束：客户端看到 FAILED 时退款已到账
+            _settle_job_credits(db, job, consumed=False)
+            _update_job(
+                db, job_id, status="FAILED", stage="failed", error=str(detail),
+                input_text=None, file_bytes=None, finished_at=datetime.utcnow(),
+            )
+            _close_progress(channels, error=e)
+            return
+
+        _settle_job_credits(db, job, consumed=consumed[0])
+        _update_job(
+            db, job_id, status="SUCCEEDED", stage="done", progress=100,
+            result_json=json.dumps(result, ensure_ascii=False), analysis_id=int(result["id"]),
+            input_text=None, file_bytes=None, finished_at=datetime.utcnow(),
         )
-        if received < total:
-            raise HTTPException(status_code=400, detail=f"Batch not complete: received {received}/{total}")
+        _close_progress(channels, result=result)
+    finally:
+        db.close()
 
-        _require_credits(db, user_id, cost=1)
 
-        rows = (
-            db.query(UploadBatchFile)
-            .filter(UploadBatchFile.user_id == user_id, UploadBatchFile.batch_id == batch_id)
-            .order_by(UploadBatchFile.idx.asc())
+def _submit_job(db, user_id: int, kind: str, t: str, identity: str, **inputs) -> Dict[str, Any]:
+    active = (
+        db.query(AnalysisJob)
+        .filter(AnalysisJob.user_id == user_id, AnalysisJob.status.in_(["QUEUED", "RUNNING"]))
+        .count()
+    )
+    if active >= MAX_ACTIVE_JOBS_PER_USER:
+        raise HTTPException(status_code=429, detail=f"Too many active jobs (max {MAX_ACTIVE_JOBS_PER_USER})")
+
+    # 预留额度（余额不足直接 402）
+    _require_credits(db, user_id, cost=1)
+
+    job = AnalysisJob(
+        job_id="j_" + uuid.uuid4().hex,
+        user_id=user_id,
+        kind=kind,
+        status="QUEUED",
+        stage="queued",
+        progress=0,
+        contract_type=t,
+        identity=identity,
+        credits_reserved=1,
+        credit_state="RESERVED",
+        **inputs,
+    )
+    db.add(job)
+    db.commit()
+    db.refresh(job)
+
+    progress_hub.open(_job_channel(job.job_id), user_id)
+    progress_hub.publish(_job_channel(job.job_id), "queued", 0)
+    _job_executor.submit(_run_job, job.job_id)
+    return _job_response(job)
+
+
+@app.on_event("startup")
+def _resume_jobs():
+    """
+    Re-queue jobs interrupted by a restart (RUNNING -> QUEUED) and hand every QUEUED job to the pool.
+    Assumes a single server process owns the job table.
+    """
+    db = SessionLocal()
+    try:
+        db.query(AnalysisJob).filter(AnalysisJob.status == "RUNNING").update(
+            {"status": "QUEUED", "stage": "queued", "updated_at": datetime.utcnow()}, synchronize_session=False
+        )
+        db.commit()
+        ids = [
+            r.job_id
+            for r in db.query(AnalysisJob.job_id)
+            .filter(AnalysisJob.status == "QUEUED")
+            .order_by(AnalysisJob.created_at.asc())
             .all()
+        ]
+    finally:
+        db.close()
+    for job_id in ids:
+        _job_executor.submit(_run_job, job_id)
+
+
+@app.post("/v1/jobs/analyze/text", response_model=AnalysisJobResponse)
+def submit_text_job(req: AnalyzeTextRequest, authorization: Optional[str] = Header(default=None)):
+    user_id = _get_user_id_from_auth(authorization)
+
+    t = validate_contract_type(req.type)
+    content = (req.content or "").strip()
+    if not content:
+        raise HTTPException(status_code=400, detail="Empty content")
+
+    db = SessionLocal()
+    try:
+        return _submit_job(db, user_id, "text", t, req.identity, input_text=content)
+    finally:
+        db.close()
+
+
+@app.post("/v1/jobs/analyze/upload", response_model=AnalysisJobResponse)
+async def submit_upload_job(
+    authorization: Optional[str] = Header(default=None),
+    type: str = Form("general"),
+    identity: Literal["A", "B"] = Form(...),
+    file: UploadFile = File(...),
+):
+    user_id = _get_user_id_from_auth(authorization)
+
+    t = validate_contract_type(type)
+    file_bytes = await _read_upload(file)
+    filename = file.filename or "upload"
+    _, mime = _detect_upload_kind(filename, file.content_type or "application/octet-stream")
+
+    db = SessionLocal()
+    try:
+        return _submit_job(
+            db, user_id, "upload", t, identity,
+            file_name=filename, file_mime=mime, file_bytes=file_bytes,
         )
-        image_bytes_list = [r.file_bytes for r in rows]
-        mime_list = [(r.file_mime or "image/png") for r in rows]
+    finally:
+        db.close()
 
-        extracted_text = _ocr_images_with_openai_multi(image_bytes_list, mime_list)
-        extracted_text = (extracted_text or "").strip() or "（解析失败：未提取到文本）"
 
-        t = batch.contract_type
-        identity = batch.identity
+@app.post("/v1/jobs/analyze/upload/batch/finalize", response_model=AnalysisJobResponse)
+def submit_batch_finalize_job(req: BatchFinalizeRequest, authorization: Optional[str] = Header(default=None)):
+    user_id = _get_user_id_from_auth(authorization)
+    batch_id = (req.batch_id or "").strip()
+    if not batch_id:
+        raise HTTPException(status_code=400, detail="Missing batch_id")
 
-        data = _analyze_with_chunking(extracted_text, t, identity)
+    db = SessionLocal()
+    try:
+        batch = _check_batch_ready(db, user_id, batch_id)
+        return _submit_job(db, user_id, "batch", batch.contract_type, batch.identity, batch_id=batch_id)
+    finally:
+        db.close()
 
-        cache_key_raw = (PROMPT_VERSION + "|" + t + "|" + identity + "|" + hashlib.sha256(extracted_text.encode("utf-8")).hexdigest()).encode("utf-8")
-        content_hash = hashlib.sha256(cache_key_raw).hexdigest()
-        display_name= _gen_contract_display_name(db, user_id, t)
-        new_row = Analysis(
-            user_id=user_id,
-            contract_type=t,
-            identity=identity,
-            prompt_version=PROMPT_VERSION,
-            content_hash=content_hash,
-            original_content=extracted_text,
-            result_json=json.dumps(data, ensure_ascii=False),
-            file_name=None,
-            file_mime=None,
-            file_bytes=None,
-            display_name=display_name,
+
+@app.get("/v1/jobs/{job_id}", response_model=AnalysisJobResponse)
+def get_job(job_id: str, authorization: Optional[str] = Header(default=None)):
+    user_id = _get_user_id_from_auth(authorization)
+    db = SessionLocal()
+    try:
+        job = (
+            db.query(AnalysisJob)
+            .filter(AnalysisJob.job_id == (job_id or "").strip(), AnalysisJob.user_id == user_id)
+            .first()
         )
-        db.add(new_row)
-        db.commit()
-        db.refresh(new_row)
+        if not job:
+            raise HTTPException(status_code=404, detail="Job not found")
+        return _job_response(job)
+    finally:
+        db.close()
 
-        # cleanup
-        db.query(UploadBatchFile).filter(
-            UploadBatchFile.user_id == user_id,
-            UploadBatchFile.batch_id == batch_id
-        ).delete(synchronize_session=False)
-        db.query(UploadBatch).filter(
-            UploadBatch.user_id == user_id,
-            UploadBatch.batch_id == batch_id
-        ).delete(synchronize_session=False)
-        db.commit()
+# =========================
+# Progress Channel
+# =========================
+# GET /v1/progress/{id}         长轮询：?after=<seq>&wait=<秒>，返回 seq 之后的事件
+# GET /v1/progress/{id}/stream  SSE（支持 Last-Event-ID 断线续传）
+# id = 任务 jobId 或上传批次 batchId；只能读取自己的通道。
+# 事件：{"seq", "type", "progress", "ts", ...detail}，type 见 Analysis Pipelines 的阶段说明，
+# 终止事件为 done {analysisId} / failed {status, detail}。
+PROGRESS_LONGPOLL_MAX_SECONDS = float(os.getenv("PROGRESS_LONGPOLL_MAX_SECONDS", "30"))
 
-        now = datetime.now().isoformat()
-        return {
-            "id": str(new_row.id),
-            "name": display_name,
-            "date": now,
-            "score": float(data.get("score", 0) or 0),
-            "riskSummary": str(data.get("riskSummary", "") or ""),
-            "clauses": data.get("clauses", []) or [],
-            "originalContent": str(data.get("originalContent", extracted_text) or extracted_text),
-            "status": "completed",
-            "type": t,
-            "identity": identity,
-            "promptVersion": PROMPT_VERSION,
-            "imagePreview": None,
-            "fileUrl": None,
-            "meta": {"processedImages": total, "totalImages": total, "batchId": batch_id, "pending": False},
-        }
+
+def _job_channel(job_id: str) -> str:
+    return f"job:{job_id}"
+
+
+def _batch_channel(user_id: int, batch_id: str) -> str:
+    # batchId 由前端生成，按用户隔离
+    return f"batch:{user_id}:{batch_id}"
+
+
+def _job_channels(job: AnalysisJob) -> List[str]:
+    # 批次任务同时推送到批次通道：按 batchId 订阅时同步/异步 finalize 都能看到进度
+    channels = [_job_channel(job.job_id)]
+    if job.kind == "batch" and job.batch_id:
+        channels.append(_batch_channel(job.user_id, job.batch_id))
+    return channels
+
+
+def _hub_reporter(*channels: str) -> Callable[..., None]:
+    def report(stage: str, progress: int, **detail: Any):
+        for ch in channels:
+            progress_hub.publish(ch, stage, progress, **detail)
+    return report
+
+
+def _close_progress(
+    channels: List[str],
+    result: Optional[Dict[str, Any]] = None,
+    error: Optional[BaseException] = None,
+):
+    for ch in channels:
+        if error is None:
+            progress_hub.close(ch, "done", 100, analysisId=int((result or {}).get("id") or 0) or None)
+        elif isinstance(error, HTTPException):
+            progress_hub.close(ch, "failed", None, status=error.status_code, detail=error.detail)
+        else:
+            progress_hub.close(ch, "failed", None, status=500, detail=f"{type(error).__name__}: {error}")
+
+
+def _resolve_progress_channel(db, user_id: int, channel_id: str) -> str:
+    """
+    Map a jobId / batchId to the user's channel. A finished job whose channel has expired
+    gets its final state replayed; a batch that has not been finalized yet gets an empty
+    channel that fills once finalize starts.
+    """
+    channel_id = (channel_id or "").strip()
+    job = (
+        db.query(AnalysisJob)
+        .filter(AnalysisJob.job_id == channel_id, AnalysisJob.user_id == user_id)
+        .first()
+    )
+    if job:
+        ch = _job_channel(job.job_id)
+        if progress_hub.owner(ch) is None:
+            progress_hub.open(ch, user_id)
+            if job.status == "SUCCEEDED":
+                progress_hub.close(ch, "done", 100, analysisId=job.analysis_id)
+            elif job.status == "FAILED":
+                progress_hub.close(ch, "failed", job.progress, detail=job.error)
+            else:
+                progress_hub.publish(ch, job.stage or "queued", job.progress)
+        return ch
+
+    ch = _batch_channel(user_id, channel_id)
+    if progress_hub.owner(ch) is None:
+        batch = (
+            db.query(UploadBatch)
+            .filter(UploadBatch.user_id == user_id, UploadBatch.batch_id == channel_id)
+            .first()
+        )
+        if not batch:
+            raise HTTPException(status_code=404, detail="Progress channel not found")
+        progress_hub.open(ch, user_id)
+    return ch
+
+
+def _progress_channel_for(authorization: Optional[str], channel_id: str) -> Tuple[int, str]:
+    user_id = _get_user_id_from_auth(authorization)
+    db = SessionLocal()
+    try:
+        return user_id, _resolve_progress_channel(db, user_id, channel_id)
     finally:
         db.close()
 
+
+# 长轮询 / SSE 等待都在事件循环上（progress_hub.aread），不占线程池：只有查库解析 channel 时借一下线程
+@app.get("/v1/progress/{channel_id}")
+async def get_progress(
+    channel_id: str,
+    after: int = 0,
+    wait: float = 0,
+    authorization: Optional[str] = Header(default=None),
+):
+    user_id, ch = await run_in_threadpool(_progress_channel_for, authorization, channel_id)
+
+    got = await progress_hub.aread(ch, user_id, after=after, timeout=min(max(wait, 0.0), PROGRESS_LONGPOLL_MAX_SECONDS))
+    if got is None:
+        raise HTTPException(status_code=404, detail="Progress channel not found")
+    events, closed = got
+    return {
+        "id": channel_id,
+        "events": events,
+        "next": events[-1]["seq"] if events else after,
+        "closed": closed,
+    }
+
+
+@app.get("/v1/progress/{channel_id}/stream")
+async def stream_progress(
+    channel_id: str,
+    after: int = 0,
+    authorization: Optional[str] = Header(default=None),
+    last_event_id: Optional[str] = Header(default=None),
+):
+    user_id, ch = await run_in_threadpool(_progress_channel_for, authorization, channel_id)
+    if (last_event_id or "").strip().isdigit():
+        after = int(last_event_id.strip())
+
+    async def events():
+        seq = after
+        while True:
+            got = await progress_hub.aread(ch, user_id, after=seq, timeout=SSE_KEEPALIVE_SECONDS)
+            if got is None:
+                return
+            evs, closed = got
+            for ev in evs:
+                seq = ev["seq"]
+                yield _sse(ev["type"], ev, event_id=seq)
+            if closed:
+                return
+            if not evs:
+                yield ": keepalive\n\n"
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 # =========================
 # Share Endpoints (NEW)
 # =========================
@@ -1512,39 +3597,135 @@ def get_share_public(share_id: str):
     finally:
         db.close()
 
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 100
+
+
+def _encode_history_cursor(created_at: datetime, row_id: int) -> str:
+    raw = f"{created_at.isoformat()}|{row_id}".encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def _decode_history_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("utf-8")
+        ts, row_id = raw.rsplit("|", 1)
+        return datetime.fromisoformat(ts), int(row_id)
+    except (ValueError, UnicodeDecodeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def _parse_history_date(value: Optional[str], name: str, end_of_day: bool = False) -> Optional[datetime]:
+    # YYYY-MM-DD（按 UTC 日期；dateTo 含当天）或完整 ISO 时间
+    if not value:
+        return None
+    try:
+        if len(value) == 10:
+            d = datetime.strptime(value, "%Y-%m-%d")
+            return d + timedelta(days=1) if end_of_day else d
+        dt = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        if dt.tzinfo is not None:
+            dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+        return dt
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Invalid {name}: expected YYYY-MM-DD or ISO datetime")
+
+
+def _history_query(
+    db,
+    user_id: int,
+    *,
+    contract_type: Optional[str] = None,
+    identity: Optional[str] = None,
+    min_score: Optional[int] = None,
+    max_score: Optional[int] = None,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    after: Optional[Tuple[datetime, int]] = None,
+    order: str = "desc",
+):
+    q = db.query(
+        Analysis.id,
+        Analysis.display_name,
+        Analysis.contract_type,
+        Analysis.identity,
+        Analysis.score,
+        Analysis.created_at,
+        (Analysis.file_sha.isnot(None)).label("has_file"),
+    ).filter(Analysis.user_id == user_id)
+    if contract_type:
+        q = q.filter(Analysis.contract_type == contract_type)
+    if identity:
+        q = q.filter(Analysis.identity == identity)
+    if min_score is not None:
+        q = q.filter(Analysis.score >= min_score)
+    if max_score is not None:
+        q = q.filter(Analysis.score <= max_score)
+    if start is not None:
+        q = q.filter(Analysis.created_at >= start)
+    if end is not None:
+        q = q.filter(Analysis.created_at < end)
+
+    key = tuple_(Analysis.created_at, Analysis.id)
+    if after is not None:
+        q = q.filter(key < after if order == "desc" else key > after)
+    if order == "desc":
+        return q.order_by(Analysis.created_at.desc(), Analysis.id.desc())
+    return q.order_by(Analysis.created_at.asc(), Analysis.id.asc())
+
+
 @app.get("/v1/contracts/history")
-def history(authorization: Optional[str] = Header(default=None)):
+def history(
+    authorization: Optional[str] = Header(default=None),
+    limit: int = Query(default=HISTORY_PAGE_SIZE, ge=1, le=HISTORY_MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    order: Literal["desc", "asc"] = "desc",
+    contract_type: Optional[str] = Query(default=None, alias="type"),
+    identity: Optional[Literal["A", "B"]] = None,
+    min_score: Optional[int] = Query(default=None, alias="minScore", ge=0, le=100),
+    max_score: Optional[int] = Query(default=None, alias="maxScore", ge=0, le=100),
+    date_from: Optional[str] = Query(default=None, alias="dateFrom"),
+    date_to: Optional[str] = Query(default=None, alias="dateTo"),
+):
+    # 只返回列表摘要（列投影，不读 result_json / original_content）；完整报告走 GET /v1/contracts/{id}
+    # 游标分页：按 (created_at, id) 接着上一页最后一条往后取，翻到多深每页都是一次索引范围扫描
     user_id = _get_user_id_from_auth(authorization)
+    start = _parse_history_date(date_from, "dateFrom")
+    end = _parse_history_date(date_to, "dateTo", end_of_day=True)
+
+    after = _decode_history_cursor(cursor) if cursor else None
+
     db = SessionLocal()
     try:
-        rows = (
-            db.query(Analysis)
-            .filter(Analysis.user_id == user_id)
-            .order_by(Analysis.created_at.desc())
-            .limit(50)
-            .all()
+        q = _history_query(
+            db, user_id, contract_type=contract_type, identity=identity, min_score=min_score,
+            max_score=max_score, start=start, end=end, after=after, order=order,
         )
+        rows = q.limit(limit + 1).all()
+        more = len(rows) > limit
+        rows = rows[:limit]
         return {
             "items": [
                 {
                     "id": str(r.id),
+                    "name": r.display_name or "",
                     "type": r.contract_type,
                     "identity": r.identity,
-                    "promptVersion": r.prompt_version,
+                    "score": int(r.score or 0),
                     "date": r.created_at.isoformat(),
-                    "result": json.loads(r.result_json),
-                    "fileUrl": f"/v1/contracts/{r.id}/file" if r.file_bytes else None,
-		    "fileName": r.file_name,
+                    "hasFile": bool(r.has_file),
+                    "fileUrl": f"/v1/contracts/{r.id}/file" if r.has_file else None,
                 }
                 for r in rows
-            ]
+            ],
+            "nextCursor": _encode_history_cursor(rows[-1].created_at, rows[-1].id) if more else None,
         }
     finally:
         db.close()
 
 
-@app.get("/v1/contracts/{analysis_id}/file")
-def download_file(analysis_id: int, authorization: Optional[str] = Header(default=None)):
+@app.get("/v1/contracts/{analysis_id}")
+def get_analysis(analysis_id: int, authorization: Optional[str] = Header(default=None)):
     user_id = _get_user_id_from_auth(authorization)
     db = SessionLocal()
     try:
@@ -1553,19 +3734,100 @@ def download_file(analysis_id: int, authorization: Optional[str] = Header(defaul
             .filter(Analysis.id == analysis_id, Analysis.user_id == user_id)
             .first()
         )
-        if not row or not row.file_bytes:
-            raise HTTPException(status_code=404, detail="File not found")
+        if not row:
+            raise HTTPException(status_code=404, detail="Analysis not found")
+
+        data = json.loads(row.result_json)
+        out = _analysis_result(
+            row.id, row.display_name or "", data, row.contract_type, row.identity,
+            original_fallback=_original_content(db, row) if not data.get("originalContent") else "",
+            file_url=f"/v1/contracts/{row.id}/file" if row.file_sha else None,
+            file_name=row.file_name,
+            meta=_extraction_meta(db, row.id),
+        )
+        out["date"] = row.created_at.isoformat()
+        out["promptVersion"] = row.prompt_version or PROMPT_VERSION
+        return out
+    finally:
+        db.close()
+
+
+def _content_disposition(filename: str) -> str:
+    # 中文文件名：ASCII 兜底 + RFC 5987 filename*（HTTP 头只能是 latin-1）
+    fallback = filename.encode("ascii", "replace").decode("ascii").replace("?", "_").replace('"', "")
+    return f"attachment; filename=\"{fallback}\"; filename*=UTF-8''{urllib.parse.quote(filename, safe='')}"
 
-        mime = row.file_mime or "application/octet-stream"
-        filename = row.file_name or f"analysis_{analysis_id}"
 
-        return Response(
-            content=row.file_bytes,
-            media_type=mime,
-            headers={"Content-Disposition": f'attachment; filename=\"{filename}\"'},
+@app.get("/v1/contracts/{analysis_id}/file")
+def download_file(
+    analysis_id: int,
+    authorization: Optional[str] = Header(default=None),
+    range_header: Optional[str] = Header(default=None, alias="Range"),
+    if_range: Optional[str] = Header(default=None),
+    if_none_match: Optional[str] = Header(default=None),
+    if_modified_since: Optional[str] = Header(default=None),
+):
+    user_id = _get_user_id_from_auth(authorization)
+    db = SessionLocal()
+    try:
+        row = (
+            db.query(Analysis.file_sha, Analysis.file_mime, Analysis.file_name, Analysis.created_at)
+            .filter(Analysis.id == analysis_id, Analysis.user_id == user_id)
+            .first()
         )
     finally:
         db.close()
+    if not row or not row.file_sha:
+        raise HTTPException(status_code=404, detail="File not found")
+
+    # 内容寻址：sha256 就是强 ETag，同一 analysis 的文件永远不会变
+    etag = f'"{row.file_sha}"'
+    last_modified = http_date(row.created_at or datetime.utcnow())
+    headers = {
+        "ETag": etag,
+        "Last-Modified": last_modified,
+        "Accept-Ranges": "bytes",
+        "Cache-Control": "private, no-cache",
+    }
+    if etag_matches(if_none_match, etag) or (
+        if_none_match is None and not_modified_since(if_modified_since, row.created_at or datetime.utcnow())
+    ):
+        metrics.inc("download.not_modified")
+        return Response(status_code=304, headers=headers)
+
+    f = _open_file_blob(row.file_sha)
+    if f is None:
+        raise HTTPException(status_code=404, detail="File not found")
+    size = os.fstat(f.fileno()).st_size
+
+    # If-Range 不匹配（文件已变）时忽略 Range，整份重发
+    use_range = range_header is not None and (
+        if_range is None or etag_matches(if_range, etag, weak=False) or if_range.strip() == last_modified
+    )
+    try:
+        byte_range = parse_range(range_header, size) if use_range else None
+    except RangeNotSatisfiable:
+        f.close()
+        metrics.inc("download.range_not_satisfiable")
+        return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+
+    start, end = byte_range if byte_range else (0, size - 1)
+    length = max(0, end - start + 1)
+    headers["Content-Length"] = str(length)
+    headers["Content-Disposition"] = _content_disposition(row.file_name or f"analysis_{analysis_id}")
+    status = 200
+    if byte_range:
+        status = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        metrics.inc("download.partial")
+    else:
+        metrics.inc("download.full")
+    return StreamingResponse(
+        iter_file(f, start, length, DOWNLOAD_CHUNK_BYTES),
+        status_code=status,
+        media_type=row.file_mime or "application/octet-stream",
+        headers=headers,
+    )
 
 @app.delete("/v1/analyses/{analysis_id}")
 def delete_one_analysis(analysis_id: int, authorization: Optional[str] = Header(default=None)):
@@ -1581,8 +3843,12 @@ def delete_one_analysis(analysis_id: int, authorization: Optional[str] = Header(
         if not row:
             raise HTTPException(status_code=404, detail="Analysis not found")
 
-        db.delete(row)
-        db.commit()
+        with _blob_store.lock_many([row.file_sha]):
+            db.delete(row)
+            freed = _blob_release(db, [row.file_sha])
+            _extracted_text_release(db, [row.extracted_text_id])
+            db.commit()
+        _blob_unlink(freed)
 
         return {"ok": True, "deleted": 1, "id": analysis_id}
     finally:
@@ -1594,12 +3860,18 @@ def wipe_all_analyses(authorization: Optional[str] = Header(default=None)):
 
     db = SessionLocal()
     try:
-        # 先数一下要删多少条
-        count = db.query(Analysis).filter(Analysis.user_id == user_id).count()
-
-        # 删除该用户所有分析记录（包含 file_bytes，所以“原文件”也没了）
-        db.query(Analysis).filter(Analysis.user_id == user_id).delete(synchronize_session=False)
-        db.commit()
+        # 先数一下要删多少条，顺便取出原文件和提取原文的引用
+        refs = db.query(Analysis.file_sha, Analysis.extracted_text_id).filter(Analysis.user_id == user_id).all()
+        shas = [sha for sha, _ in refs]
+        count = len(refs)
+
+        # 删除该用户所有分析记录；原文件减引用，没有其他记录引用的从磁盘删除，提取原文同样
+        with _blob_store.lock_many(shas):
+            db.query(Analysis).filter(Analysis.user_id == user_id).delete(synchronize_session=False)
+            freed = _blob_release(db, shas)
+            _extracted_text_release(db, [text_id for _, text_id in refs])
+            db.commit()
+        _blob_unlink(freed)
 
         return {"deleted": count}
     finally:
@@ -2193,4 +4465,119 @@ async def wechat_pay_notify(request: Request):
 
 @app.get("/health")
 def health():
-    return {"ok": True}
\ No newline at end of file
+    return {"ok": True}
+
+
+# =========================
+# Metrics
+# =========================
+# /v1/metrics 只对带 X-Metrics-Token 的请求开放；没配置 token 时整个接口关闭（404）
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "").strip()
+
+
+def _derived_metrics() -> Dict[str, Any]:
+    hit_own = metrics.get("analysis_cache.hit_own")
+    hit_global = metrics.get("analysis_cache.hit_global")
+    lookups = hit_own + hit_global + metrics.get("analysis_cache.miss")
+    return {
+        "analysis_cache.hit_rate": ((hit_own + hit_global) / lookups) if lookups else 0.0,
+        "analysis_cache.global_hit_rate": (hit_global / lookups) if lookups else 0.0,
+        # 每次命中 = 省掉一次完整的模型分析
+        "analysis_cache.llm_analyses_saved": hit_own + hit_global,
+        # 重复的并发请求（双击/客户端重试）被合并到正在进行的分析上的比例
+        "singleflight.coalescing_rate": metrics.ratio(
+            "singleflight.coalesced", "singleflight.leader", "singleflight.coalesced"
+        ),
+        "singleflight.in_flight": _analysis_flight.in_flight(),
+        "llm.provider": llm.name,
+        "tokens.tokenizer": tokenizer_name(),
+        "extract.cache.hit_rate": metrics.ratio("extract.cache.hit", "extract.cache.hit", "extract.cache.miss"),
+        "ocr.cache.hit_rate": metrics.ratio("ocr.cache.hit", "ocr.cache.hit", "ocr.cache.miss"),
+        # OCR 图片预处理是否生效（IMAGE_PREP 打开且装了 Pillow）；不生效时下面两个比例恒为 0
+        "imageprep.active": IMAGE_PREP and imageprep_available(),
+        # OCR 图片预处理省下的上传字节 / 视觉 token 比例
+        "imageprep.bytes_saved_ratio": (
+            1 - metrics.ratio("imageprep.bytes_out", "imageprep.bytes_in") if metrics.get("imageprep.bytes_in") else 0.0
+        ),
+        "imageprep.tokens_saved_ratio": (
+            1 - metrics.ratio("imageprep.tokens_out", "imageprep.tokens_in") if metrics.get("imageprep.tokens_in") else 0.0
+        ),
+        # closed | open | half_open；计数器见 llm.retry.* / llm.breaker.* / llm.hedge.*
+        "llm.breaker.state": llm_breaker.state,
+        "llm.hedge.win_rate": metrics.ratio("llm.hedge.won", "llm.hedge.launched"),
+    }
+
+
+@app.get("/v1/metrics")
+def get_metrics(x_metrics_token: Optional[str] = Header(default=None)):
+    if not METRICS_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not x_metrics_token or not secrets.compare_digest(x_metrics_token, METRICS_TOKEN):
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+    snap = metrics.snapshot()
+    snap["derived"] = _derived_metrics()
+    return snap
+
+# =========================
+# Query plan audit
+# =========================
+# 启动时对热路径查询跑 EXPLAIN QUERY PLAN，出现全表扫描（SCAN <table>）或临时 B 树排序
+# （USE TEMP B-TREE，先取出全部匹配行再排序）的查询记到 /v1/metrics
+# （gauges["queryplan.bad_plans"]：查询名 -> 问题步骤）。warn（默认）只记录、照常启动；
+# strict 直接启动失败（CI / 预发环境用）；off 不检查。
+# 命令行 python -m bench.query_plans 有问题计划时总是退出码 1。
+QUERY_PLAN_AUDIT = os.getenv("QUERY_PLAN_AUDIT", "warn").strip().lower()
+
+
+def _hot_queries() -> Dict[str, Any]:
+    """
+    name -> statement，参数取样例值（计划只看形状，不看值）。
+    """
+    sha = "0" * 64
+    now = datetime.utcnow()
+    db = SessionLocal()
+    try:
+        history = lambda **kw: _history_query(db, 1, **kw).limit(21).statement
+        return {
+            "analysis cache probe (own)": _cache_probe_stmt("general", "A", sha, 1),
+            "analysis cache probe (global)": _cache_probe_stmt("general", "A", sha),
+            "analysis by id + user": select(Analysis).where(Analysis.id == 1, Analysis.user_id == 1),
+            "display name count": select(func.count(Analysis.id)).where(
+                Analysis.user_id == 1, Analysis.contract_type == "general"
+            ),
+            "history first page": history(),
+            "history next page": history(after=(now, 1)),
+            "history filtered": history(contract_type="general", identity="A", min_score=60, start=now),
+            "extracted text": select(ExtractedText.id).where(
+                ExtractedText.file_sha == sha, ExtractedText.extractor_version == "docx:3"
+            ),
+            "extracted text references": select(Analysis.id).where(Analysis.extracted_text_id == 1).limit(1),
+            "ocr cache": select(OcrCacheEntry).where(OcrCacheEntry.cache_key == sha),
+            "blob by sha": select(Blob).where(Blob.sha256 == sha),
+            "upload batch": select(UploadBatch).where(UploadBatch.user_id == 1, UploadBatch.batch_id == "b"),
+            "batch pages": select(UploadBatchFile.id)
+            .where(UploadBatchFile.user_id == 1, UploadBatchFile.batch_id == "b")
+            .order_by(UploadBatchFile.idx.asc()),
+            "batch page by idx": select(UploadBatchFile).where(
+                UploadBatchFile.user_id == 1, UploadBatchFile.batch_id == "b", UploadBatchFile.idx == 1
+            ),
+            "batch earlier pages": select(UploadBatchFile.id).where(
+                UploadBatchFile.user_id == 1, UploadBatchFile.batch_id == "b", UploadBatchFile.idx < 3
+            ),
+            "share by share_id": select(AnalysisShare).where(AnalysisShare.share_id == "s"),
+            "job by job_id + user": select(AnalysisJob).where(AnalysisJob.job_id == "j", AnalysisJob.user_id == 1),
+        }
+    finally:
+        db.close()
+
+
+def run_query_plan_audit() -> List[Tuple[str, List[str], List[str]]]:
+    with engine.connect() as conn:
+        return audit_query_plans(conn, _hot_queries())
+
+
+if QUERY_PLAN_AUDIT != "off":
+    _bad = {name: bad for name, _, bad in run_query_plan_audit() if bad}
+    metrics.set("queryplan.bad_plans", _bad)
+    if _bad and QUERY_PLAN_AUDIT == "strict":
+        raise RuntimeError(f"query plan audit: full table scan or temp b-tree sort in {', '.join(_bad)}")
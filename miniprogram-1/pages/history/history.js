@@ -3,7 +3,7 @@ const { request } = require("../../services/request");
 const { getToken } = require("../../services/storage");
 
 /** ========= Cache (localStorage) ========= */
-const HISTORY_CACHE_KEY = "HISTORY_CACHE_V1";
+const HISTORY_CACHE_KEY = "HISTORY_CACHE_V2"; // V2：列表只有摘要字段，详情按需拉取
 const HISTORY_TTL = 60 * 1000; // 60s，你想更省请求就改 120s/300s
 
 function getHistoryCache() {
@@ -104,12 +104,6 @@ function applyDisplayNames(serverItems) {
   return items;
 }
 
-function makeSnippetPreview(text) {
-  const raw = String(text || "").replace(/\s+/g, " ").trim();
-  if (!raw) return "（无合同原文）";
-  return raw.length > 28 ? raw.slice(0, 28) + "…" : raw;
-}
-
 function makeSnippetText(text) {
   const raw = String(text || "").trim();
   if (!raw) return "（无合同原文）";
@@ -118,12 +112,10 @@ function makeSnippetText(text) {
 }
 
 function normalizeItem(item) {
-  const result = item.result || {};
-  const score = clampScore(result.score);
+  const score = clampScore(item.score);
   const risk = scoreToRisk(score);
-  const displayName = item._displayName || "合同";
+  const displayName = item.name || item._displayName || "合同";
 
-  const original = result.originalContent || "";
   return {
     id: String(item.id),
     type: String(item.type || ""),
@@ -138,16 +130,24 @@ function normalizeItem(item) {
     riskText: risk.riskText,
     riskClass: risk.riskClass,
 
-    riskSummary: result.riskSummary || "",
-    originalContent: original,
-    clauses: Array.isArray(result.clauses) ? result.clauses : [],
+    hasFile: !!item.hasFile,
     fileUrl: item.fileUrl || null,
-    promptVersion: item.promptVersion || "",
 
-    snippetPreview: makeSnippetPreview(original),
+    // 原文不在列表里，点开时再拉详情
+    snippetPreview: "点击查看",
   };
 }
 
+/** ========= Detail (GET /v1/contracts/{id}) ========= */
+const detailCache = {}; // id -> detail（页面生命周期内复用）
+
+async function fetchDetail(id) {
+  if (detailCache[id]) return detailCache[id];
+  const d = await request({ url: `/v1/contracts/${id}`, method: "GET" });
+  detailCache[id] = d;
+  return d;
+}
+
 // ✅ 统一：把服务端 items -> 页面 items（并按时间倒序）
 function mapServerToViewItems(raw) {
   const withNames = applyDisplayNames(raw);
@@ -171,6 +171,10 @@ Page({
     items: [],
     deletingId: "",
 
+    // 分页：服务端返回的 nextCursor（null = 没有更多）
+    nextCursor: null,
+    loadingMore: false,
+
     // snippet modal
     snippetOpen: false,
     snippetTitle: "",
@@ -182,7 +186,7 @@ Page({
     // 1) 秒开：先渲染缓存
     const cache = getHistoryCache();
     if (cache && Array.isArray(cache.items)) {
-      this.setData({ items: cache.items, error: "" });
+      this.setData({ items: cache.items, nextCursor: cache.nextCursor || null, error: "" });
     }
 
     // 2) 未登录不请求
@@ -212,7 +216,7 @@ Page({
     // force=false 且缓存仍新鲜：直接用缓存
     const cache = getHistoryCache();
     if (!force && isHistoryFresh(cache, HISTORY_TTL) && Array.isArray(cache.items)) {
-      this.setData({ items: cache.items, loading: false, error: "" });
+      this.setData({ items: cache.items, nextCursor: cache.nextCursor || null, loading: false, error: "" });
       return;
     }
 
@@ -222,14 +226,16 @@ Page({
       const data = await request({ url: "/v1/contracts/history", method: "GET" });
       const raw = Array.isArray(data.items) ? data.items : [];
       const viewItems = mapServerToViewItems(raw);
+      const nextCursor = data.nextCursor || null;
 
       // ✅ 更新页面
-      this.setData({ items: viewItems, loading: false, error: "" });
+      this.setData({ items: viewItems, nextCursor, loading: false, error: "" });
 
       // ✅ 写缓存
       setHistoryCache({
         at: Date.now(),
         items: viewItems,
+        nextCursor,
       });
     } catch (err) {
       console.error("[history] loadHistory fail:", err);
@@ -246,6 +252,37 @@ Page({
     }
   },
 
+  // 触底加载下一页（游标分页，翻多深都一样快）
+  async loadMore() {
+    const cursor = this.data.nextCursor;
+    if (!cursor || this.data.loadingMore || this.data.loading) return;
+
+    this.setData({ loadingMore: true });
+    try {
+      const data = await request({
+        url: `/v1/contracts/history?cursor=${encodeURIComponent(cursor)}`,
+        method: "GET",
+      });
+      const raw = Array.isArray(data.items) ? data.items : [];
+      const seen = {};
+      (this.data.items || []).forEach((x) => { seen[x.id] = true; });
+      const more = mapServerToViewItems(raw).filter((x) => !seen[x.id]);
+      const items = (this.data.items || []).concat(more);
+      const nextCursor = data.nextCursor || null;
+
+      this.setData({ items, nextCursor, loadingMore: false });
+      setHistoryCache({ at: Date.now(), items, nextCursor });
+    } catch (err) {
+      console.error("[history] loadMore fail:", err);
+      this.setData({ loadingMore: false });
+      wx.showToast({ title: "加载失败", icon: "none" });
+    }
+  },
+
+  onReachBottom() {
+    this.loadMore();
+  },
+
   // 顶部刷新按钮（如果你有），也走 force
   refresh() {
     this.loadHistory({ force: true });
@@ -257,7 +294,7 @@ Page({
 
   noop() {},
 
-  openReport(e) {
+  async openReport(e) {
     const ds = (e && e.currentTarget && e.currentTarget.dataset) ? e.currentTarget.dataset : {};
     const id = String(ds.id || "");
     if (!id) return;
@@ -269,25 +306,37 @@ Page({
       return;
     }
 
+    wx.showLoading({ title: "加载中" });
+    let detail;
+    try {
+      detail = await fetchDetail(id);
+    } catch (err) {
+      console.error("[history] detail fail:", err);
+      wx.showToast({ title: (err && err.message) || "加载失败", icon: "none" });
+      return;
+    } finally {
+      wx.hideLoading();
+    }
+
     wx.setStorageSync("ANALYSIS_RESULT", {
       id: hit.id,
       name: hit.name,
       date: hit.date,
       score: hit.score,
-      riskSummary: hit.riskSummary,
-      originalContent: hit.originalContent,
-      clauses: hit.clauses,
-      fileUrl: hit.fileUrl,
+      riskSummary: detail.riskSummary || "",
+      originalContent: detail.originalContent || "",
+      clauses: Array.isArray(detail.clauses) ? detail.clauses : [],
+      fileUrl: detail.fileUrl || hit.fileUrl,
       type: hit.type,
       identity: hit.identity,
-      promptVersion: hit.promptVersion,
+      promptVersion: detail.promptVersion || "",
       status: "completed",
     });
 
     wx.navigateTo({ url: "/pages/report/report" });
   },
 
-  openSnippet(e) {
+  async openSnippet(e) {
     const ds = (e && e.currentTarget && e.currentTarget.dataset) ? e.currentTarget.dataset : {};
     const id = String(ds.id || "");
     if (!id) return;
@@ -301,8 +350,16 @@ Page({
       snippetOpen: true,
       snippetTitle: hit.name,
       snippetMeta: meta,
-      snippetText: makeSnippetText(hit.originalContent),
+      snippetText: "加载中…",
     });
+
+    try {
+      const detail = await fetchDetail(id);
+      this.setData({ snippetText: makeSnippetText(detail.originalContent) });
+    } catch (err) {
+      console.error("[history] detail fail:", err);
+      this.setData({ snippetText: "（加载失败，请稍后重试）" });
+    }
   },
 
   closeSnippet() {
@@ -349,6 +406,7 @@ Page({
     try {
       await request({ url: `/v1/analyses/${id}`, method: "DELETE" });
 
+      delete detailCache[id];
       const next = (this.data.items || []).filter((x) => String(x.id) !== id);
       this.setData({ items: next });
       wx.showToast({ title: "已删除", icon: "success" });
@@ -357,7 +415,7 @@ Page({
       const cache = getHistoryCache();
       if (cache && Array.isArray(cache.items)) {
         const nextCacheItems = cache.items.filter((x) => String(x.id) !== id);
-        setHistoryCache({ at: Date.now(), items: nextCacheItems });
+        setHistoryCache({ at: Date.now(), items: nextCacheItems, nextCursor: cache.nextCursor || null });
       }
     } catch (err) {
       console.error("[history] delete fail:", err);
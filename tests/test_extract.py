@@ -0,0 +1,36 @@
+import time
+
+import pytest
+
+from engine.extract import ExtractionPool, ExtractionTimeout
+
+
+def _quick_items(n):
+    for i in range(n):
+        yield i
+
+
+def _stuck_after_first():
+    yield 0
+    time.sleep(30)
+    yield 1
+
+
+def test_slow_consumer_does_not_count_against_the_worker_timeout():
+    pool = ExtractionPool(max_workers=1, timeout=1.0)
+    got = []
+    for item in pool.stream(_quick_items, 4):
+        got.append(item)
+        time.sleep(0.5)  # caller busy with the previous page (OCR / chunk analysis)
+    assert got == [0, 1, 2, 3]
+
+
+def test_stuck_worker_still_times_out():
+    pool = ExtractionPool(max_workers=1, timeout=1.0)
+    got = []
+    started = time.monotonic()
+    with pytest.raises(ExtractionTimeout):
+        for item in pool.stream(_stuck_after_first):
+            got.append(item)
+    assert got == [0]
+    assert time.monotonic() - started < 10
@@ -0,0 +1,49 @@
+import pytest
+
+from engine.filerange import RangeNotSatisfiable, parse_range
+
+
+def test_no_header_or_other_unit_sends_the_whole_file():
+    assert parse_range(None, 100) is None
+    assert parse_range("", 100) is None
+    assert parse_range("items=0-5", 100) is None
+
+
+def test_closed_range_is_clamped_to_the_end():
+    assert parse_range("bytes=0-9", 100) == (0, 9)
+    assert parse_range("bytes=90-200", 100) == (90, 99)
+
+
+def test_open_ended_range():
+    assert parse_range("bytes=10-", 100) == (10, 99)
+    assert parse_range("bytes=99-", 100) == (99, 99)
+
+
+def test_suffix_range():
+    assert parse_range("bytes=-10", 100) == (90, 99)
+    assert parse_range("bytes=-500", 100) == (0, 99)
+    with pytest.raises(RangeNotSatisfiable):
+        parse_range("bytes=-0", 100)
+
+
+def test_start_past_the_end_is_not_satisfiable():
+    with pytest.raises(RangeNotSatisfiable):
+        parse_range("bytes=100-", 100)
+    with pytest.raises(RangeNotSatisfiable):
+        parse_range("bytes=150-200", 100)
+
+
+@pytest.mark.parametrize("header", ["bytes=-1", "bytes=-10", "bytes=0-", "bytes=0-0"])
+def test_empty_file_has_no_satisfiable_range(header):
+    with pytest.raises(RangeNotSatisfiable):
+        parse_range(header, 0)
+
+
+@pytest.mark.parametrize("header", ["bytes=0-1,5-9", "bytes=-5, 0-1"])
+def test_multiple_ranges_send_the_whole_file(header):
+    assert parse_range(header, 100) is None
+
+
+@pytest.mark.parametrize("header", ["bytes=abc", "bytes=5-2", "bytes=x-9", "bytes=-"])
+def test_malformed_range_sends_the_whole_file(header):
+    assert parse_range(header, 100) is None
@@ -0,0 +1,70 @@
+import random
+
+from engine.segmenter import StreamingPacker, _split_oversized, chunk_contract
+
+
+def _count(text):
+    return len(text)
+
+
+def _contract(seed):
+    rng = random.Random(seed)
+    lines = ["租赁合同", "甲方：某某公司", ""]
+    for k in range(1, 40):
+        lines.append(f"第{k}条 租金与押金")
+        for _ in range(rng.randint(1, 4)):
+            lines.append("甲方应于每月五日前支付租金。" * rng.randint(1, 6))
+        if rng.random() < 0.2:
+            lines.append("")
+        if rng.random() < 0.2:
+            lines.append(f"（{'一二三'[rng.randint(0, 2)]}）逾期按日万分之五支付违约金；")
+    return "\n".join(lines)
+
+
+def _pages(text, seed):
+    # cut anywhere, including in the middle of a line or a heading
+    rng = random.Random(seed)
+    cuts = sorted(rng.sample(range(1, len(text)), 15))
+    return [text[a:b] for a, b in zip([0] + cuts, cuts + [len(text)])]
+
+
+def _streamed(pages, budget, overlap):
+    p = StreamingPacker(budget, overlap, count=_count)
+    out = []
+    for page in pages:
+        out.extend(p.feed(page))
+    return out + p.close()
+
+
+def test_streaming_packer_matches_one_shot_chunking():
+    for seed in range(20):
+        pages = [pg for pg in _pages(_contract(seed), seed) if pg]
+        for budget in (60, 200, 800):
+            expected = chunk_contract("\n\n".join(pages), budget, 30, count=_count)
+            assert _streamed(pages, budget, 30) == expected
+
+
+def test_streaming_packer_custom_separator():
+    pages = _pages(_contract(1), 1)
+    expected = chunk_contract("\n".join(pages), 100, 0, count=_count)
+    p = StreamingPacker(100, 0, count=_count, sep="\n")
+    got = [c for page in pages for c in p.feed(page)] + p.close()
+    assert got == expected
+
+
+def test_split_oversized_keeps_original_separators():
+    text = "甲方应支付租金。乙方应交付房屋。\n\n双方另行约定。违约金按日计算；逾期超过十日的可解除合同。"
+    parts = _split_oversized(text, 12, _count)
+    assert len(parts) > 1
+    for part in parts:
+        assert part in text
+    # no line break that was not in the source
+    assert "".join(parts).count("\n") == 0
+    assert "".join(parts) == text.replace("\n", "")
+
+
+def test_split_oversized_sentences_are_not_joined_with_newlines():
+    text = "第1条 " + "甲方应支付租金。" * 10 + "\n"
+    parts = _split_oversized(text, 20, _count)
+    assert all("\n" not in p for p in parts)
+    assert "".join(parts) == text.strip()